@@ -0,0 +1,21 @@
+"""
+ASGI config for brims project.
+
+It exposes the ASGI application as a module-level variable named
+``application``, served by an ASGI server, ex)
+
+    daphne brims.asgi:application
+
+/graphql/ is answered by lims.consumers.GraphQLConsumer, every other path
+by the django handler (see brims/routing.py).
+"""
+
+import os
+
+import django
+from channels.routing import get_default_application
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "brims.settings")
+django.setup()
+
+application = get_default_application()
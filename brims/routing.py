@@ -0,0 +1,18 @@
+from django.urls import path, re_path
+from channels.auth import AuthMiddlewareStack
+from channels.http import AsgiHandler
+from channels.routing import ProtocolTypeRouter, URLRouter
+
+from lims.consumers import GraphQLConsumer, LiveConsumer
+
+application = ProtocolTypeRouter({
+    'http': URLRouter([
+        path('graphql/', GraphQLConsumer),
+        # the django urls (brims/urls.py) in a thread
+        re_path(r'', AsgiHandler),
+    ]),
+    # box and storage updates, see lims/live.py
+    'websocket': AuthMiddlewareStack(URLRouter([
+        path('live/', LiveConsumer),
+    ])),
+})
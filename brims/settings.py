@@ -38,9 +38,11 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'corsheaders',
     'debug_toolbar',
     'graphene_django',
+    'channels',
     'lims.apps.LimsConfig',
 ]
 
@@ -49,8 +51,14 @@ MIDDLEWARE = [
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.common.CommonMiddleware',
+    # ETag/304 for GET responses (graphql queries sent with GET)
+    'django.middleware.http.ConditionalGetMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    # JWT header/cookie checked once per request, see lims/auth.py
+    'lims.auth.JSONWebTokenMiddleware',
+    # read your writes after a mutation, see lims/database.py
+    'lims.database.ReplicaStickinessMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     # for csrf token forwarding in dev only
     # see https://www.fusionbox.com/blog/detail/create-react-app-and-django/624/
@@ -92,6 +100,19 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'brims.wsgi.application'
 
+# ASGI deployment (brims/asgi.py), graphql root fields run concurrently
+ASGI_APPLICATION = 'brims.routing.application'
+
+# live box and storage updates (lims/live.py), the in memory layer reaches
+# the websockets of one process only, use a shared layer for several ex)
+# {'BACKEND': 'channels_redis.core.RedisChannelLayer',
+#  'CONFIG': {'hosts': [('127.0.0.1', 6379)]}}
+CHANNEL_LAYERS = {
+    'default': {
+        'BACKEND': 'channels.layers.InMemoryChannelLayer',
+    },
+}
+
 
 # Database
 # https://docs.djangoproject.com/en/2.0/ref/settings/#databases
@@ -105,7 +126,28 @@ DATABASES = {
         'PASSWORD': '',
         'HOST': '',
         'PORT': '',
+        # persistent connections, health checked (DATABASE_HEALTH_CHECK_INTERVAL);
+        # put pgbouncer in front of postgres when running many workers
+        'CONN_MAX_AGE': 600,
+    }
+}
 
+# streaming replica of default, graphql queries read from it
+# (see lims/database.py); points at default until a replica is set up
+DATABASES['replica'] = dict(DATABASES['default'], TEST={'MIRROR': 'default'})
+
+DATABASE_ROUTERS = ['lims.database.ReplicaRouter']
+DATABASE_REPLICA = 'replica'
+# seconds a client reads from the primary after a mutation
+DATABASE_STICKY_SECONDS = 10
+# seconds between checks of a persistent connection
+DATABASE_HEALTH_CHECK_INTERVAL = 30
+
+# local memory is per process, use a shared backend (memcached/redis) when
+# running several workers so cache invalidation reaches all of them
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
     }
 }
 
@@ -137,10 +179,42 @@ AUTH_PASSWORD_VALIDATORS = [
 
 GRAPHENE = {
     'SCHEMA': 'lims.schema.schema',
-    # remove in production
+    # default and maximum page size of cursor paginated (connection) queries
+    'RELAY_CONNECTION_MAX_LIMIT': 100,
+    # static query depth/cost limits, see lims/query_cost.py
+    'QUERY_COST': {
+        'MAX_DEPTH': 10,
+        'MAX_COST': 5000,
+        # per user budgets by username
+        'USER_MAX_COST': {},
+    },
+    # parsed/validated documents cached per process
+    'DOCUMENT_CACHE_SIZE': 256,
+    # registry of persisted queries (sha256 -> document), see
+    # lims/persisted_queries.py and the register_persisted_queries command
+    'PERSISTED_QUERIES': os.path.join(BASE_DIR, 'lims', 'persisted_queries.json'),
+    # only accept registered documents (enable in production)
+    'PERSISTED_QUERIES_ONLY': False,
+    # sampled per operation metrics served at /metrics, see lims/telemetry.py
+    'TELEMETRY': {
+        'SAMPLE_RATE': 0.1,
+        # set to a directory shared by the workers when running several
+        'DIRECTORY': None,
+        # /metrics requires "Authorization: Bearer <token>", without a
+        # token it is only served when DEBUG is on
+        'METRICS_TOKEN': None,
+    },
+    # ASGI /graphql/ concurrency, see lims/consumers.py
+    'ASYNC': {
+        # threads running django code, each may hold a database connection
+        'MAX_WORKERS': 16,
+        # root fields of one query executed at the same time
+        'MAX_CONCURRENT_FIELDS': 4,
+    },
     'MIDDLEWARE': [
-        'graphql_jwt.middleware.JSONWebTokenMiddleware',
-        'graphene_django.debug.DjangoDebugMiddleware',
+        # reports rejected tokens, see lims/auth.py
+        'lims.auth.JSONWebTokenErrorMiddleware',
+        'lims.telemetry.TelemetryMiddleware',
     ]
 }
 
@@ -151,6 +225,7 @@ GRAPHQL_JWT = {
     'JWT_VERIFY_EXPIRATION': True,
     'JWT_EXPIRATION_DELTA': timedelta(minutes=15),
     'JWT_COOKIE_NAME': '',
+    'JWT_GET_USER_BY_NATURAL_KEY_HANDLER': 'lims.auth.get_user_by_natural_key',
 }
 
 # Internationalization
@@ -3,16 +3,20 @@ from django.urls import path, include
 from django.views.decorators.csrf import csrf_exempt
 from django.conf import settings
 from . import views
+from lims import views as lims_views
+from lims.backend import LimsGraphQLBackend
 
 
-from graphene_django.views import GraphQLView
 from graphql_jwt.decorators import jwt_cookie
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('logout/', views.logout_view),
-    path('graphql/', jwt_cookie(csrf_exempt(GraphQLView.as_view(graphiql=True)))),
+    path('graphql/', jwt_cookie(csrf_exempt(lims_views.LimsGraphQLView.as_view(graphiql=True, backend=LimsGraphQLBackend())))),
     path('csrf/', views.csrf),
+    path('manifest/<int:shipment>/', lims_views.shipment_manifest),
+    path('export/', lims_views.export_repository),
+    path('metrics', lims_views.metrics),
 ]
 
 if settings.DEBUG:
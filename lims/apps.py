@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class LimsConfig(AppConfig):
     name = 'lims'
+
+    def ready(self):
+        # connect signal handlers
+        from lims import signals  # noqa: F401
@@ -0,0 +1,87 @@
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.utils.deprecation import MiddlewareMixin
+from graphql_jwt.exceptions import JSONWebTokenError
+from graphql_jwt.settings import jwt_settings
+from graphql_jwt.shortcuts import get_user_by_token
+from graphql_jwt.utils import get_http_authorization
+
+"""
+    JWT authentication done once per HTTP request
+
+    graphql_jwt ships its check as a graphene middleware, which is called
+    for every resolved field and decodes the token again whenever the user
+    is still anonymous. JSONWebTokenMiddleware below is a django middleware
+    instead: the token (Authorization header or cookie) is decoded once and
+    request.user is set before the view runs, for GraphQL and plain views.
+
+    The user named by a token is loaded through a short lived cache
+    (JWT_GET_USER_BY_NATURAL_KEY_HANDLER), cleared when the user is saved,
+    deleted or logs out (see lims/signals.py).
+"""
+
+# seconds a user record is reused, bounds staleness of changes not
+# going through signals (queryset.update)
+USER_CACHE_TIMEOUT = 60
+
+
+def user_cache_key(username):
+    return 'lims:user:{}'.format(username)
+
+
+def get_user_by_natural_key(username):
+    """
+        Cached replacement of graphql_jwt.utils.get_user_by_natural_key
+    """
+    key = user_cache_key(username)
+    user = cache.get(key)
+    if user is None:
+        UserModel = get_user_model()
+        try:
+            user = UserModel._default_manager.get_by_natural_key(username)
+        except UserModel.DoesNotExist:
+            return None
+        cache.set(key, user, USER_CACHE_TIMEOUT)
+    return user
+
+
+def invalidate_user(username):
+    cache.delete(user_cache_key(username))
+
+
+class JSONWebTokenMiddleware(MiddlewareMixin):
+    """
+        Authenticates the request from its JWT, after AuthenticationMiddleware
+        A session user is kept. An invalid or expired token leaves the user
+        anonymous and is kept in request.jwt_error, raised by the GraphQL
+        fields that require a user (see JSONWebTokenErrorMiddleware).
+    """
+
+    def process_request(self, request):
+        request.jwt_error = None
+        if not request.user.is_authenticated:
+            token = get_http_authorization(request)
+            if token is not None:
+                try:
+                    user = get_user_by_token(token, request)
+                except JSONWebTokenError as error:
+                    request.jwt_error = error
+                else:
+                    if user is not None:
+                        request.user = user
+
+
+class JSONWebTokenErrorMiddleware(object):
+    """
+        Graphene middleware reporting a rejected token on the top level
+        fields, as graphql_jwt's middleware did, so clients can tell an
+        expired token from a missing one. Fields allowed for anonymous
+        users (JWT_ALLOW_ANY_HANDLER) are resolved normally.
+    """
+
+    def resolve(self, next, root, info, **kwargs):
+        error = getattr(info.context, 'jwt_error', None)
+        if error is not None and len(info.path) == 1 and (
+                not jwt_settings.JWT_ALLOW_ANY_HANDLER(info, **kwargs)):
+            raise error
+        return next(root, info, **kwargs)
@@ -0,0 +1,147 @@
+import threading
+from collections import OrderedDict
+from functools import partial
+
+from django.conf import settings
+from graphql.backend.base import GraphQLDocument
+from graphql.backend.core import GraphQLCoreBackend
+from graphql.execution import ExecutionResult, execute
+from graphql.language import ast
+from graphql.language.base import parse
+from graphql.utils.get_operation_ast import get_operation_ast
+from graphql.validation import validate
+
+from lims.database import route_operation
+from lims.persisted_queries import query_hash
+from lims.query_cost import check_query_cost
+from lims.telemetry import measure
+
+"""
+    GraphQL backend used by the /graphql/ view
+
+    Parsed and validated documents are kept in an LRU cache keyed by the
+    query hash, so the few dozen operations sent by the frontend are parsed
+    and validated once per process rather than on every request.
+
+    The static depth/cost check (lims/query_cost.py) depends on variables
+    and the user, so it runs on every request between the (cached) standard
+    validation and execution; rejected queries never reach a resolver.
+    Execution is measured by lims/telemetry.py. Queries read from the
+    replica, mutations from the primary (lims/database.py).
+
+    split_root_fields cuts a query into one document per root field, which
+    the ASGI consumer (lims/consumers.py) executes concurrently.
+"""
+
+# documents kept per process, GRAPHENE['DOCUMENT_CACHE_SIZE'] overrides
+DOCUMENT_CACHE_SIZE = 256
+
+
+def validate_and_execute(schema, document_ast, validation_errors, *args, **kwargs):
+    if validation_errors:
+        return ExecutionResult(errors=validation_errors, invalid=True)
+
+    context = kwargs.get('context_value')
+    cost_errors = check_query_cost(
+        schema,
+        document_ast,
+        variables=kwargs.get('variable_values'),
+        operation_name=kwargs.get('operation_name'),
+        user=getattr(context, 'user', None))
+    if cost_errors:
+        return ExecutionResult(errors=cost_errors, invalid=True)
+
+    operation = get_operation_ast(document_ast, kwargs.get('operation_name'))
+    with route_operation(context, operation.operation if operation is not None else None):
+        return measure(
+            context, document_ast, kwargs.get('operation_name'),
+            partial(execute, schema, document_ast, *args, **kwargs))
+
+
+def split_root_fields(document_ast, operation_name=None):
+    """
+        Returns one document per root field of a query operation, each with
+        the variables and fragments of the original, in selection order
+        Returns None when the operation is not a query selecting several
+        distinct root fields (fragments or repeated response keys at the
+        root are not split)
+    """
+    operations = [
+        definition for definition in document_ast.definitions
+        if isinstance(definition, ast.OperationDefinition)
+    ]
+    if operation_name is not None:
+        operations = [
+            operation for operation in operations
+            if operation.name is not None and operation.name.value == operation_name
+        ]
+    if len(operations) != 1 or operations[0].operation != 'query':
+        return None
+
+    operation = operations[0]
+    selections = operation.selection_set.selections
+    if len(selections) < 2 or not all(isinstance(field, ast.Field) for field in selections):
+        return None
+    keys = [(field.alias or field.name).value for field in selections]
+    if len(set(keys)) != len(keys):
+        return None
+
+    fragments = [
+        definition for definition in document_ast.definitions
+        if isinstance(definition, ast.FragmentDefinition)
+    ]
+    return [
+        ast.Document(definitions=[ast.OperationDefinition(
+            operation=operation.operation,
+            name=operation.name,
+            variable_definitions=operation.variable_definitions,
+            directives=operation.directives,
+            selection_set=ast.SelectionSet(selections=[field]),
+        )] + fragments)
+        for field in selections
+    ]
+
+
+class LimsGraphQLBackend(GraphQLCoreBackend):
+
+    def __init__(self, executor=None, cache_size=None):
+        super().__init__(executor=executor)
+        if cache_size is None:
+            cache_size = settings.GRAPHENE.get('DOCUMENT_CACHE_SIZE', DOCUMENT_CACHE_SIZE)
+        self.cache_size = cache_size
+        self._documents = OrderedDict()
+        self._lock = threading.Lock()
+
+    def parse_and_validate(self, schema, document_string):
+        """
+            Returns (document ast, validation errors), from the cache if possible
+            Syntax errors are raised and not cached
+        """
+        key = (id(schema), query_hash(document_string))
+        with self._lock:
+            cached = self._documents.get(key)
+            if cached is not None:
+                self._documents.move_to_end(key)
+                return cached
+
+        document_ast = parse(document_string)
+        cached = (document_ast, validate(schema, document_ast))
+
+        with self._lock:
+            self._documents[key] = cached
+            while len(self._documents) > self.cache_size:
+                self._documents.popitem(last=False)
+        return cached
+
+    def document_from_string(self, schema, document_string):
+        document_ast, validation_errors = self.parse_and_validate(schema, document_string)
+        return GraphQLDocument(
+            schema=schema,
+            document_string=document_string,
+            document_ast=document_ast,
+            execute=partial(
+                validate_and_execute,
+                schema,
+                document_ast,
+                validation_errors,
+                **self.execute_params))
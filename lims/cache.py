@@ -0,0 +1,79 @@
+from django.core.cache import cache
+from django.db import transaction
+
+from lims.database import reading_from_primary
+from lims.live import publish_boxes
+from lims.refresh_queue import RefreshQueue
+
+"""
+    Cache helpers for rendered data that is expensive to build and
+    read far more often than it changes.
+
+    Entries are removed by the signal handlers in lims/signals.py.
+    Removal is deferred until the surrounding transaction commits so a
+    concurrent reader cannot re-cache data that is about to change.
+    Entries are built from the primary database, a lagging replica
+    would cache data that was just replaced.
+    The live subscribers of a box (lims/live.py) are told once its grid
+    has been removed.
+"""
+
+# seconds, a safety net for changes that bypass signals (queryset.update)
+BOX_GRID_TIMEOUT = 60 * 60
+REFERENCE_TIMEOUT = 60 * 60 * 24
+
+
+def box_grid_key(box_id):
+    return 'lims:box-grid:{}'.format(box_id)
+
+
+def get_box_grid(box_id, build):
+    """
+        Returns the cached grid for a box, calling build(box_id) on a miss
+    """
+    key = box_grid_key(box_id)
+    grid = cache.get(key)
+    if grid is None:
+        with reading_from_primary():
+            grid = build(box_id)
+        cache.set(key, grid, BOX_GRID_TIMEOUT)
+    return grid
+
+
+def drop_box_grids(box_ids):
+    cache.delete_many([box_grid_key(box_id) for box_id in box_ids])
+    publish_boxes(box_ids)
+
+
+_box_grids = RefreshQueue(drop_box_grids, 1000)
+
+
+def invalidate_box_grids(box_ids):
+    _box_grids.add(box_ids)
+
+
+# reference data: small lookup tables (specimen/aliquot types, events,
+# visits, schedules, box types, carriers, destinations) read on every page
+# load and edited rarely, each cached as the list of its instances
+
+
+def reference_key(model):
+    return 'lims:reference:{}'.format(model._meta.label_lower)
+
+
+def get_reference_data(model):
+    """
+        Returns every instance of model ordered by pk, cached
+    """
+    key = reference_key(model)
+    instances = cache.get(key)
+    if instances is None:
+        with reading_from_primary():
+            instances = list(model.objects.order_by('pk'))
+        cache.set(key, instances, REFERENCE_TIMEOUT)
+    return instances
+
+
+def invalidate_reference_data(model):
+    key = reference_key(model)
+    transaction.on_commit(lambda: cache.delete(key))
@@ -0,0 +1,118 @@
+import base64
+import datetime
+import json
+from collections import namedtuple
+
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from lims.models.patient import PatientModel
+from lims.models.specimen import AliquotModel, SpecimenModel
+from lims.models.tombstone import TombstoneModel
+
+"""
+    Delta sync of patients, specimens and aliquots (changesSince query)
+
+    Rows created or updated since a time are read in (modify_date, id)
+    order from the modify_date indexes, deletions from the tombstones left
+    by the delete signals (lims/signals.py). Each of the four lists is
+    paged separately; the cursor returned holds the last (date, id) seen
+    in every list, so a client asks again with it until hasMore is false
+    and keeps the last cursor for its next sync.
+
+    Rows changed in the last SETTLE_SECONDS are left for the next sync:
+    modify_date is set when a row is saved, not when its transaction
+    commits, and a row committed late must not fall behind a cursor.
+
+    modify_date is an auto_now field, set by save and bulk_create but not
+    by queryset.update() or bulk_update(): code changing tracked rows
+    that way has to set modify_date=Now() itself or the change is never
+    synced.
+"""
+
+SETTLE_SECONDS = 10
+# default and maximum rows of each list per page
+MAX_LIMIT = 500
+
+# (list name, model, date field)
+STREAMS = [
+    ('patients', PatientModel, 'modify_date'),
+    ('specimens', SpecimenModel, 'modify_date'),
+    ('aliquots', AliquotModel, 'modify_date'),
+    ('deleted', TombstoneModel, 'deleted_date'),
+]
+
+# tombstone model name of the tracked models
+TOMBSTONE_MODELS = {
+    PatientModel: 'patient',
+    SpecimenModel: 'specimen',
+    AliquotModel: 'aliquot',
+}
+
+Changes = namedtuple('Changes', 'patients specimens aliquots deleted cursor has_more')
+
+
+def encode_cursor(positions):
+    data = {
+        name: [position[0].isoformat(), position[1]]
+        for name, position in positions.items() if position is not None
+    }
+    return base64.b64encode(json.dumps(data, sort_keys=True).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """ returns {list name: (date, id)} """
+    try:
+        data = json.loads(base64.b64decode(cursor.encode()).decode())
+        positions = {}
+        for name, _, _ in STREAMS:
+            if name in data:
+                date, pk = data[name]
+                date = parse_datetime(date)
+                if date is None:
+                    raise ValueError(cursor)
+                positions[name] = (date, int(pk))
+        return positions
+    except (ValueError, TypeError):
+        raise Exception('Invalid cursor "{}"'.format(cursor))
+
+
+def record_deletion(model, pk):
+    """ leaves a tombstone for a deleted row of a tracked model """
+    TombstoneModel.objects.create(model=TOMBSTONE_MODELS[model], object_id=pk)
+
+
+def changes_since(timestamp=None, cursor=None, limit=None, now=None):
+    """
+        Returns the Changes after cursor, or after timestamp when there is
+        no cursor yet (everything without either)
+        now: the current time, rows changed less than SETTLE_SECONDS
+        before it are left out
+    """
+    limit = MAX_LIMIT if limit is None else max(1, min(limit, MAX_LIMIT))
+    if cursor is not None:
+        positions = decode_cursor(cursor)
+    else:
+        positions = {name: (timestamp, 0) for name, _, _ in STREAMS} if timestamp else {}
+
+    until = (now or timezone.now()) - datetime.timedelta(seconds=SETTLE_SECONDS)
+    lists = {}
+    has_more = False
+    for name, model, date_field in STREAMS:
+        rows = model.objects.filter(**{date_field + '__lt': until})
+        position = positions.get(name)
+        if position is not None:
+            date, pk = position
+            rows = rows.filter(
+                Q(**{date_field + '__gt': date}) | Q(**{date_field: date, 'pk__gt': pk}))
+        # one extra row tells whether there is more
+        rows = list(rows.order_by(date_field, 'pk')[:limit + 1])
+        if len(rows) > limit:
+            has_more = True
+            rows = rows[:limit]
+        if rows:
+            positions[name] = (getattr(rows[-1], date_field), rows[-1].pk)
+        lists[name] = rows
+
+    return Changes(cursor=encode_cursor(positions), has_more=has_more, **lists)
@@ -0,0 +1,467 @@
+import asyncio
+import copy
+import threading
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from channels.generic.http import AsyncHttpConsumer
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
+from channels.http import AsgiHandler, AsgiRequest
+from django.conf import settings
+from django.core.handlers.base import BaseHandler
+from django.core.handlers.exception import response_for_exception
+from django.db import close_old_connections, connections
+from django.http import HttpResponse
+from django.middleware.csrf import get_token
+from django.urls import get_resolver
+from django.utils.module_loading import import_string
+from graphene_django.views import HttpError
+from graphql.execution import execute
+from graphql_jwt.exceptions import JSONWebTokenError
+from graphql_jwt.shortcuts import get_user_by_token
+
+from lims.backend import LimsGraphQLBackend, split_root_fields
+from lims.database import check_connections, reading_from_primary, route_operation
+from lims.live import MAX_BOXES, STORAGE_GROUP, attach_loop, box_group, grid_diff
+from lims.models.storage import BoxModel
+from lims.query_cost import check_query_cost
+from lims.schema import build_box_grid
+from lims.telemetry import finish_recording, recording_sql, start_recording
+from lims.views import LimsGraphQLView, patch_revalidation
+
+"""
+    Async /graphql/ endpoint of the ASGI deployment (brims/asgi.py)
+
+    A query selecting several root fields, ex) a dashboard asking for
+    allShipments, storageUi and allPatients, is cut into one document per
+    root field (lims/backend.py split_root_fields). The parts are executed
+    in parallel threads, since the ORM is synchronous, and their results
+    merged in selection order. The event loop only waits: no thread is held
+    by the request besides the ones running its fields.
+
+    Everything else (mutations, GraphiQL, introspection of one field,
+    invalid documents ...) goes through the regular django stack and
+    LimsGraphQLView in a thread, as under WSGI.
+
+    Around the parallel execution the hooks of the django middleware
+    (MiddlewareMixin process_request, process_view with the view /graphql/
+    resolves to, and process_response) are run like the django handler
+    would, so ex) CsrfViewMiddleware checks the request unless the view is
+    csrf_exempt. An exception raised by a hook (DisallowedHost,
+    PermissionDenied ...) is turned into its 400/403/500 response as by
+    the django handler. Middleware without these hooks (the debug toolbar,
+    which only decorates html pages) is not called, nor are
+    process_exception hooks: resolver errors are reported in the GraphQL
+    response and any other exception is answered with a 500 by channels.
+
+    The thread pool is shared by the requests of the process; its threads
+    keep persistent database connections (CONN_MAX_AGE) until
+    shutdown_executor.
+
+    LiveConsumer (/live/) pushes box and storage changes over a websocket
+    to clients that would otherwise poll allSlots and storageUi, see
+    lims/live.py.
+
+    Limits live under GRAPHENE['ASYNC'], ex)
+    'ASYNC': {
+        'MAX_WORKERS': 16,
+        'MAX_CONCURRENT_FIELDS': 4,
+    }
+"""
+
+DEFAULTS = {
+    # threads running django code for the ASGI consumer, shared by all requests;
+    # every thread may hold a database connection
+    'MAX_WORKERS': 16,
+    # root fields of one request executed at the same time
+    'MAX_CONCURRENT_FIELDS': 4,
+}
+
+
+# middleware methods called around the parallel execution
+HOOKS = ('process_request', 'process_view', 'process_response')
+
+
+def get_async_settings():
+    return dict(DEFAULTS, **settings.GRAPHENE.get('ASYNC', {}))
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """ the thread pool of the process, created on first use """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=get_async_settings()['MAX_WORKERS'],
+                thread_name_prefix='lims-graphql')
+        return _executor
+
+
+def with_connections(func, *args, **kwargs):
+    """ calls func closing database connections that can't be reused, before and after """
+    close_old_connections()
+    check_connections()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        close_old_connections()
+
+
+def shutdown_executor():
+    """
+        Stops the thread pool, closing the database connections its
+        threads kept open (CONN_MAX_AGE), ex) before the test database is
+        dropped; the next request creates a new pool
+    """
+    global _executor
+    with _executor_lock:
+        executor, _executor = _executor, None
+    if executor is None:
+        return
+    # one close per thread: each waits for the others before returning
+    workers = len(executor._threads)
+    barrier = threading.Barrier(workers)
+
+    def close_connections():
+        barrier.wait()
+        connections.close_all()
+
+    for _ in range(workers):
+        executor.submit(close_connections)
+    executor.shutdown(wait=True)
+
+
+async def run_in_pool(func, *args, **kwargs):
+    return await asyncio.get_event_loop().run_in_executor(
+        get_executor(), partial(with_connections, func, *args, **kwargs))
+
+
+class Handler(BaseHandler):
+    """
+        The django handler: middleware, url routing and views
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.load_middleware()
+        self.hooks = []
+        for middleware_path in settings.MIDDLEWARE:
+            middleware = import_string(middleware_path)
+            if any(hasattr(middleware, hook) for hook in HOOKS):
+                self.hooks.append(middleware(self.get_response))
+
+    def process_request(self, request):
+        """
+            Runs the request then view hooks, returns the response of the
+            first middleware answering the request, or None
+            An exception raised by a hook (DisallowedHost, PermissionDenied
+            ...) is answered as by the django handler
+        """
+        try:
+            return self.run_request_hooks(request)
+        except Exception as exception:
+            return response_for_exception(request, exception)
+
+    def run_request_hooks(self, request):
+        for middleware in self.hooks:
+            process_request = getattr(middleware, 'process_request', None)
+            response = process_request(request) if process_request is not None else None
+            if response is not None:
+                return response
+
+        request.resolver_match = get_resolver(getattr(request, 'urlconf', None)).resolve(
+            request.path_info)
+        callback, callback_args, callback_kwargs = request.resolver_match
+        for middleware in self.hooks:
+            process_view = getattr(middleware, 'process_view', None)
+            if process_view is None:
+                continue
+            response = process_view(request, callback, callback_args, callback_kwargs)
+            if response is not None:
+                return response
+        return None
+
+    def process_response(self, request, response):
+        for middleware in reversed(self.hooks):
+            process_response = getattr(middleware, 'process_response', None)
+            if process_response is None:
+                continue
+            try:
+                response = process_response(request, response)
+            except Exception as exception:
+                response = response_for_exception(request, exception)
+        return response
+
+
+class GraphQLConsumer(AsyncHttpConsumer):
+    """
+        /graphql/ executing the root fields of queries concurrently
+    """
+
+    handler = None
+    view = None
+
+    @classmethod
+    def setup(cls):
+        if cls.handler is None:
+            cls.view = LimsGraphQLView(graphiql=True, backend=LimsGraphQLBackend())
+            cls.handler = Handler()
+
+    async def handle(self, body):
+        self.setup()
+        request = AsgiRequest(self.scope, BytesIO(body))
+        plan = await run_in_pool(self.plan, request)
+        if plan is None:
+            response = await run_in_pool(self.handler.get_response, request)
+        else:
+            response = await run_in_pool(self.handler.process_request, request)
+            if response is None:
+                response = await self.execute_parallel(request, *plan)
+            response = await run_in_pool(self.handler.process_response, request, response)
+
+        for message in AsgiHandler.encode_response(response):
+            await self.send(message)
+        await run_in_pool(response.close)
+
+    def plan(self, request):
+        """
+            Returns (document ast, parts, variables, operation name) for
+            a query worth running in parallel, None otherwise
+        """
+        view = self.view
+        if request.method not in ('GET', 'POST'):
+            return None
+        try:
+            data = view.parse_body(request)
+            if view.can_display_graphiql(request, data):
+                return None
+            query, variables, operation_name, _ = view.get_graphql_params(request, data)
+        except HttpError:
+            # answered by the view
+            return None
+        if not query:
+            return None
+
+        try:
+            document_ast, validation_errors = view.backend.parse_and_validate(view.schema, query)
+        except Exception:
+            return None
+        if validation_errors:
+            return None
+        parts = split_root_fields(document_ast, operation_name)
+        if parts is None:
+            return None
+        return document_ast, parts, variables, operation_name
+
+    async def execute_parallel(self, request, document_ast, parts, variables, operation_name):
+        view = self.view
+        await run_in_pool(self.prepare, request)
+        cost_errors = await run_in_pool(
+            check_query_cost, view.schema, document_ast,
+            variables=variables, operation_name=operation_name, user=request.user)
+        if cost_errors:
+            return self.json_response(
+                request, {'errors': [view.format_error(error) for error in cost_errors]}, 400)
+
+        recording = start_recording(request, document_ast, operation_name)
+        semaphore = asyncio.Semaphore(get_async_settings()['MAX_CONCURRENT_FIELDS'])
+
+        async def execute_part(part):
+            async with semaphore:
+                return await run_in_pool(
+                    self.execute_part, request, part, variables, operation_name, recording)
+
+        try:
+            results = await asyncio.gather(*[execute_part(part) for part in parts])
+        except Exception:
+            if recording is not None:
+                finish_recording(recording, request, True)
+            raise
+
+        data = {}
+        errors = []
+        for result in results:
+            if result.errors:
+                errors.extend(view.format_error(error) for error in result.errors)
+            if data is not None and result.data is not None:
+                data.update(result.data)
+            else:
+                # a non null root field failed
+                data = None
+        if recording is not None:
+            finish_recording(recording, request, bool(errors))
+
+        response = {}
+        if errors:
+            response['errors'] = errors
+        response['data'] = data
+        return self.json_response(request, response, 200)
+
+    @staticmethod
+    def prepare(request):
+        # as the view's decorators: ensure_csrf_cookie, jwt_cookie
+        get_token(request)
+        request.jwt_cookie = True
+
+    def execute_part(self, request, part, variables, operation_name, recording):
+        # each part gets its own copy of the request, DataLoaders
+        # (lims/loaders.py) are created per context and are not thread safe
+        with route_operation(request, 'query'), recording_sql(recording):
+            return execute(
+                self.view.schema,
+                part,
+                root_value=self.view.get_root_value(request),
+                context_value=copy.copy(request),
+                variable_values=variables,
+                operation_name=operation_name,
+                middleware=self.view.get_middleware(request))
+
+    def json_response(self, request, response, status):
+        return patch_revalidation(request, HttpResponse(
+            self.view.json_encode(request, response),
+            status=status,
+            content_type='application/json'))
+
+
+def read_box_grid(box_id):
+    with reading_from_primary():
+        return build_box_grid(box_id)
+
+
+class LiveConsumer(AsyncJsonWebsocketConsumer):
+    """
+        /live/ websocket pushing box grid and storage changes (lims/live.py)
+
+        The client authenticates with its session or by sending its JWT:
+        {"token": "..."}
+        and (un)subscribes to boxes and to the storage tree:
+        {"subscribe": {"boxes": [1, 2], "storage": true}}
+        {"unsubscribe": {"boxes": [2]}}
+        at most MAX_BOXES boxes at a time
+
+        It is sent, for a subscribed box, every slot on subscription then
+        the slots that changed (content null for an emptied slot):
+        {"box": 1, "name": "...", "description": "...",
+         "slots": [{"row": 1, "column": 2, "content": "P1 PLASMA 12"}]}
+        {"box": 1, "deleted": true}
+        for the storage tree, the changed storage objects and boxes:
+        {"storage": [...], "boxes": [...], "deletedStorage": [...], "deletedBoxes": [...]}
+        and {"error": "..."} for a message it can't act on
+    """
+
+    async def connect(self):
+        attach_loop(asyncio.get_event_loop())
+        self.user = self.scope.get('user')
+        # grid last sent by subscribed box
+        self.grids = {}
+        self.storage = False
+        await self.accept()
+
+    async def disconnect(self, code):
+        for box_id in list(self.grids):
+            await self.channel_layer.group_discard(box_group(box_id), self.channel_name)
+        if self.storage:
+            await self.channel_layer.group_discard(STORAGE_GROUP, self.channel_name)
+
+    async def receive_json(self, content, **kwargs):
+        if not isinstance(content, dict):
+            await self.send_json({'error': 'Messages are JSON objects'})
+            return
+        if 'token' in content:
+            try:
+                self.user = await run_in_pool(get_user_by_token, content['token'])
+            except JSONWebTokenError as error:
+                await self.send_json({'error': str(error)})
+                return
+        if self.user is None or not self.user.is_authenticated:
+            await self.send_json({'error': 'Not logged in'})
+            return
+
+        try:
+            subscribe = self.parse_subscription(content.get('subscribe'))
+            unsubscribe = self.parse_subscription(content.get('unsubscribe'))
+        except (TypeError, ValueError):
+            await self.send_json({'error': 'Invalid subscription'})
+            return
+
+        box_ids, storage = unsubscribe
+        for box_id in box_ids:
+            if self.grids.pop(box_id, False) is not False:
+                await self.channel_layer.group_discard(box_group(box_id), self.channel_name)
+        if storage and self.storage:
+            self.storage = False
+            await self.channel_layer.group_discard(STORAGE_GROUP, self.channel_name)
+
+        box_ids, storage = subscribe
+        if len(set(self.grids) | set(box_ids)) > MAX_BOXES:
+            await self.send_json({'error': 'At most {} boxes can be subscribed'.format(MAX_BOXES)})
+            return
+        if storage and not self.storage:
+            self.storage = True
+            await self.channel_layer.group_add(STORAGE_GROUP, self.channel_name)
+        for box_id in box_ids:
+            if box_id not in self.grids:
+                # joined before reading the grid, no change can be missed
+                self.grids[box_id] = None
+                await self.channel_layer.group_add(box_group(box_id), self.channel_name)
+                await self.send_box(box_id)
+
+    @staticmethod
+    def parse_subscription(subscription):
+        """ returns (box ids, storage) of a subscribe/unsubscribe message """
+        if subscription is None:
+            return [], False
+        if not isinstance(subscription, dict):
+            raise TypeError(subscription)
+        return ([int(box_id) for box_id in subscription.get('boxes') or []],
+                bool(subscription.get('storage')))
+
+    async def send_box(self, box_id):
+        """
+            sends the slots of a subscribed box that changed since the grid sent last
+            The grid is built from the primary, not read from the box grid
+            cache: the change may have been made by another process, whose
+            cache entry is the only one removed with a per process cache
+        """
+        try:
+            grid = await run_in_pool(read_box_grid, box_id)
+        except BoxModel.DoesNotExist:
+            del self.grids[box_id]
+            await self.channel_layer.group_discard(box_group(box_id), self.channel_name)
+            await self.send_json({'box': box_id, 'deleted': True})
+            return
+        previous = self.grids[box_id]
+        update = grid_diff(previous, grid)
+        self.grids[box_id] = grid
+        if previous is None or update['slots'] or len(update) > 1:
+            update['box'] = box_id
+            await self.send_json(update)
+
+    async def box_changed(self, event):
+        if event['box'] in self.grids:
+            await self.send_box(event['box'])
+
+    async def storage_changed(self, event):
+        if self.storage:
+            await self.send_json({
+                'storage': [{
+                    'id': row['id'],
+                    'name': row['name'],
+                    'description': row['description'],
+                    'container': row['container'],
+                    'cssIcon': row['css_icon'],
+                } for row in event['storage']],
+                'boxes': [{
+                    'id': row['id'],
+                    'name': row['name'],
+                    'description': row['description'],
+                    'storage': row['storage_location'],
+                } for row in event['boxes']],
+                'deletedStorage': event['deleted_storage'],
+                'deletedBoxes': event['deleted_boxes'],
+            })
@@ -0,0 +1,165 @@
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+from django.utils.deprecation import MiddlewareMixin
+
+"""
+    Read replica routing and connection health checks
+
+    GraphQL queries read from the replica (settings.DATABASE_REPLICA), every
+    write and the reads of mutations go to the primary (default). The choice
+    is made once per operation by the GraphQL backend from the operation
+    type (route_operation), so resolvers don't pick a database.
+
+    A client that ran a mutation gets a short lived cookie
+    (DATABASE_STICKY_SECONDS) sending its next queries to the primary as
+    well, so it reads its own writes while the replica catches up. Cached
+    data (lims/cache.py) is always built from the primary. When the
+    replica can't be connected to, queries read from the primary and the
+    replica is tried again DATABASE_HEALTH_CHECK_INTERVAL seconds later.
+
+    Connections are persistent (CONN_MAX_AGE). Before a request, an open
+    connection is checked (SELECT 1) at most every
+    DATABASE_HEALTH_CHECK_INTERVAL seconds and replaced when the server
+    went away, instead of failing the request's first query.
+"""
+
+STICKY_COOKIE = 'lims_primary'
+
+_state = threading.local()
+
+# time.monotonic() until which the replica is considered down
+_replica_down_until = 0
+
+
+def replica_alias():
+    """ the replica alias, None when it is not configured """
+    alias = getattr(settings, 'DATABASE_REPLICA', None)
+    return alias if alias in settings.DATABASES else None
+
+
+def sticky_seconds():
+    return getattr(settings, 'DATABASE_STICKY_SECONDS', 10)
+
+
+def health_check_interval():
+    return getattr(settings, 'DATABASE_HEALTH_CHECK_INTERVAL', 30)
+
+
+def replica_available(alias):
+    """
+        Connects the current thread to the replica if needed, False when it
+        is down (the last attempt failed less than a health check ago)
+    """
+    global _replica_down_until
+    if time.monotonic() < _replica_down_until:
+        return False
+    connection = connections[alias]
+    if connection.connection is not None:
+        # checked by check_connections
+        return True
+    try:
+        connection.ensure_connection()
+    except DatabaseError:
+        _replica_down_until = time.monotonic() + health_check_interval()
+        return False
+    return True
+
+
+@contextmanager
+def reading_from(alias):
+    """ routes the reads of the current thread to alias (None for the primary) """
+    previous = getattr(_state, 'alias', None)
+    _state.alias = alias
+    try:
+        yield
+    finally:
+        _state.alias = previous
+
+
+def reading_from_primary():
+    return reading_from(None)
+
+
+def route_operation(request, operation_type):
+    """
+        Context routing the reads of a GraphQL operation: queries read from the
+        replica unless the client wrote recently, mutations use the primary
+        and make the client sticky
+    """
+    if operation_type == 'mutation':
+        if request is not None:
+            request.lims_wrote = True
+        return reading_from_primary()
+    if operation_type != 'query' or (
+            request is not None and STICKY_COOKIE in getattr(request, 'COOKIES', {})):
+        return reading_from_primary()
+    alias = replica_alias()
+    # reads inside a transaction stay on the primary anyway (ReplicaRouter)
+    if alias is None or connections[DEFAULT_DB_ALIAS].in_atomic_block or (
+            not replica_available(alias)):
+        return reading_from_primary()
+    return reading_from(alias)
+
+
+class ReplicaRouter(object):
+    """
+        Sends the reads routed by route_operation to the replica
+        Reads inside a transaction stay on the primary
+    """
+
+    def db_for_read(self, model, **hints):
+        alias = getattr(_state, 'alias', None)
+        if alias is None or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return None
+        return alias
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # the replica holds the same rows as the primary
+        databases = {DEFAULT_DB_ALIAS, replica_alias()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # the replica is migrated by replication
+        if db == replica_alias():
+            return False
+        return None
+
+
+class ReplicaStickinessMiddleware(MiddlewareMixin):
+    """
+        Sets the sticky cookie on the response of a request running a mutation
+    """
+
+    def process_response(self, request, response):
+        if getattr(request, 'lims_wrote', False):
+            response.set_cookie(
+                STICKY_COOKIE, '1', max_age=sticky_seconds(), httponly=True, samesite='Lax')
+        return response
+
+
+def check_connections():
+    """
+        Closes the persistent connections of the current thread that don't
+        answer anymore, the next query opens a new one
+        A connection is checked at most every DATABASE_HEALTH_CHECK_INTERVAL
+    """
+    interval = health_check_interval()
+    now = time.monotonic()
+    for connection in connections.all():
+        if connection.connection is None or connection.in_atomic_block:
+            continue
+        last_check = getattr(connection, 'lims_checked_at', None)
+        if last_check is not None and now - last_check < interval:
+            continue
+        if not connection.is_usable():
+            connection.close()
+        connection.lims_checked_at = now
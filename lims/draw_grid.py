@@ -0,0 +1,132 @@
+from django.db import transaction
+from django.db.models import Count
+
+from lims.models.patient import PatientModel
+from lims.models.schedule import DrawGridModel, EventModel, ScheduleModel
+from lims.models.specimen import AliquotModel, SpecimenType
+from lims.refresh_queue import RefreshQueue
+
+"""
+    Draw/event grid engine
+
+    The grid has one row (DrawGridModel) per patient, event and specimen
+    type that is either expected by the patient's draw schedule or has been
+    collected. An aliquot counts towards the event whose name equals its
+    visit label.
+
+    A refresh recomputes the rows of a batch of patients with the same
+    handful of queries (lock patients, collected counts, delete, insert)
+    no matter how many patients are in it, so rebuilding the whole study
+    is one pass over the aliquot table per batch. Model changes queue the affected patients (lims/signals.py) and
+    the queue is refreshed once when the transaction commits
+    (lims/refresh_queue.py).
+"""
+
+BATCH_SIZE = 500
+
+
+def expand_schedule(schedule, event_ids, type_ids):
+    """
+        Returns the (event id, specimen type id) pairs expected by a schedule
+        Names unknown to event_ids/type_ids are ignored
+    """
+    cells = set()
+    for event, specimen_types in (schedule or {}).items():
+        if event not in event_ids:
+            continue
+        for name in specimen_types:
+            if name in type_ids:
+                cells.add((event_ids[event], type_ids[name]))
+    return cells
+
+
+def schedules_naming(events=(), specimen_types=()):
+    """
+        Returns the ids of the schedules naming one of events or
+        specimen_types, whose rows change when such a name is given to or
+        taken from an event or specimen type
+    """
+    events, specimen_types = set(events), set(specimen_types)
+    schedule_ids = []
+    for schedule_id, schedule in ScheduleModel.objects.values_list('id', 'schedule'):
+        schedule = schedule or {}
+        if events & set(schedule) or any(
+                specimen_types & set(names) for names in schedule.values()):
+            schedule_ids.append(schedule_id)
+    return schedule_ids
+
+
+def refresh_draw_grid(patient_ids):
+    """
+        Recomputes the grid rows of the given patients
+        Returns the number of rows written
+    """
+    patient_ids = list(set(patient_ids))
+    if not patient_ids:
+        return 0
+
+    event_ids = dict(EventModel.objects.values_list('event', 'id'))
+    # SpecimenType.type is not unique, the first one of a name wins
+    type_ids = {}
+    for type_id, name in SpecimenType.objects.order_by('-id').values_list('id', 'type'):
+        type_ids[name] = type_id
+
+    with transaction.atomic():
+        # locking the patients serializes concurrent refreshes of a patient,
+        # the counts below are read after the lock is granted
+        schedules = list(PatientModel.objects.filter(pk__in=patient_ids).select_for_update(
+            of=('self',)).values_list('id', 'draw_schedule__schedule'))
+        cells = collect_cells(patient_ids, schedules, event_ids, type_ids)
+        DrawGridModel.objects.filter(patient__in=patient_ids).delete()
+        DrawGridModel.objects.bulk_create(cells)
+    return len(cells)
+
+
+def collect_cells(patient_ids, schedules, event_ids, type_ids):
+    """ returns the grid rows of patients, schedules being (patient id, schedule) """
+    cells = {}
+    for patient_id, schedule in schedules:
+        for event_id, type_id in expand_schedule(schedule, event_ids, type_ids):
+            cells[(patient_id, event_id, type_id)] = DrawGridModel(
+                patient_id=patient_id, event_id=event_id, specimen_type_id=type_id,
+                expected=True)
+
+    collected = AliquotModel.objects.filter(
+        specimen__patient__in=patient_ids,
+        visit__label__in=event_ids.keys(),
+    ).values('specimen__patient', 'visit__label', 'specimen__type').annotate(
+        specimen_count=Count('specimen', distinct=True),
+        aliquot_count=Count('id'),
+    ).order_by()
+    for row in collected:
+        key = (row['specimen__patient'], event_ids[row['visit__label']], row['specimen__type'])
+        cell = cells.get(key)
+        if cell is None:
+            cell = cells[key] = DrawGridModel(
+                patient_id=key[0], event_id=key[1], specimen_type_id=key[2])
+        cell.specimens = row['specimen_count']
+        cell.aliquots = row['aliquot_count']
+    return list(cells.values())
+
+
+def rebuild_draw_grid(batch_size=BATCH_SIZE):
+    """
+        Recomputes the grid of every patient
+        Returns the number of rows written
+    """
+    patient_ids = list(PatientModel.objects.order_by('pk').values_list('pk', flat=True))
+    total = 0
+    for start in range(0, len(patient_ids), batch_size):
+        total += refresh_draw_grid(patient_ids[start:start + batch_size])
+    return total
+
+
+_queue = RefreshQueue(refresh_draw_grid, BATCH_SIZE)
+
+
+def refresh_draw_grid_on_commit(patient_ids):
+    """
+        Queues patients for a refresh once the current transaction commits
+        Every queued patient of a transaction is refreshed in one batch
+    """
+    _queue.add(patient_ids)
@@ -0,0 +1,237 @@
+import csv
+import json
+from itertools import islice
+
+from lims.models.patient import PatientModel
+from lims.models.storage import BoxSlotModel
+
+"""
+    Streaming exports
+
+    Rows are read with .iterator(chunk_size=...), which uses a server-side
+    cursor on postgres, and are written out one at a time so memory use does
+    not depend on the size of the export.
+
+    The repository export (export_repository command, /export/ view) has
+    one row per aliquot joined to its specimen, patient, slot, box and
+    shipment; a patient without specimens or a specimen without aliquots
+    still has a row with the columns it lacks empty. It is read in batches
+    of patients, in patient id order, so an interrupted export resumes
+    after the last patient written. The columnar format (parquet) needs
+    pyarrow.
+"""
+
+CHUNK_SIZE = 2000
+# patients read by one query of the repository export
+BATCH_SIZE = 1000
+
+MANIFEST_COLUMNS = (
+    ('box_id', 'box_id'),
+    ('box', 'box__name'),
+    ('row', 'row_position'),
+    ('column', 'column_position'),
+    ('aliquot_id', 'content_id'),
+    ('aliquot_type', 'content__type__type'),
+    ('volume', 'content__volume'),
+    ('units', 'content__type__units'),
+    ('visit', 'content__visit__label'),
+    ('collectdate', 'content__collectdate'),
+    ('specimen_id', 'content__specimen_id'),
+    ('patient', 'content__specimen__patient__pid'),
+)
+
+
+ALIQUOT = 'specimenmodel__aliquotmodel__'
+SLOT = ALIQUOT + 'boxslotmodel__'
+
+# (column, field, type), types are used by the columnar format
+REPOSITORY_COLUMNS = (
+    ('patient_id', 'id', 'int'),
+    ('pid', 'pid', 'str'),
+    ('source', 'source__name', 'str'),
+    ('specimen_id', 'specimenmodel__id', 'int'),
+    ('specimen_type', 'specimenmodel__type__type', 'str'),
+    ('specimen_collectdate', 'specimenmodel__collectdate', 'date'),
+    ('aliquot_id', ALIQUOT + 'id', 'int'),
+    ('barcode', ALIQUOT + 'barcode', 'str'),
+    ('aliquot_type', ALIQUOT + 'type__type', 'str'),
+    ('volume', ALIQUOT + 'volume', 'float'),
+    ('units', ALIQUOT + 'type__units', 'str'),
+    ('visit', ALIQUOT + 'visit__label', 'str'),
+    ('aliquot_collectdate', ALIQUOT + 'collectdate', 'datetime'),
+    ('box_id', SLOT + 'box_id', 'int'),
+    ('box', SLOT + 'box__name', 'str'),
+    ('row', SLOT + 'row_position', 'int'),
+    ('column', SLOT + 'column_position', 'int'),
+    ('storage_id', SLOT + 'box__storage_location_id', 'int'),
+    ('shipment_id', SLOT + 'box__manifest_id', 'int'),
+    ('shipment_number', SLOT + 'box__manifest__shipment_number', 'str'),
+    ('sent_date', SLOT + 'box__manifest__sent_date', 'datetime'),
+    ('received_date', SLOT + 'box__manifest__received_date', 'datetime'),
+)
+
+
+def patient_batches(after=None, batch_size=BATCH_SIZE):
+    """
+        Yields the (after, until) patient ids bounding successive batches of
+        batch_size patients with an id greater than after
+    """
+    while True:
+        patients = PatientModel.objects.order_by('pk').values_list('pk', flat=True)
+        if after is not None:
+            patients = patients.filter(pk__gt=after)
+        until = patients[batch_size - 1:batch_size].first()
+        if until is None:
+            # fewer than batch_size patients left
+            until = patients.last()
+            if until is not None:
+                yield after, until
+            return
+        yield after, until
+        after = until
+
+
+def repository_rows(after=None, until=None, chunk_size=CHUNK_SIZE):
+    """
+        Export rows of the patients with an id greater than after, up to
+        until, ordered by patient, specimen and aliquot
+    """
+    patients = PatientModel.objects.all()
+    if after is not None:
+        patients = patients.filter(pk__gt=after)
+    if until is not None:
+        patients = patients.filter(pk__lte=until)
+    fields = [field for _, field, _ in REPOSITORY_COLUMNS]
+    return patients.order_by(
+        'pk', 'specimenmodel__pk', ALIQUOT + 'pk').values_list(
+        *fields).iterator(chunk_size=chunk_size)
+
+
+def repository_export(after=None, batch_size=BATCH_SIZE, chunk_size=CHUNK_SIZE):
+    """
+        Export rows of every patient with an id greater than after, one
+        query per batch of patients
+    """
+    for batch_after, until in patient_batches(after, batch_size):
+        yield from repository_rows(batch_after, until, chunk_size)
+
+
+def manifest_rows(shipment_id, chunk_size=CHUNK_SIZE):
+    """
+        Every slot of every box on a shipment, joined through to the patient
+    """
+    fields = [field for _, field in MANIFEST_COLUMNS]
+    return BoxSlotModel.objects.filter(box__manifest=shipment_id).order_by(
+        'box_id', 'row_position', 'column_position').values_list(
+        *fields).iterator(chunk_size=chunk_size)
+
+
+class Echo(object):
+    """
+        File-like object handing back what is written to it
+        Lets csv.writer produce lines for a streaming response
+    """
+
+    def write(self, value):
+        return value
+
+
+def stream_csv(columns, rows):
+    writer = csv.writer(Echo())
+    yield writer.writerow(columns)
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def stream_ndjson(columns, rows):
+    for row in rows:
+        yield json.dumps(dict(zip(columns, row)), default=str) + '\n'
+
+
+STREAM_FORMATS = {
+    'csv': (stream_csv, 'text/csv', 'csv'),
+    'ndjson': (stream_ndjson, 'application/x-ndjson', 'ndjson'),
+}
+
+
+def arrow_schema(columns, types):
+    import pyarrow
+
+    arrow_types = {
+        'int': pyarrow.int64(),
+        'str': pyarrow.string(),
+        'float': pyarrow.float64(),
+        'date': pyarrow.date32(),
+        'datetime': pyarrow.timestamp('us', tz='UTC'),
+    }
+    return pyarrow.schema([
+        (column, arrow_types[column_type]) for column, column_type in zip(columns, types)])
+
+
+class Buffer(object):
+    """
+        Write only file-like object keeping what is written until take()
+        Lets the parquet writer produce a streaming response
+    """
+
+    def __init__(self):
+        self.parts = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, value):
+        self.parts.append(bytes(value))
+        self.position += len(value)
+        return len(value)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        value = b''.join(self.parts)
+        self.parts = []
+        return value
+
+
+def write_parquet(output, columns, types, rows, chunk_size=CHUNK_SIZE):
+    """
+        Writes rows to output (path or file-like object) as parquet, one
+        row group per chunk_size rows
+        Yields the number of rows of every row group written
+    """
+    import pyarrow
+    import pyarrow.parquet
+
+    schema = arrow_schema(columns, types)
+    with pyarrow.parquet.ParquetWriter(output, schema) as writer:
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                break
+            writer.write_table(pyarrow.Table.from_arrays(
+                [pyarrow.array(list(values), type=field.type)
+                 for values, field in zip(zip(*chunk), schema)],
+                schema=schema))
+            yield len(chunk)
+
+
+def stream_parquet(columns, types, rows, chunk_size=CHUNK_SIZE):
+    buffer = Buffer()
+    for _ in write_parquet(buffer, columns, types, rows, chunk_size):
+        yield buffer.take()
+    # footer
+    yield buffer.take()
+
+
+def parquet_available():
+    try:
+        import pyarrow.parquet  # noqa: F401
+    except ImportError:
+        return False
+    return True
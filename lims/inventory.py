@@ -0,0 +1,133 @@
+from django.db import transaction
+from django.db.models import Count, Sum
+
+from lims.models.inventory import InventoryModel
+from lims.models.patient import PatientModel
+from lims.models.specimen import AliquotModel
+from lims.refresh_queue import RefreshQueue
+from lims.search import storage_path
+
+"""
+    Inventory rollups
+
+    InventoryModel holds the aliquot count and volume of every combination
+    of patient, specimen type, aliquot type, visit and storage location, so
+    "plasma left for patient X at visit 3" or "aliquots per type and visit"
+    is an aggregate over a few summary rows instead of every aliquot.
+
+    Rows are kept per patient: aliquot, specimen, slot, box and storage
+    changes queue the affected patients (lims/signals.py) and their rows are
+    recomputed with one grouped query per batch once the transaction
+    commits, as the draw grid is (lims/draw_grid.py).
+"""
+
+BATCH_SIZE = 500
+
+# InventoryModel fields totals can be grouped by
+DIMENSIONS = ['patient', 'specimen_type', 'aliquot_type', 'visit', 'storage']
+
+
+def refresh_inventory(patient_ids):
+    """
+        Recomputes the inventory rows of the given patients
+        Returns the number of rows written
+    """
+    patient_ids = list(set(patient_ids))
+    if not patient_ids:
+        return 0
+
+    with transaction.atomic():
+        # serializes concurrent refreshes of a patient (see refresh_draw_grid)
+        list(PatientModel.objects.filter(pk__in=patient_ids).select_for_update(
+            of=('self',)).values_list('pk', flat=True))
+        rows = collect_rows(patient_ids)
+        InventoryModel.objects.filter(patient__in=patient_ids).delete()
+        InventoryModel.objects.bulk_create(rows)
+    return len(rows)
+
+
+def collect_rows(patient_ids):
+    """ returns the inventory rows of patients """
+    totals = AliquotModel.objects.filter(
+        specimen__patient__in=patient_ids,
+    ).values(
+        'specimen__patient', 'specimen__type', 'type', 'visit',
+        'boxslotmodel__box__storage_location',
+    ).annotate(
+        aliquot_count=Count('id'),
+        volume_total=Sum('volume'),
+    ).order_by()
+    return [
+        InventoryModel(
+            patient_id=row['specimen__patient'],
+            specimen_type_id=row['specimen__type'],
+            aliquot_type_id=row['type'],
+            visit_id=row['visit'],
+            storage_id=row['boxslotmodel__box__storage_location'],
+            aliquots=row['aliquot_count'],
+            volume=row['volume_total'] or 0)
+        for row in totals
+    ]
+
+
+def rebuild_inventory(batch_size=BATCH_SIZE):
+    """
+        Recomputes the inventory of every patient
+        Returns the number of rows written
+    """
+    patient_ids = list(PatientModel.objects.order_by('pk').values_list('pk', flat=True))
+    total = 0
+    for start in range(0, len(patient_ids), batch_size):
+        total += refresh_inventory(patient_ids[start:start + batch_size])
+    return total
+
+
+_queue = RefreshQueue(refresh_inventory, BATCH_SIZE)
+
+
+def refresh_inventory_on_commit(patient_ids):
+    """
+        Queues patients for an inventory refresh once the current transaction commits
+    """
+    _queue.add(patient_ids)
+
+
+def inventory_totals(group_by, patient=None, specimen_type=None, aliquot_type=None,
+                     visit=None, storage=None, include_contained=True):
+    """
+        Returns dicts of the group_by dimensions (ids) with 'aliquots' and
+        'volume' totals, ordered by the group_by dimensions, a single
+        grand total without group_by
+        storage: only aliquots in this storage object, and in the storage
+        objects it contains unless include_contained is False
+    """
+    unknown = [dimension for dimension in group_by if dimension not in DIMENSIONS]
+    if unknown:
+        raise Exception('Unknown inventory dimensions: {}'.format(unknown))
+
+    rows = InventoryModel.objects.all()
+    filters = {
+        'patient': patient,
+        'specimen_type': specimen_type,
+        'aliquot_type': aliquot_type,
+        'visit': visit,
+    }
+    for field, value in filters.items():
+        if value is not None:
+            rows = rows.filter(**{field: value})
+    if storage is not None:
+        if include_contained:
+            rows = rows.filter(storage__path__startswith=storage_path(storage))
+        else:
+            rows = rows.filter(storage=storage)
+
+    if not group_by:
+        total = rows.aggregate(aliquot_total=Sum('aliquots'), volume_total=Sum('volume'))
+        return [{'aliquots': total['aliquot_total'] or 0, 'volume': total['volume_total'] or 0}]
+    totals = rows.values(*group_by).annotate(
+        aliquot_total=Sum('aliquots'), volume_total=Sum('volume')).order_by(*group_by)
+    return [
+        dict({dimension: row[dimension] for dimension in group_by},
+             aliquots=row['aliquot_total'], volume=row['volume_total'])
+        for row in totals
+    ]
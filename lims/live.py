@@ -0,0 +1,143 @@
+import asyncio
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+
+from lims.database import reading_from_primary
+from lims.models.storage import BoxModel, StorageModel
+from lims.refresh_queue import RefreshQueue
+
+"""
+    Live box and storage updates (LiveConsumer in lims/consumers.py, /live/)
+
+    Instead of polling allSlots and storageUi, a client keeps a websocket
+    open and subscribes to boxes and to the storage tree. Once a
+    transaction changing slots, boxes or storage objects commits, a
+    message is sent to the channel layer group of every changed box
+    (box_group) and, for storage objects and box locations, to
+    STORAGE_GROUP. Each connection then sends its client the slots that
+    differ from the grid it sent last, the grid being built from the
+    primary database rather than read from the box grid cache
+    (lims/cache.py): with a cache per process (LocMemCache), a change
+    only removes the grid cached by the process that made it.
+
+    Messages go through the channel layer of CHANNEL_LAYERS. The in
+    memory layer only reaches the websockets of its own process, the
+    ASGI deployment (brims/asgi.py) serving mutations and websockets; a
+    shared layer (ex) channels_redis) is needed as soon as several
+    processes serve them. Without CHANNEL_LAYERS nothing is sent.
+"""
+
+BATCH_SIZE = 500
+# boxes a connection can subscribe to
+MAX_BOXES = 200
+
+STORAGE_GROUP = 'lims.storage'
+
+# the event loop of the ASGI server, see attach_loop
+_loop = None
+
+
+def box_group(box_id):
+    return 'lims.box.{}'.format(box_id)
+
+
+def attach_loop(loop):
+    """
+        Remembers the event loop running the websockets of this process
+        The in memory layer is not thread safe: messages sent by the
+        threads running django code are handed to this loop
+    """
+    global _loop
+    _loop = loop
+
+
+def publish(group, message):
+    layer = get_channel_layer()
+    if layer is None:
+        return
+    if _loop is not None and _loop.is_running():
+        asyncio.run_coroutine_threadsafe(layer.group_send(group, message), _loop)
+    else:
+        async_to_sync(layer.group_send)(group, message)
+
+
+def publish_boxes(box_ids):
+    for box_id in box_ids:
+        publish(box_group(box_id), {'type': 'box.changed', 'box': box_id})
+
+
+def publish_storage(keys):
+    """
+        Sends the current rows of the changed storage objects and boxes
+        keys: ('storage', id), ('box', id) and ('deleted', storage id, container id)
+        Rows that don't exist anymore are listed as deleted, what a deleted
+        storage object contained is now in its container (see StorageModel)
+    """
+    storage_ids = [key[1] for key in keys if key[0] == 'storage']
+    box_ids = [key[1] for key in keys if key[0] == 'box']
+    deleted_storage = {key[1]: key[2] for key in keys if key[0] == 'deleted'}
+    with reading_from_primary():
+        storage = list(StorageModel.objects.filter(pk__in=storage_ids).values(
+            'id', 'name', 'description', 'container', 'css_icon').order_by('pk'))
+        boxes = list(BoxModel.objects.filter(pk__in=box_ids).values(
+            'id', 'name', 'description', 'storage_location').order_by('pk'))
+    found_storage = {row['id'] for row in storage}
+    found_boxes = {row['id'] for row in boxes}
+    publish(STORAGE_GROUP, {
+        'type': 'storage.changed',
+        'storage': storage,
+        'boxes': boxes,
+        'deleted_storage': [
+            {'id': pk, 'container': deleted_storage.get(pk)}
+            for pk in sorted(set(storage_ids) - found_storage | set(deleted_storage))
+        ],
+        'deleted_boxes': [pk for pk in box_ids if pk not in found_boxes],
+    })
+
+
+_storage_queue = RefreshQueue(publish_storage, BATCH_SIZE)
+
+
+def storage_changed_on_commit(storage_ids=(), box_ids=(), deleted_storage=()):
+    """
+        Queues storage objects and boxes (location, name) for the storage
+        subscribers once the current transaction commits
+        deleted_storage: (id, container id) of deleted storage objects
+    """
+    if get_channel_layer() is None:
+        return
+    _storage_queue.add([('storage', pk) for pk in storage_ids] +
+                       [('box', pk) for pk in box_ids] +
+                       [('deleted', pk, container_id) for pk, container_id in deleted_storage])
+
+
+def grid_slots(grid):
+    """
+        Returns {(row, column): content} of a box grid (lims/schema.py build_box_grid)
+    """
+    return {
+        (row, column): content
+        for row, columns in grid.items() if isinstance(columns, dict)
+        for column, content in columns.items()
+    }
+
+
+def grid_diff(previous, grid):
+    """
+        Returns the update sent for a box grid: the name, description and
+        every slot when previous is None, the slots that changed otherwise
+        (content null for a slot that was emptied)
+    """
+    slots = grid_slots(grid)
+    previous_slots = grid_slots(previous) if previous is not None else {}
+    changed = [
+        {'row': row, 'column': column, 'content': slots.get((row, column))}
+        for row, column in sorted(set(slots) | set(previous_slots))
+        if slots.get((row, column)) != previous_slots.get((row, column))
+    ]
+    update = {'slots': changed}
+    for key in ('name', 'description'):
+        if previous is None or previous.get(key) != grid.get(key):
+            update[key] = grid.get(key)
+    return update
@@ -0,0 +1,65 @@
+from promise import Promise
+from promise.dataloader import DataLoader
+
+from lims.models.patient import PatientModel, SourceModel, VisitModel
+from lims.models.specimen import SpecimenModel, SpecimenType, AliquotType
+from lims.models.storage import StorageModel
+
+"""
+    DataLoaders batch the foreign key lookups done by custom schema fields.
+
+    Every loader collects the primary keys requested while a list is being
+    resolved and fetches them with a single "pk IN (...)" query. Loaded rows
+    are cached by primary key for the rest of the request, so a list query
+    costs one query per related model regardless of the number of rows.
+
+    Loaders are created once per request and stored on the request object
+    (info.context); see get_loaders below.
+"""
+
+
+class ModelLoader(DataLoader):
+    """
+        Loads instances of a model by primary key
+        Missing keys resolve to None rather than raising
+    """
+
+    def __init__(self, model, *args, **kwargs):
+        self.model = model
+        super().__init__(*args, **kwargs)
+
+    def batch_load_fn(self, keys):
+        instances = self.model.objects.in_bulk(keys)
+        return Promise.resolve([instances.get(key) for key in keys])
+
+
+class Loaders(object):
+    """
+        One loader per model referenced by a custom schema field
+    """
+
+    def __init__(self):
+        self.patient = ModelLoader(PatientModel)
+        self.source = ModelLoader(SourceModel)
+        self.visit = ModelLoader(VisitModel)
+        self.specimen = ModelLoader(SpecimenModel)
+        self.specimen_type = ModelLoader(SpecimenType)
+        self.aliquot_type = ModelLoader(AliquotType)
+        self.storage = ModelLoader(StorageModel)
+
+
+def get_loaders(info):
+    """
+        Returns the loaders for the current request, creating them on first use
+        A context-less execution (ex. schema.execute in a shell) gets fresh
+        loaders on every call, which still works but does not batch.
+    """
+    context = info.context
+    if context is None:
+        return Loaders()
+
+    loaders = getattr(context, '_lims_loaders', None)
+    if loaders is None:
+        loaders = Loaders()
+        context._lims_loaders = loaders
+    return loaders
@@ -0,0 +1,145 @@
+import glob
+import json
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from lims.exports import (
+    BATCH_SIZE, CHUNK_SIZE, REPOSITORY_COLUMNS, STREAM_FORMATS, parquet_available,
+    patient_batches, repository_rows, write_parquet)
+
+COLUMNS = [column for column, _, _ in REPOSITORY_COLUMNS]
+TYPES = [column_type for _, _, column_type in REPOSITORY_COLUMNS]
+
+
+class Counter(object):
+    """ passes rows through, counting them """
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.count = 0
+
+    def __iter__(self):
+        for row in self.rows:
+            self.count += 1
+            yield row
+
+
+class FileWriter(object):
+    """
+        csv or ndjson export in one file, cut back to the size it had at
+        the checkpoint when an export resumes
+    """
+
+    def __init__(self, path, export_format, offset):
+        self.stream = STREAM_FORMATS[export_format][0]
+        self.header = export_format == 'csv'
+        self.file = open(path, 'r+b' if offset else 'wb')
+        self.file.seek(offset)
+        self.file.truncate()
+        if self.header and not offset:
+            self.file.write(next(self.stream(COLUMNS, [])).encode())
+
+    def write(self, rows, until):
+        lines = self.stream(COLUMNS, rows)
+        if self.header:
+            # written once, at the start of the file
+            next(lines)
+        for line in lines:
+            self.file.write(line.encode())
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        return self.file.tell()
+
+    def close(self):
+        self.file.close()
+
+
+class PartWriter(object):
+    """
+        parquet export as a directory of files of one batch of patients
+        each, named after the last patient of the batch; a file is
+        renamed into place once complete
+    """
+
+    def __init__(self, directory, chunk_size):
+        self.directory = directory
+        self.chunk_size = chunk_size
+        os.makedirs(directory, exist_ok=True)
+
+    def parts(self):
+        return glob.glob(os.path.join(self.directory, 'patients-*.parquet'))
+
+    def write(self, rows, until):
+        path = os.path.join(self.directory, 'patients-{:010d}.parquet'.format(until))
+        temporary = path + '.tmp'
+        for _ in write_parquet(temporary, COLUMNS, TYPES, rows, self.chunk_size):
+            pass
+        os.replace(temporary, path)
+        return 0
+
+    def close(self):
+        pass
+
+
+class Command(BaseCommand):
+    help = ('Exports every patient, specimen, aliquot, slot and shipment, one row per '
+            'aliquot (see lims/exports.py)')
+
+    def add_arguments(self, parser):
+        parser.add_argument('output',
+                            help='file for csv and ndjson, directory of part files for parquet')
+        parser.add_argument('--format', default='csv',
+                            choices=sorted(STREAM_FORMATS) + ['parquet'])
+        parser.add_argument('--resume', action='store_true',
+                            help='continue an interrupted export from its checkpoint')
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE,
+                            help='patients per query and checkpoint')
+        parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                            help='rows fetched at a time from the server-side cursor')
+
+    def handle(self, *args, **options):
+        output = options['output']
+        export_format = options['format']
+        if export_format == 'parquet' and not parquet_available():
+            raise CommandError('The parquet format requires pyarrow')
+
+        # last patient written, size of the file then and rows written
+        checkpoint_path = output.rstrip('/') + '.checkpoint'
+        checkpoint = {'format': export_format, 'after': None, 'offset': 0, 'rows': 0}
+        if options['resume']:
+            if not os.path.exists(checkpoint_path):
+                raise CommandError('No checkpoint at {}'.format(checkpoint_path))
+            with open(checkpoint_path) as checkpoint_file:
+                checkpoint = json.load(checkpoint_file)
+            if checkpoint.get('format') != export_format:
+                raise CommandError('{} is a {} export, not {}'.format(
+                    output, checkpoint.get('format'), export_format))
+
+        if export_format == 'parquet':
+            writer = PartWriter(output, options['chunk_size'])
+            if not options['resume'] and writer.parts():
+                raise CommandError('{} already holds an export'.format(output))
+        else:
+            writer = FileWriter(output, export_format, checkpoint['offset'])
+
+        try:
+            for after, until in patient_batches(checkpoint['after'], options['batch_size']):
+                rows = Counter(repository_rows(after, until, options['chunk_size']))
+                checkpoint['offset'] = writer.write(rows, until)
+                checkpoint['after'] = until
+                checkpoint['rows'] += rows.count
+                self.save_checkpoint(checkpoint_path, checkpoint)
+        finally:
+            writer.close()
+
+        if os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+        self.stdout.write('Exported {} rows'.format(checkpoint['rows']))
+
+    @staticmethod
+    def save_checkpoint(path, checkpoint):
+        temporary = path + '.tmp'
+        with open(temporary, 'w') as checkpoint_file:
+            json.dump(checkpoint, checkpoint_file)
+        os.replace(temporary, path)
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+
+from lims.synthetic import BATCH_SIZE, generate
+
+
+class Command(BaseCommand):
+    help = 'Fills the database with a synthetic biorepository (see lims/synthetic.py)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--patients', type=int, default=100)
+        parser.add_argument('--specimens', type=int, default=2,
+                            help='specimens per patient')
+        parser.add_argument('--aliquots', type=int, default=3,
+                            help='aliquots per specimen')
+        parser.add_argument('--storage-depth', type=int, default=3,
+                            help='levels of the storage tree')
+        parser.add_argument('--boxes', type=int, default=10)
+        parser.add_argument('--shipments', type=int, default=2)
+        parser.add_argument('--boxes-per-shipment', type=int, default=2)
+        parser.add_argument('--prefix', default='S',
+                            help='pid prefix, use a new one to add to existing data')
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        data = generate(
+            patients=options['patients'],
+            specimens=options['specimens'],
+            aliquots=options['aliquots'],
+            storage_depth=options['storage_depth'],
+            boxes=options['boxes'],
+            shipments=options['shipments'],
+            boxes_per_shipment=options['boxes_per_shipment'],
+            prefix=options['prefix'],
+            batch_size=options['batch_size'])
+        for name, value in data._asdict().items():
+            count = value if isinstance(value, int) else len(value)
+            self.stdout.write('{}: {}'.format(name, count))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from lims.draw_grid import BATCH_SIZE, rebuild_draw_grid
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the draw/event grid of every patient from the draw schedules'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE,
+                            help='patients refreshed per transaction')
+
+    def handle(self, *args, **options):
+        count = rebuild_draw_grid(options['batch_size'])
+        self.stdout.write('Rebuilt {} draw grid cells'.format(count))
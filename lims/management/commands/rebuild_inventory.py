@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from lims.inventory import BATCH_SIZE, rebuild_inventory
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the inventory rollups of every patient from the aliquots'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE,
+                            help='patients refreshed per transaction')
+
+    def handle(self, *args, **options):
+        count = rebuild_inventory(options['batch_size'])
+        self.stdout.write('Rebuilt {} inventory rows'.format(count))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from lims.models.storage import StorageModel
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the materialized hierarchy path of every storage object'
+
+    def handle(self, *args, **options):
+        count = StorageModel.rebuild_paths()
+        self.stdout.write('Rebuilt paths for {} storage objects'.format(count))
@@ -0,0 +1,32 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from lims.persisted_queries import load_registry, query_hash, registry_path
+
+
+class Command(BaseCommand):
+    help = 'Adds query documents (.graphql files) to the persisted query registry'
+
+    def add_arguments(self, parser):
+        parser.add_argument('files', nargs='+', help='.graphql files holding one document each')
+        parser.add_argument('--registry', help='registry file (defaults to GRAPHENE PERSISTED_QUERIES)')
+        parser.add_argument('--replace', action='store_true',
+                            help='drop documents not given on the command line')
+
+    def handle(self, *args, **options):
+        path = options['registry'] or registry_path()
+        if not path:
+            raise CommandError('No registry file, set GRAPHENE PERSISTED_QUERIES or pass --registry')
+
+        registry = {} if options['replace'] else load_registry(path)
+        for filename in options['files']:
+            with open(filename) as query_file:
+                query = query_file.read()
+            sha256_hash = query_hash(query)
+            registry[sha256_hash] = query
+            self.stdout.write('{} {}'.format(sha256_hash, filename))
+
+        with open(path, 'w') as registry_file:
+            json.dump(registry, registry_file, indent=2, sort_keys=True)
+        self.stdout.write('{} documents registered in {}'.format(len(registry), path))
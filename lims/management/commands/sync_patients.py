@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from lims.models.patient import SourceModel
+from lims.sync import BATCH_SIZE, fetch_pid_url, read_pid_file, sync_patients
+
+
+class Command(BaseCommand):
+    help = 'Syncs patients from an external source given a pid file or url'
+
+    def add_arguments(self, parser):
+        parser.add_argument('source', help='name of the SourceModel to sync from')
+        pids = parser.add_mutually_exclusive_group(required=True)
+        pids.add_argument('--file', help='local .json, .csv or text file of pids')
+        pids.add_argument('--url', help='http source returning pids')
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        try:
+            source = SourceModel.objects.get(name=options['source'])
+        except SourceModel.DoesNotExist:
+            raise CommandError('Unknown source "{}"'.format(options['source']))
+
+        if options['file']:
+            pids = read_pid_file(options['file'])
+        else:
+            pids = fetch_pid_url(options['url'])
+
+        try:
+            result = sync_patients(source, pids, batch_size=options['batch_size'])
+        except ValueError as error:
+            raise CommandError(str(error))
+
+        self.stdout.write(
+            'inserted: {0.inserted} synced: {0.synced} '
+            'unchanged: {0.unchanged} skipped: {0.skipped}'.format(result))
@@ -0,0 +1,238 @@
+# Generated by Django 2.2.28 on 2026-10-18 10:37
+
+import django.contrib.auth.models
+import django.contrib.auth.validators
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('auth', '0011_update_proxy_permissions'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AliquotModel',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('collectdate', models.DateTimeField()),
+                ('collecttime', models.TimeField()),
+                ('create_date', models.DateTimeField(auto_now_add=True)),
+                ('modify_date', models.DateTimeField(auto_now=True)),
+                ('volume', models.FloatField()),
+                ('notes', models.CharField(max_length=500, null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='AliquotType',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('type', models.CharField(max_length=50)),
+                ('units', models.CharField(max_length=10)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='BoxModel',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50)),
+                ('description', models.CharField(blank=True, max_length=255, null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='BoxTypeModel',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50)),
+                ('description', models.CharField(max_length=255)),
+                ('length', models.IntegerField(default=2)),
+                ('height', models.IntegerField(default=2)),
+                ('length_label', models.CharField(choices=[('alphabetic', 'A-Z'), ('numeric', 'Numbered')], default='numeric', max_length=8)),
+                ('height_label', models.CharField(choices=[('alphabetic', 'A-Z'), ('numeric', 'Numbered')], default='numeric', max_length=8)),
+                ('length_inverted', models.BooleanField(default=False)),
+                ('height_inverted', models.BooleanField(default=False)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='CarrierModel',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='DestinationModel',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='EventModel',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('event', models.CharField(max_length=120, unique=True)),
+                ('order', models.IntegerField(unique=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='PatientModel',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('pid', models.CharField(max_length=10, unique=True)),
+                ('synced', models.BooleanField(default=False)),
+                ('sync_date', models.DateTimeField(blank=True, null=True)),
+                ('create_date', models.DateTimeField(auto_now_add=True)),
+                ('modify_date', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ScheduleModel',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255)),
+                ('schedule', django.contrib.postgres.fields.jsonb.JSONField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='SourceModel',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=80, unique=True)),
+                ('create_date', models.DateTimeField(auto_now_add=True)),
+                ('modify_date', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='SpecimenType',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('type', models.CharField(max_length=50)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='VisitModel',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('label', models.CharField(max_length=50)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='StorageModel',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50)),
+                ('description', models.CharField(max_length=200)),
+                ('path', models.CharField(blank=True, db_index=True, default='', editable=False, max_length=255)),
+                ('css_icon', models.CharField(blank=True, max_length=50, null=True)),
+                ('container', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.DO_NOTHING, to='lims.StorageModel')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='SpecimenModel',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('collectdate', models.DateField()),
+                ('collecttime', models.TimeField()),
+                ('create_date', models.DateTimeField(auto_now_add=True)),
+                ('modify_date', models.DateTimeField(auto_now=True)),
+                ('notes', models.TextField(blank=True, null=True)),
+                ('patient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='lims.PatientModel')),
+                ('type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='types', to='lims.SpecimenType')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ShipmentModel',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('shipment_number', models.CharField(blank=True, max_length=255, null=True)),
+                ('sent_date', models.DateTimeField(blank=True, null=True)),
+                ('received_date', models.DateTimeField(blank=True, null=True)),
+                ('notes', models.CharField(blank=True, max_length=255, null=True)),
+                ('carrier', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='lims.CarrierModel')),
+                ('destination', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='lims.DestinationModel')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='patientmodel',
+            name='draw_schedule',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='lims.ScheduleModel'),
+        ),
+        migrations.AddField(
+            model_name='patientmodel',
+            name='source',
+            field=models.ForeignKey(default=1, on_delete=django.db.models.deletion.CASCADE, to='lims.SourceModel'),
+        ),
+        migrations.CreateModel(
+            name='BoxSlotModel',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('row_position', models.IntegerField(verbose_name='Row position')),
+                ('column_position', models.IntegerField(verbose_name='Column position')),
+                ('box', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='lims.BoxModel')),
+                ('content', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to='lims.AliquotModel')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='boxmodel',
+            name='box_type',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='lims.BoxTypeModel'),
+        ),
+        migrations.AddField(
+            model_name='boxmodel',
+            name='manifest',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='lims.ShipmentModel'),
+        ),
+        migrations.AddField(
+            model_name='boxmodel',
+            name='storage_location',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.DO_NOTHING, to='lims.StorageModel'),
+        ),
+        migrations.AddField(
+            model_name='aliquotmodel',
+            name='specimen',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='lims.SpecimenModel'),
+        ),
+        migrations.AddField(
+            model_name='aliquotmodel',
+            name='type',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='types', to='lims.AliquotType'),
+        ),
+        migrations.AddField(
+            model_name='aliquotmodel',
+            name='visit',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='lims.VisitModel'),
+        ),
+        migrations.CreateModel(
+            name='CustomUser',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('password', models.CharField(max_length=128, verbose_name='password')),
+                ('last_login', models.DateTimeField(blank=True, null=True, verbose_name='last login')),
+                ('is_superuser', models.BooleanField(default=False, help_text='Designates that this user has all permissions without explicitly assigning them.', verbose_name='superuser status')),
+                ('username', models.CharField(error_messages={'unique': 'A user with that username already exists.'}, help_text='Required. 150 characters or fewer. Letters, digits and @/./+/-/_ only.', max_length=150, unique=True, validators=[django.contrib.auth.validators.UnicodeUsernameValidator()], verbose_name='username')),
+                ('first_name', models.CharField(blank=True, max_length=30, verbose_name='first name')),
+                ('last_name', models.CharField(blank=True, max_length=150, verbose_name='last name')),
+                ('email', models.EmailField(blank=True, max_length=254, verbose_name='email address')),
+                ('is_staff', models.BooleanField(default=False, help_text='Designates whether the user can log into this admin site.', verbose_name='staff status')),
+                ('is_active', models.BooleanField(default=True, help_text='Designates whether this user should be treated as active. Unselect this instead of deleting accounts.', verbose_name='active')),
+                ('date_joined', models.DateTimeField(default=django.utils.timezone.now, verbose_name='date joined')),
+                ('groups', models.ManyToManyField(blank=True, help_text='The groups this user belongs to. A user will get all permissions granted to each of their groups.', related_name='user_set', related_query_name='user', to='auth.Group', verbose_name='groups')),
+                ('user_permissions', models.ManyToManyField(blank=True, help_text='Specific permissions for this user.', related_name='user_set', related_query_name='user', to='auth.Permission', verbose_name='user permissions')),
+            ],
+            options={
+                'verbose_name': 'user',
+                'verbose_name_plural': 'users',
+                'abstract': False,
+            },
+            managers=[
+                ('objects', django.contrib.auth.models.UserManager()),
+            ],
+        ),
+    ]
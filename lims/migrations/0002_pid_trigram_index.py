@@ -0,0 +1,26 @@
+# Generated by Django 2.2.28 on 2026-10-18 10:37
+
+import django.contrib.postgres.indexes
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lims', '0001_initial'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.AddIndex(
+            model_name='patientmodel',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['pid'], name='patient_pid_trgm', opclasses=['gin_trgm_ops']),
+        ),
+        # matches the UPPER(pid::text) LIKE UPPER(...) of istartswith/icontains
+        migrations.RunSQL(
+            'CREATE INDEX patient_pid_upper_trgm ON lims_patientmodel '
+            'USING gin (UPPER(pid::text) gin_trgm_ops);',
+            'DROP INDEX patient_pid_upper_trgm;',
+        ),
+    ]
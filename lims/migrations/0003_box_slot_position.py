@@ -0,0 +1,17 @@
+# Generated by Django 2.2.28 on 2026-10-18 10:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lims', '0002_pid_trigram_index'),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name='boxslotmodel',
+            constraint=models.UniqueConstraint(fields=('box', 'row_position', 'column_position'), name='unique_box_slot_position'),
+        ),
+    ]
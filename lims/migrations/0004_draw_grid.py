@@ -0,0 +1,37 @@
+# Generated by Django 2.2.28 on 2026-10-18 10:42
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+import django.db.models.deletion
+import lims.models.schedule
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lims', '0003_box_slot_position'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='schedulemodel',
+            name='schedule',
+            field=django.contrib.postgres.fields.jsonb.JSONField(validators=[lims.models.schedule.validate_schedule]),
+        ),
+        migrations.CreateModel(
+            name='DrawGridModel',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('expected', models.BooleanField(default=False)),
+                ('specimens', models.IntegerField(default=0)),
+                ('aliquots', models.IntegerField(default=0)),
+                ('event', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='lims.EventModel')),
+                ('patient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='lims.PatientModel')),
+                ('specimen_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='lims.SpecimenType')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='drawgridmodel',
+            constraint=models.UniqueConstraint(fields=('patient', 'event', 'specimen_type'), name='unique_draw_grid_cell'),
+        ),
+    ]
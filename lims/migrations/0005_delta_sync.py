@@ -0,0 +1,39 @@
+# Generated by Django 2.2.28 on 2026-10-18 10:57
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lims', '0004_draw_grid'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TombstoneModel',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model', models.CharField(choices=[('patient', 'patient'), ('specimen', 'specimen'), ('aliquot', 'aliquot')], max_length=20)),
+                ('object_id', models.IntegerField()),
+                ('deleted_date', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='aliquotmodel',
+            index=models.Index(fields=['modify_date', 'id'], name='aliquot_modify_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='patientmodel',
+            index=models.Index(fields=['modify_date', 'id'], name='patient_modify_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='specimenmodel',
+            index=models.Index(fields=['modify_date', 'id'], name='specimen_modify_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='tombstonemodel',
+            index=models.Index(fields=['deleted_date', 'id'], name='tombstone_deleted_idx'),
+        ),
+    ]
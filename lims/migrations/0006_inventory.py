@@ -0,0 +1,27 @@
+# Generated by Django 2.2.28 on 2026-10-18 11:01
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lims', '0005_delta_sync'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InventoryModel',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('aliquots', models.IntegerField(default=0)),
+                ('volume', models.FloatField(default=0)),
+                ('aliquot_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='lims.AliquotType')),
+                ('patient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='lims.PatientModel')),
+                ('specimen_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='lims.SpecimenType')),
+                ('storage', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='lims.StorageModel')),
+                ('visit', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='lims.VisitModel')),
+            ],
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 2.2.28 on 2026-10-18 11:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lims', '0006_inventory'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='aliquotmodel',
+            name='barcode',
+            field=models.CharField(blank=True, max_length=64, null=True, unique=True),
+        ),
+        migrations.AddField(
+            model_name='boxmodel',
+            name='barcode',
+            field=models.CharField(blank=True, max_length=64, null=True, unique=True),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 2.2.28 on 2026-10-18 11:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lims', '0007_barcodes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='aliquotmodel',
+            index=models.Index(fields=['type', 'visit', 'id'], name='aliquot_type_visit_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='aliquotmodel',
+            index=models.Index(fields=['collectdate'], name='aliquot_collect_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='specimenmodel',
+            index=models.Index(fields=['type', 'id'], name='specimen_type_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='specimenmodel',
+            index=models.Index(fields=['collectdate'], name='specimen_collect_idx'),
+        ),
+    ]
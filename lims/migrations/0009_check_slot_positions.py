@@ -0,0 +1,32 @@
+from django.db import migrations
+from django.db.models import F, Q
+
+
+def outside_slots(apps):
+    """ slots outside 1-height rows and 1-length columns of their box type """
+    BoxSlotModel = apps.get_model('lims', 'BoxSlotModel')
+    return BoxSlotModel.objects.filter(
+        Q(row_position__lt=1) | Q(row_position__gt=F('box__box_type__height')) |
+        Q(column_position__lt=1) | Q(column_position__gt=F('box__box_type__length')))
+
+
+def check_slot_positions(apps, schema_editor):
+    # BoxSlotModel.save and the slot allocator (lims/placement.py) count
+    # positions from 1, rows stored another way would be rejected on save
+    # and hidden from placement
+    count = outside_slots(apps).count()
+    if count:
+        raise RuntimeError(
+            '{} box slots are outside their box (positions start at 1), '
+            'renumber them before migrating'.format(count))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lims', '0008_search_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(check_slot_positions, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 14:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lims', '0009_check_slot_positions'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='storagemodel',
+            name='path',
+            field=models.TextField(blank=True, db_index=True, default='', editable=False),
+        ),
+    ]
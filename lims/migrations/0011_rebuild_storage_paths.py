@@ -0,0 +1,21 @@
+# Generated by Django 2.2.28 on 2026-10-18 15:10
+
+from django.db import migrations
+
+from lims.models.storage import rebuild_paths
+
+
+def rebuild_storage_paths(apps, schema_editor):
+    # rows created before paths were maintained still hold the default ''
+    rebuild_paths(apps.get_model('lims', 'StorageModel'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lims', '0010_storage_path_text'),
+    ]
+
+    operations = [
+        migrations.RunPython(rebuild_storage_paths, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 2.2.28 on 2026-10-18 16:05
+
+from django.db import migrations
+
+from lims.models.schedule import schedule_errors
+
+
+def invalid_schedules(apps):
+    """ names of the schedules ScheduleModel.save would reject """
+    ScheduleModel = apps.get_model('lims', 'ScheduleModel')
+    EventModel = apps.get_model('lims', 'EventModel')
+    SpecimenType = apps.get_model('lims', 'SpecimenType')
+    return [
+        schedule.name for schedule in ScheduleModel.objects.order_by('pk')
+        if schedule_errors(schedule.schedule, EventModel, SpecimenType)
+    ]
+
+
+def check_schedules(apps, schema_editor):
+    # ScheduleModel.save validates the {event: [specimen type names]} shape
+    # and that every name exists, older rows that fail it could no longer
+    # be saved
+    names = invalid_schedules(apps)
+    if names:
+        raise RuntimeError(
+            '{} schedules do not map known events to known specimen type '
+            'names ({}), fix them before migrating'.format(
+                len(names), ', '.join(names)))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lims', '0011_rebuild_storage_paths'),
+    ]
+
+    operations = [
+        migrations.RunPython(check_schedules, migrations.RunPython.noop),
+    ]
@@ -6,3 +6,5 @@ from lims.models.shipping import *
 from lims.models.storage import *
 from lims.models.patient import *
 from lims.models.specimen import *
+from lims.models.tombstone import *
+from lims.models.inventory import *
@@ -0,0 +1,22 @@
+from django.db import models
+
+
+class InventoryModel(models.Model):
+    """
+        Aliquot count and volume of one combination of patient, specimen
+        type, aliquot type, visit and storage location (the storage object
+        holding the aliquot's box, null when it is not in a box or the box
+        has no location)
+        Maintained by lims/inventory.py, rebuilt with the rebuild_inventory
+        command
+    """
+    patient = models.ForeignKey('PatientModel', on_delete=models.CASCADE)
+    specimen_type = models.ForeignKey('SpecimenType', on_delete=models.CASCADE)
+    aliquot_type = models.ForeignKey('AliquotType', on_delete=models.CASCADE)
+    visit = models.ForeignKey('VisitModel', null=True, on_delete=models.CASCADE)
+    storage = models.ForeignKey('StorageModel', null=True, on_delete=models.CASCADE)
+    aliquots = models.IntegerField(default=0)
+    volume = models.FloatField(default=0)
+
+    def __str__(self):
+        return '{} {} {}'.format(self.patient_id, self.aliquot_type_id, self.aliquots)
@@ -1,5 +1,6 @@
-from django.db import models
-from datetime import datetime
+from django.contrib.postgres.indexes import GinIndex
+from django.db import IntegrityError, models
+from django.utils import timezone
 from lims.models.schedule import ScheduleModel
 
 class VisitModel(models.Model):
@@ -37,34 +38,40 @@ class PatientModel(models.Model):
     create_date = models.DateTimeField(auto_now_add=True)
     modify_date = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        # trigram index for fuzzy/substring pid search (requires pg_trgm)
+        # a second one on UPPER(pid) for case-insensitive search is created
+        # in migration 0002
+        indexes = [
+            GinIndex(fields=['pid'], name='patient_pid_trgm', opclasses=['gin_trgm_ops']),
+            # delta sync (changesSince) walks rows in (modify_date, id) order
+            models.Index(fields=['modify_date', 'id'], name='patient_modify_idx'),
+        ]
+
     def __str__(self):
         return self.pid
 
     """
     Override default save:
-    When the patient is created via an external system, automatically set the
-    sync_date to the current time as it is automatically reconciled/synced
-
-    Otherwise if patient already exists set sync and exit
+    When the patient is created via an external system, it is reconciled by
+    pid with a single upsert (see lims/sync.py) that is safe when several
+    sync workers run at once:
+    a new pid is inserted with sync_date set to the current time,
+    an existing unsynced patient is marked synced (and this instance
+    becomes that patient),
+    an already synced patient is left as is and IntegrityError is raised,
+    as for a duplicate pid of a local patient
     """
 
     def save(self, *args, **kwargs):
-        # If patient was not created locally, check if patient already exists
-        local_source = SourceModel.objects.get(name="local")
-        if self.source == local_source:
+        if self.pk is not None or self.source.name == 'local':
             super().save(*args, **kwargs)
-        if self.source != local_source:
-            patient_exists = PatientModel.objects.filter(pid=self.pid)
-            if(patient_exists.exists()):
-                if(patient_exists.values("synced")[0]["synced"] is False):
-                    patient_exists.update(
-                        synced=True,
-                        sync_date=datetime.now(),
-                        source=self.source)
-            else:
-                self.synced=True
-                self.sync_date=datetime.now()
-                super().save(*args, **kwargs)
-
-
-
+            return
+
+        from lims.sync import upsert_patients
+        rows = upsert_patients(self.source_id, [self.pid], self.draw_schedule_id)
+        if not rows:
+            raise IntegrityError('Patient {} already exists and is synced'.format(self.pid))
+        self.pk = rows[0][0]
+        self.synced = True
+        self.sync_date = timezone.now()
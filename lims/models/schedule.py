@@ -1,3 +1,4 @@
+from django.core.exceptions import ValidationError
 from django.db import models
 from django.contrib.postgres.fields import JSONField
 
@@ -22,14 +23,91 @@ class EventModel(models.Model):
     def __str__(self):
         return self.event
 
-# eventually https://python-jsonschema.readthedocs.io/en/stable/ should be implemented
-# TODO override create/save function to check against Specimen/Event
+def validate_schedule(schedule):
+    """
+        A schedule maps event names to the specimen type names drawn at
+        that event, ex)
+        {"baseline": ["Blood", "Urine"], "week 1": ["Blood"]}
+        Every event and specimen type must exist
+    """
+    from lims.models.specimen import SpecimenType
+
+    errors = schedule_errors(schedule, EventModel, SpecimenType)
+    if errors:
+        raise ValidationError(errors)
+
+
+def schedule_errors(schedule, event_model, specimen_type_model):
+    """ the messages validate_schedule raises, the models are passed in for migrations """
+    if not isinstance(schedule, dict):
+        return ['A schedule must map event names to lists of specimen types']
+
+    errors = []
+    for event, specimen_types in schedule.items():
+        if not isinstance(specimen_types, list) or not all(
+                isinstance(name, str) for name in specimen_types):
+            errors.append('Event "{}" must list specimen type names'.format(event))
+        elif len(set(specimen_types)) != len(specimen_types):
+            errors.append('Event "{}" lists a specimen type twice'.format(event))
+
+    known_events = set(event_model.objects.filter(
+        event__in=schedule.keys()).values_list('event', flat=True))
+    errors.extend(
+        'Unknown event "{}"'.format(event)
+        for event in schedule if event not in known_events)
+
+    names = {
+        name for specimen_types in schedule.values() if isinstance(specimen_types, list)
+        for name in specimen_types if isinstance(name, str)
+    }
+    known_types = set(specimen_type_model.objects.filter(
+        type__in=names).values_list('type', flat=True))
+    errors.extend(
+        'Unknown specimen type "{}"'.format(name)
+        for name in sorted(names - known_types))
+    return errors
+
 
 class ScheduleModel(models.Model):
     name = models.CharField(max_length=255)
-    schedule = JSONField()
+    schedule = JSONField(validators=[validate_schedule])
 
     def __str__(self):
         return self.name
 
+    # the draw grid is expanded from the schedule, reject anything it can not read
+    def save(self, *args, **kwargs):
+        validate_schedule(self.schedule)
+        super().save(*args, **kwargs)
+
+
+class DrawGridModel(models.Model):
+    """
+        One cell of the draw/event grid: a specimen type of a patient at an event
+        expected: the patient's draw schedule lists the specimen type at the event
+        specimens/aliquots: collected so far, matched by the aliquot visit label
+        A cell that is expected with no aliquots is a missing draw
+
+        Rows are derived data maintained by lims/draw_grid.py, never edit them
+    """
+    patient = models.ForeignKey('PatientModel', on_delete=models.CASCADE)
+    event = models.ForeignKey('EventModel', on_delete=models.CASCADE)
+    specimen_type = models.ForeignKey('SpecimenType', on_delete=models.CASCADE)
+    expected = models.BooleanField(default=False)
+    specimens = models.IntegerField(default=0)
+    aliquots = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['patient', 'event', 'specimen_type'], name='unique_draw_grid_cell'),
+        ]
+
+    @property
+    def missing(self):
+        return self.expected and self.aliquots == 0
+
+    def __str__(self):
+        return '{} {} {}'.format(self.patient_id, self.event_id, self.specimen_type_id)
+
 
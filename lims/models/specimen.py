@@ -1,6 +1,8 @@
+from django.core.exceptions import ValidationError
 from django.db import models
 from lims.models.patient import PatientModel
 from lims.models.shipping import ShipmentModel
+from lims.models.storage import BoxModel
 
 class SpecimenType(models.Model):
     type = models.CharField(max_length=50)
@@ -18,6 +20,15 @@ class SpecimenModel(models.Model):
     modify_date = models.DateTimeField(auto_now=True)
     notes = models.TextField(blank=True, null=True)
 
+    class Meta:
+        # delta sync (changesSince) walks rows in (modify_date, id) order
+        indexes = [
+            models.Index(fields=['modify_date', 'id'], name='specimen_modify_idx'),
+            # searchSpecimens filters, pages are in id order (lims/search.py)
+            models.Index(fields=['type', 'id'], name='specimen_type_idx'),
+            models.Index(fields=['collectdate'], name='specimen_collect_idx'),
+        ]
+
     def __str__(self):
         return("{patient} {type}".format(patient=self.patient.pid, type=self.type))
 
@@ -43,6 +54,23 @@ class AliquotModel(models.Model):
     modify_date = models.DateTimeField(auto_now=True)
     volume = models.FloatField()
     notes = models.CharField(max_length=500, null=True)
+    # label printed on the tube, scanned at the bench (resolveScans)
+    barcode = models.CharField(max_length=64, unique=True, null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['modify_date', 'id'], name='aliquot_modify_idx'),
+            # searchAliquots filters, pages are in id order (lims/search.py)
+            models.Index(fields=['type', 'visit', 'id'], name='aliquot_type_visit_idx'),
+            models.Index(fields=['collectdate'], name='aliquot_collect_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        # a scanned code names one aliquot or one box (resolveScans)
+        self.barcode = (self.barcode or '').strip() or None
+        if self.barcode and BoxModel.objects.filter(barcode=self.barcode).exists():
+            raise ValidationError('Barcode {} is used by a box'.format(self.barcode))
+        super().save(*args, **kwargs)
 
     def __str__(self):
         # Access the name type instead of the primary key value
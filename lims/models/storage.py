@@ -1,5 +1,7 @@
-from django.db import models
-from django.db.models import signals
+from django.core.exceptions import ValidationError
+from django.db import models, transaction
+from django.db.models import DEFERRED, signals, Value
+from django.db.models.functions import Replace
 from django.dispatch import receiver
 from lims.models.shipping import ShipmentModel
 
@@ -9,6 +11,13 @@ class StorageModel(models.Model):
        Storage objects can be contained in other storage objects ex) box, shelf
        Container points to the object a storage instance is contained in.
        A blank container represents a "top" object ex) building
+
+       path is a materialized index of the container hierarchy made of the
+       ids from the top object down to this one ex) /1/4/9/
+       It is maintained by save (create and move) and by the pre_delete
+       handler below, allowing subtree/ancestor lookups in a single query.
+       rebuild_paths (or the rebuild_storage_paths command) recomputes it.
+       Saving an object that was not moved leaves the stored path as is.
     """
     name = models.CharField(max_length=50)
     description = models.CharField(max_length=200)
@@ -19,6 +28,10 @@ class StorageModel(models.Model):
         null=True,
         blank=True,
         on_delete=models.DO_NOTHING)
+    path = models.TextField(blank=True,
+                            default='',
+                            db_index=True,
+                            editable=False)
 
     """
         css_icon should be equivalent to a css icon class to represent
@@ -30,9 +43,98 @@ class StorageModel(models.Model):
     def __str__(self):
         return str(self.name)
 
+    def ancestor_ids(self):
+        """ ids of the containing objects, top object first """
+        return [int(pk) for pk in self.path.strip('/').split('/')[:-1]]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_container_id = instance.__dict__.get('container_id', DEFERRED)
+        return instance
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding and self.container_id == getattr(
+                self, '_loaded_container_id', DEFERRED):
+            # not moved: keep the stored path, more recent than self.path
+            # when a container moved since this instance was read
+            update_fields = kwargs.get('update_fields')
+            if update_fields is None:
+                update_fields = [field.name for field in self._meta.concrete_fields
+                                 if not field.primary_key]
+            kwargs['update_fields'] = [name for name in update_fields if name != 'path']
+            super().save(*args, **kwargs)
+            return
+
+        # a move rewrites the row and its subtree at once; the object and
+        # its new container are locked so a concurrent move of either
+        # can't make their paths stale
+        with transaction.atomic():
+            paths = dict(StorageModel.objects.select_for_update().filter(
+                pk__in=[self.pk, self.container_id]).order_by('pk').values_list('pk', 'path'))
+
+            parent_path = '/'
+            if self.container_id is not None:
+                if self.container_id not in paths:
+                    raise StorageModel.DoesNotExist(
+                        'Storage {} does not exist'.format(self.container_id))
+                parent_path = paths[self.container_id]
+                if self.pk is not None and '/{}/'.format(self.pk) in parent_path:
+                    raise ValidationError(
+                        'A storage object cannot be placed inside itself')
+
+            # use the stored path, the instance may predate a move of a parent
+            old_path = paths.get(self.pk) or ''
+
+            super().save(*args, **kwargs)
+
+            new_path = '{}{}/'.format(parent_path, self.pk)
+            if new_path != old_path:
+                StorageModel.objects.filter(pk=self.pk).update(path=new_path)
+                # moving an object moves everything it contains
+                if old_path:
+                    StorageModel.objects.filter(
+                        path__startswith=old_path).exclude(pk=self.pk).update(
+                        path=Replace('path', Value(old_path), Value(new_path)))
+        self.path = new_path
+        self._loaded_container_id = self.container_id
+
+    @classmethod
+    def rebuild_paths(cls):
+        """
+            Recomputes every path from the container foreign keys
+            Needed once for rows created before paths were maintained
+        """
+        return rebuild_paths(cls)
+
+
+def rebuild_paths(model):
+    """
+        Recomputes the path of every row of model (StorageModel, or its
+        historical version in a migration), returns the number of rows
+    """
+    parents = dict(model.objects.values_list('id', 'container_id'))
+    paths = {}
+
+    def build(pk):
+        if pk not in paths:
+            parent = parents[pk]
+            prefix = build(parent) if parent is not None else '/'
+            paths[pk] = '{}{}/'.format(prefix, pk)
+        return paths[pk]
+
+    storage_objects = list(model.objects.only('id'))
+    for storage in storage_objects:
+        storage.path = build(storage.pk)
+    model.objects.bulk_update(storage_objects, ['path'], batch_size=1000)
+    return len(storage_objects)
+
+
 class BoxSlotModel(models.Model):
     """
         Slot in a box model
+        Positions start at 1, rows up to the box type height and columns up
+        to the box type length. A position holds at most one aliquot.
     """
     row_position = models.IntegerField('Row position')
     column_position = models.IntegerField('Column position')
@@ -41,10 +143,27 @@ class BoxSlotModel(models.Model):
                                    unique=True,
                                    on_delete=models.CASCADE)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['box', 'row_position', 'column_position'],
+                name='unique_box_slot_position'),
+        ]
+
 #    def __str__(self):
 #        return str(self.content.id)
 #
-    # write save method that checks position of box
+    def save(self, *args, **kwargs):
+        # check position against the box dimensions
+        dimensions = BoxTypeModel.objects.values('length', 'height').get(
+            boxmodel=self.box_id)
+        if not 1 <= self.row_position <= dimensions['height']:
+            raise ValidationError('Row {} is outside the box (1-{})'.format(
+                self.row_position, dimensions['height']))
+        if not 1 <= self.column_position <= dimensions['length']:
+            raise ValidationError('Column {} is outside the box (1-{})'.format(
+                self.column_position, dimensions['length']))
+        super().save(*args, **kwargs)
 
 
 class BoxModel(models.Model):
@@ -54,6 +173,8 @@ class BoxModel(models.Model):
 
     name = models.CharField(max_length=50)
     description = models.CharField(max_length=255, blank=True, null=True)
+    # label of the box or rack, scanned at the bench (resolveScans)
+    barcode = models.CharField(max_length=64, unique=True, null=True, blank=True)
     box_type = models.ForeignKey('BoxTypeModel', on_delete=models.CASCADE)
     # DO_NOTHING set to prevent NULL overwrite.
     # on_delete behavior handled by pre_delete below
@@ -65,6 +186,15 @@ class BoxModel(models.Model):
                                  on_delete=models.SET_NULL,
                                  blank=True,
                                  null=True)
+
+    def save(self, *args, **kwargs):
+        # a scanned code names one aliquot or one box (resolveScans)
+        from lims.models.specimen import AliquotModel
+        self.barcode = (self.barcode or '').strip() or None
+        if self.barcode and AliquotModel.objects.filter(barcode=self.barcode).exists():
+            raise ValidationError('Barcode {} is used by an aliquot'.format(self.barcode))
+        super().save(*args, **kwargs)
+
     def __str__(self):
         return str(self.name)
 
@@ -100,4 +230,10 @@ class BoxTypeModel(models.Model):
 @receiver(signals.pre_delete, sender=StorageModel)
 def set_child_storage_to_parent(sender, instance, *args, **kwargs):
     StorageModel.objects.filter(container=instance).update(container=instance.container)
+    # drop the deleted object from the path of everything it contained
+    if instance.path:
+        parent_path = instance.path[:-len('{}/'.format(instance.pk))]
+        StorageModel.objects.filter(path__startswith=instance.path).exclude(
+            pk=instance.pk).update(
+            path=Replace('path', Value(instance.path), Value(parent_path)))
     BoxModel.objects.filter(storage_location=instance).update(storage_location=instance.container)
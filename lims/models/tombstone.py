@@ -0,0 +1,29 @@
+from django.db import models
+from django.utils import timezone
+
+
+class TombstoneModel(models.Model):
+    """
+        Record of a deleted patient, specimen or aliquot, written by the
+        delete signals (lims/signals.py) so delta sync clients
+        (changesSince, see lims/changes.py) learn about deletions
+        model: "patient", "specimen" or "aliquot"
+        object_id: primary key the deleted row had
+    """
+    MODEL_CHOICES = (
+        ('patient', 'patient'),
+        ('specimen', 'specimen'),
+        ('aliquot', 'aliquot'),
+    )
+
+    model = models.CharField(max_length=20, choices=MODEL_CHOICES)
+    object_id = models.IntegerField()
+    deleted_date = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['deleted_date', 'id'], name='tombstone_deleted_idx'),
+        ]
+
+    def __str__(self):
+        return '{} {}'.format(self.model, self.object_id)
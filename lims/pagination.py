@@ -0,0 +1,98 @@
+import base64
+import json
+
+import graphene
+from django.db import connections
+from graphene import relay
+from graphene_django.settings import graphene_settings
+
+"""
+    Keyset (cursor) pagination for list queries
+
+    Pages are ordered newest first by primary key and the cursor holds the
+    last primary key seen, so a page is fetched with "pk < cursor LIMIT n"
+    which costs the same on page 1 and page 10,000 (unlike OFFSET).
+
+    Page size defaults to, and is capped by, RELAY_CONNECTION_MAX_LIMIT in
+    the GRAPHENE settings.
+"""
+
+CURSOR_PREFIX = 'pk:'
+
+
+def encode_cursor(pk):
+    return base64.b64encode('{}{}'.format(CURSOR_PREFIX, pk).encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        value = base64.b64decode(cursor.encode()).decode()
+        if not value.startswith(CURSOR_PREFIX):
+            raise ValueError(cursor)
+        return int(value[len(CURSOR_PREFIX):])
+    except ValueError:
+        raise Exception('Invalid cursor "{}"'.format(cursor))
+
+
+def estimate_count(queryset):
+    """
+        Row count estimated by the postgres planner (EXPLAIN), which does not
+        scan the table; exact count() on other databases
+    """
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return queryset.count()
+
+    sql, params = queryset.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+class CountableConnection(relay.Connection):
+    """
+        Connection with an optional total count of the (unpaged) list
+        estimate: use the planner estimate rather than an exact count(*)
+    """
+    total_count = graphene.Int(estimate=graphene.Boolean(default_value=True))
+
+    class Meta:
+        abstract = True
+
+    def resolve_total_count(self, info, estimate=True):
+        if estimate:
+            return estimate_count(self.queryset)
+        return self.queryset.count()
+
+
+def paginate(connection_type, queryset, first=None, after=None):
+    """
+        Returns one page of queryset as an instance of connection_type
+    """
+    max_limit = graphene_settings.RELAY_CONNECTION_MAX_LIMIT
+    limit = max_limit if first is None else max(0, min(first, max_limit))
+
+    queryset = queryset.order_by('-pk')
+    page = queryset
+    if after is not None:
+        page = page.filter(pk__lt=decode_cursor(after))
+
+    # one extra row tells whether there is a next page
+    rows = list(page[:limit + 1])
+    has_next_page = len(rows) > limit
+    rows = rows[:limit]
+
+    edges = [connection_type.Edge(node=row, cursor=encode_cursor(row.pk))
+             for row in rows]
+    page_info = relay.PageInfo(
+        start_cursor=edges[0].cursor if edges else None,
+        end_cursor=edges[-1].cursor if edges else None,
+        has_previous_page=after is not None,
+        has_next_page=has_next_page)
+
+    connection = connection_type(edges=edges, page_info=page_info)
+    connection.queryset = queryset
+    return connection
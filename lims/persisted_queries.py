@@ -0,0 +1,57 @@
+import hashlib
+import json
+import os
+
+from django.conf import settings
+
+"""
+    Persisted query registry
+
+    The registry is a JSON file mapping the sha256 hash of a query document
+    to the document ({"<sha256>": "query {...}"}), written by the
+    register_persisted_queries command from the frontend's .graphql files.
+    Clients send the hash instead of the query text using the apollo format
+    {"extensions": {"persistedQuery": {"version": 1, "sha256Hash": "<sha256>"}}}
+
+    GRAPHENE settings:
+    PERSISTED_QUERIES: path of the registry file
+    PERSISTED_QUERIES_ONLY: reject query text that is not in the registry
+"""
+
+_registry = None
+
+
+def query_hash(query):
+    return hashlib.sha256(query.encode('utf-8')).hexdigest()
+
+
+def registry_path():
+    return settings.GRAPHENE.get('PERSISTED_QUERIES')
+
+
+def load_registry(path=None):
+    path = path or registry_path()
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path) as registry_file:
+        return json.load(registry_file)
+
+
+def get_registry():
+    """ the registry is read once per process """
+    global _registry
+    if _registry is None:
+        _registry = load_registry()
+    return _registry
+
+
+def get_persisted_query(sha256_hash):
+    return get_registry().get(sha256_hash)
+
+
+def is_registered(query):
+    return query_hash(query) in get_registry()
+
+
+def persisted_only():
+    return settings.GRAPHENE.get('PERSISTED_QUERIES_ONLY', False)
@@ -0,0 +1,130 @@
+from django.db import IntegrityError, connection, transaction
+
+from lims.cache import invalidate_box_grids
+from lims.inventory import refresh_inventory_on_commit
+from lims.models.specimen import AliquotModel
+from lims.models.storage import BoxModel, BoxSlotModel, BoxTypeModel
+
+"""
+    Box slot allocator
+
+    Free positions are found with one query: every position of the
+    candidate boxes (generate_series over the box type height/length) minus
+    the occupied slots (NOT EXISTS anti-join on the unique slot position).
+
+    The query locks the boxes it hands out positions from:
+    placing into a box type uses FOR UPDATE SKIP LOCKED, so concurrent
+    technicians fill different boxes instead of waiting on each other;
+    placing into a given box uses FOR UPDATE and waits for its turn.
+    The unique (box, row, column) constraint backs this up, a placement
+    that still collides is retried with a fresh snapshot. The aliquots
+    are locked before they are checked, so two requests placing the same
+    aliquot are answered in turn.
+"""
+
+ATTEMPTS = 3
+
+FREE_POSITIONS_SQL = """
+    SELECT box.id, slot_row.position, slot_column.position
+    FROM {box} box
+    JOIN {box_type} box_type ON box_type.id = box.box_type_id
+    CROSS JOIN LATERAL generate_series(1, box_type.height) AS slot_row(position)
+    CROSS JOIN LATERAL generate_series(1, box_type.length) AS slot_column(position)
+    WHERE {condition}
+      AND NOT EXISTS (
+          SELECT 1 FROM {slot} slot
+          WHERE slot.box_id = box.id
+            AND slot.row_position = slot_row.position
+            AND slot.column_position = slot_column.position)
+    ORDER BY box.id, slot_row.position, slot_column.position
+    LIMIT %s
+    FOR UPDATE OF box {skip_locked}
+"""
+
+
+class PlacementError(Exception):
+    pass
+
+
+def free_positions(count, box=None, box_type=None):
+    """
+        Returns up to count free (box id, row, column) positions, locking
+        their boxes until the end of the transaction
+    """
+    if box is not None:
+        condition, params, skip_locked = 'box.id = %s', [box], ''
+    else:
+        # boxes already on a shipment are not filled
+        condition = 'box.box_type_id = %s AND box.manifest_id IS NULL'
+        params, skip_locked = [box_type], 'SKIP LOCKED'
+
+    sql = FREE_POSITIONS_SQL.format(
+        box=connection.ops.quote_name(BoxModel._meta.db_table),
+        box_type=connection.ops.quote_name(BoxTypeModel._meta.db_table),
+        slot=connection.ops.quote_name(BoxSlotModel._meta.db_table),
+        condition=condition,
+        skip_locked=skip_locked)
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params + [count])
+        return cursor.fetchall()
+
+
+def check_aliquots(aliquot_ids):
+    """ every aliquot must exist and not be in a box yet """
+    found = dict(AliquotModel.objects.filter(pk__in=aliquot_ids).values_list(
+        'pk', 'boxslotmodel__id'))
+    missing = [pk for pk in aliquot_ids if pk not in found]
+    if missing:
+        raise PlacementError('Aliquots do not exist: {}'.format(missing))
+    placed = [pk for pk in aliquot_ids if found[pk] is not None]
+    if placed:
+        raise PlacementError('Aliquots are already in a box: {}'.format(placed))
+
+
+def place_aliquots(aliquot_ids, box=None, box_type=None):
+    """
+        Places aliquots, in the given order, into the first free positions
+        of a box, or of the unshipped boxes of a box type (spilling over to
+        the next box). Everything is placed or nothing is.
+        Returns the created slots.
+    """
+    if (box is None) == (box_type is None):
+        raise PlacementError('Give either a box or a box type')
+    if len(set(aliquot_ids)) != len(aliquot_ids):
+        raise PlacementError('Aliquots are listed more than once')
+
+    with transaction.atomic():
+        # a concurrent placement of the same aliquots waits here, and the
+        # check then sees its slots
+        list(AliquotModel.objects.select_for_update().filter(
+            pk__in=aliquot_ids).order_by('pk').values_list('pk', flat=True))
+        check_aliquots(aliquot_ids)
+        for attempt in range(ATTEMPTS):
+            positions = free_positions(len(aliquot_ids), box=box, box_type=box_type)
+            if len(positions) < len(aliquot_ids):
+                raise PlacementError('Only {} free positions for {} aliquots'.format(
+                    len(positions), len(aliquot_ids)))
+
+            slots = [
+                BoxSlotModel(box_id=box_id,
+                             row_position=row,
+                             column_position=column,
+                             content_id=aliquot_id)
+                for aliquot_id, (box_id, row, column) in zip(aliquot_ids, positions)
+            ]
+            try:
+                with transaction.atomic():
+                    BoxSlotModel.objects.bulk_create(slots)
+            except IntegrityError:
+                # a concurrent placement took a position first
+                if attempt == ATTEMPTS - 1:
+                    raise PlacementError(
+                        'Positions were taken by other placements {} times, '
+                        'try again'.format(ATTEMPTS))
+                continue
+
+            invalidate_box_grids(slot.box_id for slot in slots)
+            # bulk_create sends no signals
+            refresh_inventory_on_commit(AliquotModel.objects.filter(
+                pk__in=aliquot_ids).values_list('specimen__patient_id', flat=True))
+            return slots
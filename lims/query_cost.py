@@ -0,0 +1,205 @@
+from django.conf import settings
+from graphene_django.settings import graphene_settings
+from graphql.error import GraphQLError
+from graphql.language import ast
+from graphql.type import GraphQLList, GraphQLNonNull
+
+"""
+    Static query depth and cost analysis
+
+    Runs on the parsed query before it is executed (see lims/backend.py).
+    Every field costs its weight plus the cost of its selections, and the
+    selections of a list are paid once per expected row:
+    first: N when the field takes a page size (at most
+    RELAY_CONNECTION_MAX_LIMIT for connections, whose pages are cut to
+    it), DEFAULT_LIST_SIZE for other lists. Leaf (scalar) fields are free
+    unless given a weight.
+
+    Settings live under GRAPHENE['QUERY_COST'], ex)
+    'QUERY_COST': {
+        'MAX_DEPTH': 10,
+        'MAX_COST': 5000,
+        'USER_MAX_COST': {'admin': 50000},
+        'FIELD_COSTS': {'Query.allAliquot': 500},
+    }
+    FIELD_COSTS keys are "Type.fieldName" as written in the schema.
+"""
+
+DEFAULTS = {
+    # deepest allowed field nesting
+    'MAX_DEPTH': 10,
+    # per operation budget
+    'MAX_COST': 5000,
+    # per user budget overrides by username
+    'USER_MAX_COST': {},
+    # weight of a field returning an object
+    'DEFAULT_FIELD_COST': 1,
+    # assumed rows of a list that is not paged with first
+    'DEFAULT_LIST_SIZE': 20,
+    # weights of individual fields
+    'FIELD_COSTS': {
+        # unbounded full table lists
+        'Query.users': 100,
+        'Query.allShipments': 100,
+        'Query.allBoxes': 100,
+        'Query.allPatients': 100,
+        'Query.allSpecimen': 100,
+        'Query.allAliquot': 200,
+        'Query.storageUi': 50,
+        'Query.shipmentManifest': 50,
+        'Query.drawGrid': 100,
+        'Query.changesSince': 100,
+        'Query.inventory': 50,
+    },
+}
+
+
+def get_cost_settings():
+    user_settings = settings.GRAPHENE.get('QUERY_COST', {})
+    cost_settings = dict(DEFAULTS, **user_settings)
+    cost_settings['FIELD_COSTS'] = dict(
+        DEFAULTS['FIELD_COSTS'], **user_settings.get('FIELD_COSTS', {}))
+    return cost_settings
+
+
+def get_max_cost(user, cost_settings):
+    username = getattr(user, 'username', None)
+    return cost_settings['USER_MAX_COST'].get(username, cost_settings['MAX_COST'])
+
+
+def unwrap(graphql_type):
+    """ returns (named type, is list) """
+    is_list = False
+    while isinstance(graphql_type, (GraphQLNonNull, GraphQLList)):
+        if isinstance(graphql_type, GraphQLList):
+            is_list = True
+        graphql_type = graphql_type.of_type
+    return graphql_type, is_list
+
+
+class CostAnalysis(object):
+    """
+        Computes the cost and depth of one operation of a document
+    """
+
+    def __init__(self, schema, document_ast, variables=None, cost_settings=None):
+        self.schema = schema
+        self.variables = variables or {}
+        self.settings = cost_settings or get_cost_settings()
+        self.fragments = {
+            definition.name.value: definition
+            for definition in document_ast.definitions
+            if isinstance(definition, ast.FragmentDefinition)
+        }
+
+    def argument_value(self, field, name):
+        for argument in field.arguments or []:
+            if argument.name.value != name:
+                continue
+            value = argument.value
+            if isinstance(value, ast.Variable):
+                return self.variables.get(value.name.value)
+            if isinstance(value, ast.IntValue):
+                return int(value.value)
+        return None
+
+    def fields(self, parent_type, selection_set):
+        """ yields (field ast, parent type) with fragments expanded """
+        for selection in selection_set.selections:
+            if isinstance(selection, ast.Field):
+                yield selection, parent_type
+            elif isinstance(selection, ast.FragmentSpread):
+                fragment = self.fragments[selection.name.value]
+                fragment_type = self.schema.get_type(fragment.type_condition.name.value)
+                yield from self.fields(fragment_type, fragment.selection_set)
+            elif isinstance(selection, ast.InlineFragment):
+                fragment_type = parent_type
+                if selection.type_condition is not None:
+                    fragment_type = self.schema.get_type(selection.type_condition.name.value)
+                yield from self.fields(fragment_type, selection.selection_set)
+
+    def selection_cost(self, parent_type, selection_set, depth=1):
+        """ returns (cost, depth) of a selection set """
+        total_cost = 0
+        max_depth = depth
+        for field, field_parent in self.fields(parent_type, selection_set):
+            name = field.name.value
+            # introspection (graphiql) is not charged
+            if name.startswith('__'):
+                continue
+            field_def = getattr(field_parent, 'fields', {}).get(name)
+            if field_def is None:
+                continue
+
+            weight_key = '{}.{}'.format(field_parent.name, name)
+            if field.selection_set is None:
+                total_cost += self.settings['FIELD_COSTS'].get(weight_key, 0)
+                continue
+
+            field_type, is_list = unwrap(field_def.type)
+            child_cost, child_depth = self.selection_cost(
+                field_type, field.selection_set, depth + 1)
+            max_depth = max(max_depth, child_depth)
+
+            multiplier = 1
+            if 'first' in field_def.args:
+                first = self.argument_value(field, 'first')
+                max_limit = graphene_settings.RELAY_CONNECTION_MAX_LIMIT
+                if first is None:
+                    multiplier = max_limit
+                elif field_type.name.endswith('Connection'):
+                    # pages are cut to the maximum size (lims/pagination.py)
+                    multiplier = max(0, min(first, max_limit))
+                else:
+                    multiplier = first if first > 0 else max_limit
+            elif is_list and not field_parent.name.endswith('Connection'):
+                # connection edges are already paid for by first
+                multiplier = self.settings['DEFAULT_LIST_SIZE']
+
+            weight = self.settings['FIELD_COSTS'].get(
+                weight_key, self.settings['DEFAULT_FIELD_COST'])
+            total_cost += weight + multiplier * child_cost
+        return total_cost, max_depth
+
+    def operation(self, document_ast, operation_name=None):
+        operations = [
+            definition for definition in document_ast.definitions
+            if isinstance(definition, ast.OperationDefinition)
+        ]
+        for operation in operations:
+            if operation_name is None or (
+                    operation.name is not None and operation.name.value == operation_name):
+                return operation
+        return None
+
+    def analyze(self, document_ast, operation_name=None):
+        operation = self.operation(document_ast, operation_name)
+        if operation is None:
+            return 0, 0
+        root_types = {
+            'query': self.schema.get_query_type(),
+            'mutation': self.schema.get_mutation_type(),
+            'subscription': self.schema.get_subscription_type(),
+        }
+        return self.selection_cost(root_types[operation.operation], operation.selection_set)
+
+
+def check_query_cost(schema, document_ast, variables=None, operation_name=None, user=None):
+    """
+        Returns a list of GraphQLErrors, empty when the operation is allowed
+    """
+    cost_settings = get_cost_settings()
+    analysis = CostAnalysis(schema, document_ast, variables, cost_settings)
+    cost, depth = analysis.analyze(document_ast, operation_name)
+
+    errors = []
+    if depth > cost_settings['MAX_DEPTH']:
+        errors.append(GraphQLError(
+            'Query is nested {} levels deep, the maximum allowed depth is {}'.format(
+                depth, cost_settings['MAX_DEPTH'])))
+    max_cost = get_max_cost(user, cost_settings)
+    if cost > max_cost:
+        errors.append(GraphQLError(
+            'Query cost {} exceeds the maximum allowed cost of {}'.format(
+                cost, max_cost)))
+    return errors
@@ -0,0 +1,63 @@
+import threading
+import weakref
+
+from django.db import transaction
+
+"""
+    Deferred refreshes of derived data: per patient tables (draw grid,
+    inventory), cached box grids and live updates (lims/live.py)
+
+    Model changes queue the ids (patients, boxes ...) they affect and every
+    id queued by a transaction is refreshed once, in batches, when it
+    commits. A mutation touching hundreds of aliquots of a patient
+    refreshes that patient once rather than once per row.
+"""
+
+
+class PendingRefresh(object):
+    """
+        The ids waiting for a refresh when the current transaction commits
+    """
+
+    def __init__(self, queue):
+        self.queue = queue
+        self.ids = set()
+
+    def __call__(self):
+        self.queue.local.pending = None
+        ids = sorted(self.ids)
+        for start in range(0, len(ids), self.queue.batch_size):
+            self.queue.refresh(ids[start:start + self.queue.batch_size])
+
+
+class RefreshQueue(object):
+    """
+        Calls refresh(ids) for the ids queued by a transaction, batch_size
+        ids at a time, once it commits
+
+        The batch of the current transaction is only referenced by its
+        on_commit callback, the queue keeping a weak reference to it: when
+        a rollback (of the transaction or of the savepoint it was
+        registered in) drops the callback, the batch goes with it and the
+        next ids start a new one.
+    """
+
+    def __init__(self, refresh, batch_size):
+        self.refresh = refresh
+        self.batch_size = batch_size
+        self.local = threading.local()
+
+    def add(self, ids):
+        ids = {id for id in ids if id is not None}
+        if not ids:
+            return
+
+        reference = getattr(self.local, 'pending', None)
+        pending = reference() if reference is not None else None
+        if pending is None:
+            pending = PendingRefresh(self)
+            self.local.pending = weakref.ref(pending)
+            pending.ids.update(ids)
+            transaction.on_commit(pending)
+            return
+        pending.ids.update(ids)
@@ -1,3 +1,5 @@
+from collections import defaultdict
+
 import graphene
 import graphql_jwt
 from graphql_jwt.decorators import login_required
@@ -6,6 +8,8 @@ from graphene_django.types import DjangoObjectType
 from graphene_django.filter import DjangoFilterConnectionField
 from django.contrib.auth import get_user_model, logout
 from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
 
 from lims.models.user import *
 from lims.models.schedule import *
@@ -13,6 +17,16 @@ from lims.models.shipping import *
 from lims.models.storage import *
 from lims.models.patient import *
 from lims.models.specimen import *
+from lims.models.tombstone import *
+from lims.cache import get_box_grid, get_reference_data
+from lims.changes import changes_since
+from lims.draw_grid import refresh_draw_grid_on_commit
+from lims.inventory import inventory_totals, refresh_inventory_on_commit
+from lims.loaders import get_loaders
+from lims.pagination import CountableConnection, paginate
+from lims.placement import place_aliquots
+from lims.search import resolve_scans, search_aliquots, search_patients, search_specimens
+from lims.sync import sync_patients
 
 """
     .get is used on dictionary pull from kwargs allowing for a default value
@@ -56,18 +70,6 @@ class StorageUI(graphene.ObjectType):
     top_level = graphene.Boolean()
 
 
-# TODO return list of ids from aliquot mutation
-# https://stackoverflow.com/questions/51762817/get-query-to-return-list-of-values-instead-of-objects-in-graphene-django
-class AliquotIdList(DjangoObjectType):
-    id_list = graphene.List(graphene.Int)
-
-    class Meta:
-        model = AliquotModel
-
-    def resolve_id_list(self, info):
-        return [aliquot.id for aliquot in self.aliquot]
-
-
 class UserType(DjangoObjectType):
     class Meta:
         model = get_user_model()
@@ -79,7 +81,8 @@ class PatientType(DjangoObjectType):
         model = PatientModel
 
     def resolve_source(self, info):
-        return '{}'.format(self.source.name)
+        return get_loaders(info).source.load(self.source_id).then(
+            lambda source: '{}'.format(source.name))
 
 class VisitType(DjangoObjectType):
     class Meta:
@@ -94,6 +97,16 @@ class ScheduleType(DjangoObjectType):
     class Meta:
         model = ScheduleModel
 
+class DrawGridType(DjangoObjectType):
+    """
+        A cell of the draw/event grid (see lims/draw_grid.py)
+        missing: expected by the draw schedule but not collected
+    """
+    missing = graphene.Boolean()
+
+    class Meta:
+        model = DrawGridModel
+
 class SpecimenTypeModelType(DjangoObjectType):
     """
         Ugh I hate the name of this
@@ -130,14 +143,17 @@ class SpecimenModelType(DjangoObjectType):
     # return actual type as string rather then type as an object
     # example: "Dried Blood Spot" instead of type{ type: "Dried Blood Spot"}
     def resolve_type(self, info):
-        return '{}'.format(self.type.type)
+        return get_loaders(info).specimen_type.load(self.type_id).then(
+            lambda specimen_type: '{}'.format(specimen_type.type))
 
     # override type field to return a string rather than an object
     def resolve_patientid(self, info):
-        return '{}'.format(self.patient.pid)
+        return get_loaders(info).patient.load(self.patient_id).then(
+            lambda patient: '{}'.format(patient.pid))
 
+    # the id is already on the row, no lookup needed
     def resolve_patient(self, info):
-        return '{}'.format(self.patient.id)
+        return '{}'.format(self.patient_id)
 
 
 
@@ -150,16 +166,143 @@ class AliquotModelType(DjangoObjectType):
         model = AliquotModel
 
     def resolve_patient(self, info):
-        return '{}'.format(self.specimen.patient)
+        loaders = get_loaders(info)
+        return loaders.specimen.load(self.specimen_id).then(
+            lambda specimen: loaders.patient.load(specimen.patient_id)).then(
+            lambda patient: '{}'.format(patient))
 
     def resolve_specimenid(self, info):
-        return '{}'.format(self.specimen.id)
+        return '{}'.format(self.specimen_id)
 
     def resolve_visit(self, info):
-        return '{}'.format(self.visit.label)
+        # visit is nullable (SET_NULL on visit removal)
+        if self.visit_id is None:
+            return None
+        return get_loaders(info).visit.load(self.visit_id).then(
+            lambda visit: '{}'.format(visit.label))
 
     def resolve_type(self, info):
-        return '{}'.format(self.type.type)
+        return get_loaders(info).aliquot_type.load(self.type_id).then(
+            lambda aliquot_type: '{}'.format(aliquot_type.type))
+
+class TombstoneType(DjangoObjectType):
+    """
+        A deleted patient, specimen or aliquot
+    """
+
+    class Meta:
+        model = TombstoneModel
+
+
+class ChangesType(graphene.ObjectType):
+    """
+        Rows created, updated (patients, specimens, aliquots) and deleted
+        since the previous sync, see lims/changes.py
+        cursor: to pass to the next changesSince call
+        has_more: more changes are waiting, ask again with cursor
+    """
+    patients = graphene.List(PatientType)
+    specimens = graphene.List(SpecimenModelType)
+    aliquots = graphene.List(AliquotModelType)
+    deleted = graphene.List(TombstoneType)
+    cursor = graphene.String()
+    has_more = graphene.Boolean()
+
+
+class ScanType(graphene.ObjectType):
+    """
+        A scanned barcode: an aliquot with its slot and box when it is
+        stored, or a box
+    """
+    barcode = graphene.String()
+    aliquot = graphene.Field(AliquotModelType)
+    slot = graphene.Field(BoxSlotType)
+    box = graphene.Field(BoxModelType)
+
+
+class ScansType(graphene.ObjectType):
+    """
+        Barcodes of a rack resolved at once, see lims/search.py
+        unknown: barcodes matching no aliquot or box
+        duplicates: barcodes scanned more than once
+    """
+    scans = graphene.List(ScanType)
+    unknown = graphene.List(graphene.String)
+    duplicates = graphene.List(graphene.String)
+
+
+class InventoryDimension(graphene.Enum):
+    PATIENT = 'patient'
+    SPECIMEN_TYPE = 'specimen_type'
+    ALIQUOT_TYPE = 'aliquot_type'
+    VISIT = 'visit'
+    STORAGE = 'storage'
+
+
+class InventoryRowType(graphene.ObjectType):
+    """
+        Aliquot count and volume total of one group of an inventory query
+        Dimensions that are not grouped by are null
+    """
+    patient = graphene.Field(PatientType)
+    specimen_type = graphene.Field(SpecimenTypeModelType)
+    aliquot_type = graphene.Field(AliquotTypeModelType)
+    visit = graphene.Field(VisitType)
+    storage = graphene.Field(StorageType)
+    aliquots = graphene.Int()
+    volume = graphene.Float()
+
+    @staticmethod
+    def load(info, loader, key):
+        if key is None:
+            return None
+        return getattr(get_loaders(info), loader).load(key)
+
+    def resolve_patient(self, info):
+        return InventoryRowType.load(info, 'patient', self.get('patient'))
+
+    def resolve_specimen_type(self, info):
+        return InventoryRowType.load(info, 'specimen_type', self.get('specimen_type'))
+
+    def resolve_aliquot_type(self, info):
+        return InventoryRowType.load(info, 'aliquot_type', self.get('aliquot_type'))
+
+    def resolve_visit(self, info):
+        return InventoryRowType.load(info, 'visit', self.get('visit'))
+
+    def resolve_storage(self, info):
+        return InventoryRowType.load(info, 'storage', self.get('storage'))
+
+
+class PatientConnection(CountableConnection):
+    class Meta:
+        node = PatientType
+
+
+class SpecimenConnection(CountableConnection):
+    class Meta:
+        node = SpecimenModelType
+
+
+class AliquotConnection(CountableConnection):
+    class Meta:
+        node = AliquotModelType
+
+
+class BoxConnection(CountableConnection):
+    class Meta:
+        node = BoxModelType
+
+
+class ShipmentConnection(CountableConnection):
+    class Meta:
+        node = ShipmentModelType
+
+
+class UserConnection(CountableConnection):
+    class Meta:
+        node = UserType
+
 
 class ManifestType(graphene.ObjectType):
     """
@@ -226,6 +369,53 @@ class CreateStorageMutation(graphene.Mutation):
         )
 
 
+class PlaceAliquotsMutation(graphene.Mutation):
+    """
+    Places aliquots into the first free slots of a box, or of the unshipped
+    boxes of a box type, in one transaction (see lims/placement.py)
+    box: id of the box to fill
+    box_type: id of the box type whose boxes should be filled
+    aliquot_ids: aliquots in placement order
+    """
+    slots = graphene.List(BoxSlotType)
+
+    class Arguments:
+        aliquot_ids = graphene.List(graphene.Int, required=True)
+        box = graphene.Int()
+        box_type = graphene.Int()
+
+    def mutate(self, info, aliquot_ids, **kwargs):
+        box = kwargs.get('box', None)
+        box_type = kwargs.get('box_type', None)
+        slots = place_aliquots(aliquot_ids, box=box, box_type=box_type)
+        return PlaceAliquotsMutation(slots=slots)
+
+
+class MoveStorageMutation(graphene.Mutation):
+    """
+    Moves a storage object (and everything it contains) into another
+    container, or to the top level when container is not given
+    """
+    id = graphene.Int()
+    container = graphene.Int()
+
+    class Arguments:
+        id = graphene.Int(required=True)
+        container = graphene.Int()
+
+    def mutate(self, info, id, **kwargs):
+        container = kwargs.get('container', None)
+        with transaction.atomic():
+            storage = StorageModel.objects.select_for_update().get(id=id)
+            storage.container_id = container
+            storage.save()
+
+        return MoveStorageMutation(
+            id=storage.id,
+            container=storage.container_id,
+        )
+
+
 class CreateUser(graphene.Mutation):
     user = graphene.Field(UserType)
 
@@ -270,11 +460,121 @@ class CreateEventMutation(graphene.Mutation):
             order=event_input.order,
         )
 
+class AliquotInput(graphene.InputObjectType):
+    """
+    One entry of a createAliquots batch
+    times: number of identical aliquots to create from the entry (default 1)
+    """
+    specimenid = graphene.Int(required=True)
+    aliquottype = graphene.Int(required=True)
+    visit = graphene.Int()
+    collectdate = graphene.types.datetime.Date()
+    collecttime = graphene.types.datetime.Time()
+    volume = graphene.Float()
+    notes = graphene.String()
+    times = graphene.Int()
+    barcode = graphene.String()
+
+
+def entry_times(entry):
+    """ number of aliquots an AliquotInput entry creates, 1 when not given """
+    times = entry.get('times')
+    if times is None:
+        return 1
+    if times < 1:
+        raise Exception('times must be at least 1, got {}'.format(times))
+    return times
+
+
+def entry_barcode(entry):
+    """ barcode of an AliquotInput entry without surrounding spaces, None when blank """
+    return (entry.get('barcode') or '').strip() or None
+
+
+def used_barcodes(barcodes):
+    """ barcodes already labelling an aliquot or a box """
+    return sorted(
+        set(AliquotModel.objects.filter(barcode__in=barcodes).values_list('barcode', flat=True)) |
+        set(BoxModel.objects.filter(barcode__in=barcodes).values_list('barcode', flat=True)))
+
+
+def check_barcodes(entries):
+    """ raises when a barcode of entries is repeated or already used """
+    barcodes = [entry_barcode(entry) for entry in entries if entry_barcode(entry)]
+    for entry in entries:
+        if entry_barcode(entry) and entry_times(entry) > 1:
+            raise Exception('Barcode {} can only label one aliquot'.format(entry_barcode(entry)))
+    repeated = sorted({barcode for barcode in barcodes if barcodes.count(barcode) > 1})
+    if repeated:
+        raise Exception('Barcodes repeated: {}'.format(', '.join(repeated)))
+    used = used_barcodes(barcodes) if barcodes else []
+    if used:
+        raise Exception('Barcodes already used: {}'.format(', '.join(used)))
+
+
+def bulk_create_aliquots(entries):
+    """
+    Creates the aliquots described by entries (dicts of AliquotInput fields)
+    Foreign keys are resolved with one query per model and every aliquot is
+    inserted by a single bulk_create in one transaction.
+    Returns the created aliquots in entry order.
+    """
+    specimens = SpecimenModel.objects.in_bulk(
+        {entry.get('specimenid') for entry in entries})
+    aliquot_types = AliquotType.objects.in_bulk(
+        {entry.get('aliquottype') for entry in entries})
+    visits = VisitModel.objects.in_bulk(
+        {entry.get('visit') for entry in entries} - {None})
+    check_barcodes(entries)
+
+    aliquots = []
+    for entry in entries:
+        specimen = specimens.get(entry.get('specimenid'))
+        if specimen is None:
+            raise Exception('Specimen {} does not exist'.format(entry.get('specimenid')))
+        aliquot_type = aliquot_types.get(entry.get('aliquottype'))
+        if aliquot_type is None:
+            raise Exception('Aliquot type {} does not exist'.format(entry.get('aliquottype')))
+        visit = entry.get('visit', None)
+        if visit is not None and visit not in visits:
+            raise Exception('Visit {} does not exist'.format(visit))
+
+        for _ in range(entry_times(entry)):
+            aliquots.append(AliquotModel(
+                specimen=specimen,
+                type=aliquot_type,
+                visit=visits.get(visit),
+                collectdate=entry.get('collectdate', None),
+                collecttime=entry.get('collecttime', None),
+                volume=entry.get('volume', None),
+                notes=entry.get('notes', None),
+                barcode=entry_barcode(entry)))
+
+    # postgres returns the new primary keys from bulk_create
+    try:
+        with transaction.atomic():
+            AliquotModel.objects.bulk_create(aliquots)
+            # bulk_create sends no signals
+            patient_ids = {specimen.patient_id for specimen in specimens.values()}
+            refresh_draw_grid_on_commit(patient_ids)
+            refresh_inventory_on_commit(patient_ids)
+    except IntegrityError:
+        # a barcode was used by another request since check_barcodes
+        barcodes = [aliquot.barcode for aliquot in aliquots if aliquot.barcode]
+        used = used_barcodes(barcodes) if barcodes else []
+        if not used:
+            raise
+        raise Exception('Barcodes already used: {}'.format(', '.join(used)))
+    return aliquots
+
+
 class CreateAliquotMutation(graphene.Mutation):
     """
     Allows creation of an aliquot from web UI or external source
+    times: number of identical aliquots to create, returned in id_list
     """
     id = graphene.Int()
+    id_list = graphene.List(graphene.Int)
     specimenid = graphene.Int()
     specimen = graphene.String()
     aliquottype = graphene.Int()
@@ -284,6 +584,7 @@ class CreateAliquotMutation(graphene.Mutation):
     volume = graphene.Float()
     notes = graphene.String()
     times = graphene.Int()
+    barcode = graphene.String()
 
     class Arguments:
         specimenid = graphene.Int()
@@ -294,47 +595,239 @@ class CreateAliquotMutation(graphene.Mutation):
         volume = graphene.Float()
         notes = graphene.String()
         times = graphene.Int()
+        barcode = graphene.String()
 
     def mutate(self, info, **kwargs):
-        times = kwargs.get('times', None)
-        specimenid = kwargs.get('specimenid', None)
-        aliquottype = kwargs.get('aliquottype', None)
-        visit = kwargs.get('visit', None)
-        specimen_object = SpecimenModel.objects.get(id=specimenid)
-        aliquot_type_object = AliquotType.objects.get(id=aliquottype)
-        visit_object = VisitModel.objects.get(id=visit)
-        collectdate = kwargs.get('collectdate', None)
-        collecttime = kwargs.get('collecttime', None)
-        volume = kwargs.get('volume', None)
-        notes = kwargs.get('notes', None)
-
-        aliquot_input = AliquotModel(
-            specimen=specimen_object,
-            type=aliquot_type_object,
-            visit=visit_object,
-            collectdate=collectdate,
-            collecttime=collecttime,
-            volume=volume,
-            notes=notes
-        )
-
-        for _ in range(times):
-            # setting pk to None allows creation of multiple objects
-            aliquot_input.pk = None
-            aliquot_input.save()
+        aliquots = bulk_create_aliquots([kwargs])
+        aliquot_input = aliquots[-1]
 
         return CreateAliquotMutation(
             id=aliquot_input.id,
+            id_list=[aliquot.id for aliquot in aliquots],
             specimen=aliquot_input.specimen,
             aliquottype=aliquot_input.type.id,
-            visit=aliquot_input.visit.id,
+            visit=aliquot_input.visit_id,
             collectdate=aliquot_input.collectdate,
             collecttime=aliquot_input.collecttime,
             volume=aliquot_input.volume,
             notes=aliquot_input.notes,
+            times=len(aliquots),
+            barcode=aliquot_input.barcode,
         )
 
 
+class CreateAliquotsMutation(graphene.Mutation):
+    """
+    Creates aliquots of different specimens/types/volumes in one round trip
+    id_list: ids of the created aliquots, in input order
+    """
+    id_list = graphene.List(graphene.Int)
+
+    class Arguments:
+        aliquots = graphene.List(AliquotInput, required=True)
+
+    def mutate(self, info, aliquots):
+        created = bulk_create_aliquots(aliquots)
+        return CreateAliquotsMutation(id_list=[aliquot.id for aliquot in created])
+
+
+
+class SpecimenInput(graphene.InputObjectType):
+    """
+    One entry of a createSpecimens batch
+    """
+    patient = graphene.Int(required=True)
+    specimentype = graphene.Int(required=True)
+    collectdate = graphene.types.datetime.Date(required=True)
+    collecttime = graphene.types.datetime.Time(required=True)
+    notes = graphene.String()
+
+
+class PatientInput(graphene.InputObjectType):
+    """
+    One entry of a createPatients batch
+    source: defaults to the local source
+    """
+    pid = graphene.String(required=True)
+    drawschedule = graphene.Int()
+    source = graphene.Int()
+    synced = graphene.Boolean()
+
+
+class BatchItemResult(graphene.ObjectType):
+    """
+    Outcome of one entry of a batch mutation, in input order
+    id: the created row, null when the batch was rejected
+    errors: what is wrong with the entry
+    """
+    index = graphene.Int()
+    id = graphene.Int()
+    errors = graphene.List(graphene.String)
+
+
+def batch_results(created, errors):
+    return [
+        BatchItemResult(
+            index=index,
+            id=row.pk if row is not None else None,
+            errors=entry_errors)
+        for index, (row, entry_errors) in enumerate(zip(created, errors))
+    ]
+
+
+def bulk_create_specimens(entries):
+    """
+    Creates the specimens described by entries (dicts of SpecimenInput fields)
+    Foreign keys are resolved with one query per model. When every entry is
+    valid the specimens are inserted by a single bulk_create in one
+    transaction, otherwise nothing is inserted.
+    Returns (specimen or None, list of errors) for every entry, in entry order
+    """
+    patients = PatientModel.objects.in_bulk(
+        {entry.get('patient') for entry in entries})
+    specimen_types = SpecimenType.objects.in_bulk(
+        {entry.get('specimentype') for entry in entries})
+
+    specimens = []
+    errors = []
+    for entry in entries:
+        entry_errors = []
+        patient = patients.get(entry.get('patient'))
+        if patient is None:
+            entry_errors.append('Patient {} does not exist'.format(entry.get('patient')))
+        specimen_type = specimen_types.get(entry.get('specimentype'))
+        if specimen_type is None:
+            entry_errors.append(
+                'Specimen type {} does not exist'.format(entry.get('specimentype')))
+        errors.append(entry_errors)
+        specimens.append(SpecimenModel(
+            patient=patient,
+            type=specimen_type,
+            collectdate=entry.get('collectdate'),
+            collecttime=entry.get('collecttime'),
+            notes=entry.get('notes', None)))
+
+    if any(errors):
+        return [None] * len(entries), errors
+
+    with transaction.atomic():
+        SpecimenModel.objects.bulk_create(specimens)
+        # bulk_create sends no signals
+        refresh_draw_grid_on_commit({specimen.patient_id for specimen in specimens})
+    return specimens, errors
+
+
+def bulk_create_patients(entries):
+    """
+    Creates the patients described by entries (dicts of PatientInput fields)
+    pids must be new and unique in the batch. Patients of an external source
+    are created synced, as PatientModel.save does for a new pid.
+    All or nothing, as bulk_create_specimens
+    Returns (patient or None, list of errors) for every entry, in entry order
+    """
+    local_source = SourceModel.objects.get(name='local')
+    sources = SourceModel.objects.in_bulk(
+        {entry.get('source') for entry in entries} - {None})
+    schedules = ScheduleModel.objects.in_bulk(
+        {entry.get('drawschedule') for entry in entries} - {None})
+    pids = [(entry.get('pid') or '').strip() for entry in entries]
+    existing = set(PatientModel.objects.filter(pid__in=pids).values_list('pid', flat=True))
+    max_length = PatientModel._meta.get_field('pid').max_length
+
+    now = timezone.now()
+    seen = set()
+    patients = []
+    errors = []
+    for entry, pid in zip(entries, pids):
+        entry_errors = []
+        if not pid:
+            entry_errors.append('pid is required')
+        elif len(pid) > max_length:
+            entry_errors.append('pid {} is longer than {} characters'.format(pid, max_length))
+        elif pid in existing:
+            entry_errors.append('Patient {} already exists'.format(pid))
+        elif pid in seen:
+            entry_errors.append('pid {} is repeated in the batch'.format(pid))
+        seen.add(pid)
+
+        source = local_source
+        if entry.get('source') is not None:
+            source = sources.get(entry.get('source'))
+            if source is None:
+                entry_errors.append('Source {} does not exist'.format(entry.get('source')))
+        schedule = None
+        if entry.get('drawschedule') is not None:
+            schedule = schedules.get(entry.get('drawschedule'))
+            if schedule is None:
+                entry_errors.append(
+                    'Schedule {} does not exist'.format(entry.get('drawschedule')))
+        errors.append(entry_errors)
+
+        external = source is not None and source.pk != local_source.pk
+        patients.append(PatientModel(
+            pid=pid,
+            draw_schedule=schedule,
+            source=source,
+            synced=True if external else entry.get('synced', False),
+            sync_date=now if external else None))
+
+    if any(errors):
+        return [None] * len(entries), errors
+
+    try:
+        with transaction.atomic():
+            PatientModel.objects.bulk_create(patients)
+            refresh_draw_grid_on_commit(
+                patient.pk for patient in patients if patient.draw_schedule_id is not None)
+    except IntegrityError:
+        # a pid was inserted by another request since existing was read
+        existing = set(PatientModel.objects.filter(pid__in=pids).values_list('pid', flat=True))
+        errors = [['Patient {} already exists'.format(pid)] if pid in existing else []
+                  for pid in pids]
+        if not any(errors):
+            raise
+        return [None] * len(entries), errors
+    return patients, errors
+
+
+class CreateSpecimensMutation(graphene.Mutation):
+    """
+    Creates the specimens of a clinic visit, for any number of patients, in
+    one round trip and one transaction
+    Nothing is created when an entry is invalid, results tell which
+    ok: the specimens were created
+    results: one per entry, in input order
+    """
+    ok = graphene.Boolean()
+    results = graphene.List(BatchItemResult)
+
+    class Arguments:
+        specimens = graphene.List(SpecimenInput, required=True)
+
+    def mutate(self, info, specimens):
+        created, errors = bulk_create_specimens(specimens)
+        return CreateSpecimensMutation(
+            ok=not any(errors), results=batch_results(created, errors))
+
+
+class CreatePatientsMutation(graphene.Mutation):
+    """
+    Creates patients in one round trip and one transaction
+    Nothing is created when an entry is invalid, results tell which
+    ok: the patients were created
+    results: one per entry, in input order
+    """
+    ok = graphene.Boolean()
+    results = graphene.List(BatchItemResult)
+
+    class Arguments:
+        patients = graphene.List(PatientInput, required=True)
+
+    def mutate(self, info, patients):
+        created, errors = bulk_create_patients(patients)
+        return CreatePatientsMutation(
+            ok=not any(errors), results=batch_results(created, errors))
+
 
 class CreateSpecimenMutation(graphene.Mutation):
     """
@@ -377,10 +870,10 @@ class CreateSpecimenMutation(graphene.Mutation):
         collecttime = kwargs.get('collecttime', None)
         notes = kwargs.get('notes', None)
 
+        # volume is accepted but not stored, SpecimenModel has no volume
         specimen_input = SpecimenModel(
             patient=patient_object,
             type=specimen_type_object,
-            volume=volume,
             collectdate=collectdate,
             collecttime=collecttime,
             notes=notes
@@ -390,7 +883,7 @@ class CreateSpecimenMutation(graphene.Mutation):
         return CreateSpecimenMutation(
             id=specimen_input.id,
             specimentype=specimen_input.type,
-            volume=specimen_input.volume,
+            volume=volume,
             collectdate=specimen_input.collectdate,
             collecttime=specimen_input.collecttime,
             notes=specimen_input.notes,
@@ -452,7 +945,14 @@ class CreatePatientMutation(graphene.Mutation):
             draw_schedule=drawinput,
             source=SourceModel.objects.get(id=source),
             synced=synced)
-        patient_input.save()
+        try:
+            with transaction.atomic():
+                patient_input.save()
+        except IntegrityError:
+            # a duplicate pid, or a patient the external source already synced
+            if not PatientModel.objects.filter(pid=pid).exists():
+                raise
+            raise Exception('Patient {} already exists'.format(pid))
 
         return CreatePatientMutation(
             id=patient_input.id,
@@ -463,6 +963,29 @@ class CreatePatientMutation(graphene.Mutation):
         )
 
 
+class SyncPatientsMutation(graphene.Mutation):
+    """
+    Reconciles a batch of pids from an external source with existing patients
+    source: name of the source (SourceModel) the pids come from
+    inserted: new patients created
+    synced: existing local patients marked as synced
+    unchanged: patients that were already synced
+    skipped: blank, duplicate or too long pids
+    """
+    inserted = graphene.Int()
+    synced = graphene.Int()
+    unchanged = graphene.Int()
+    skipped = graphene.Int()
+
+    class Arguments:
+        source = graphene.String(required=True)
+        pids = graphene.List(graphene.String, required=True)
+
+    def mutate(self, info, source, pids):
+        result = sync_patients(source, pids)
+        return SyncPatientsMutation(**result._asdict())
+
+
 class LogoutMutation(graphene.Mutation):
     """
        Calls django-logout from mutation and returns redirect URL
@@ -488,37 +1011,135 @@ class Mutation(graphene.ObjectType):
     # leaving in codebase for example purposes, redirect url moved to query
     #logout = LogoutMutation.Field()
     create_patient = CreatePatientMutation.Field()
+    create_patients = CreatePatientsMutation.Field()
+    sync_patients = SyncPatientsMutation.Field()
     create_specimen = CreateSpecimenMutation.Field()
+    create_specimens = CreateSpecimensMutation.Field()
     create_aliquot = CreateAliquotMutation.Field()
+    create_aliquots = CreateAliquotsMutation.Field()
     create_user = CreateUser.Field()
     create_event = CreateEventMutation.Field()
     create_storage = CreateStorageMutation.Field()
+    move_storage = MoveStorageMutation.Field()
+    place_aliquots = PlaceAliquotsMutation.Field()
     delete_storage = DeleteStorage.Field()
     edit_pid = EditPatientPidMutation.Field()
 
 
+def build_box_grid(box_id):
+    """
+        Builds the slot grid of a box from one joined query
+        Cached per box by resolve_all_slots (see lims/cache.py)
+    """
+    box_json = {}
+    # this can be editable in the future
+    content_entry = "{patient} {aliquot} {aliquot_id}"
+    slots = BoxSlotModel.objects.filter(box=box_id).values(
+        'row_position',
+        'column_position',
+        'content_id',
+        'content__type__type',
+        'content__specimen__patient__pid',
+        'box__name',
+        'box__description')
+
+    if slots:
+        box_json["name"] = slots[0]['box__name']
+        box_json["description"] = slots[0]['box__description']
+    else:
+        box = BoxModel.objects.values('name', 'description').get(id=box_id)
+        box_json["name"] = box['name']
+        box_json["description"] = box['description']
+
+    # builds json object for ingestion by cell table in react
+    # row goes first as JS is stuck with a for loop starting with row
+    for slot in slots:
+        column = {}
+        content = content_entry.format(
+            patient=slot['content__specimen__patient__pid'],
+            aliquot=slot['content__type__type'],
+            aliquot_id=slot['content_id'])
+        column[slot['column_position']] = content
+        if box_json.get(slot['row_position']) is not None:
+            box_json[slot['row_position']].update(column)
+        else:
+            box_json[slot['row_position']] = column
+    return box_json
+
+
 class Query(graphene.ObjectType):
     # name here is what ends up in query
     # (underscores end up camelCase for graphql spec)
     me = graphene.Field(UserType)
-    users = graphene.List(UserType)
+    users = graphene.List(UserType,
+                          deprecation_reason='Use usersConnection')
     redirect_url = graphene.String()
-    search_specimen = graphene.List(PatientType, patient=graphene.String())
-    all_shipments = graphene.List(ShipmentModelType)
+    search_specimen = graphene.List(PatientType, patient=graphene.String(),
+                                    deprecation_reason='Use searchPatients')
+    # ranked prefix/fuzzy pid search, see lims/search.py
+    search_patients = graphene.List(PatientType,
+                                    pid=graphene.String(required=True),
+                                    limit=graphene.Int())
+    all_shipments = graphene.List(ShipmentModelType,
+                                  deprecation_reason='Use allShipmentsConnection')
     shipment_manifest = graphene.List(ManifestType, shipment=graphene.Int())
-    all_boxes = graphene.List(BoxModelType)
+    all_boxes = graphene.List(BoxModelType,
+                              deprecation_reason='Use allBoxesConnection')
     all_specimen_types = graphene.List(SpecimenTypeModelType)
     all_aliquot_types = graphene.List(AliquotTypeModelType)
+    all_carriers = graphene.List(CarrierModelType)
+    all_destinations = graphene.List(DestinationModelType)
     all_slots = graphene.types.json.JSONString(id=graphene.Int())
     all_schedules = graphene.List(ScheduleType)
-    all_patients = graphene.List(PatientType, first=graphene.Int(), skip=graphene.Int())
+    # precomputed draw/event grid, ordered by pid and event order
+    draw_grid = graphene.List(DrawGridType,
+                              schedule=graphene.Int(),
+                              patient=graphene.Int(),
+                              missing=graphene.Boolean())
+    all_patients = graphene.List(PatientType, first=graphene.Int(), skip=graphene.Int(),
+                                 deprecation_reason='Use allPatientsConnection')
     all_events = graphene.List(EventType)
     all_visits = graphene.List(VisitType)
-    all_specimen = graphene.List(SpecimenModelType, patient=graphene.Int())
-    all_aliquot = graphene.List(AliquotModelType, specimen=graphene.Int())
+    all_specimen = graphene.List(SpecimenModelType, patient=graphene.Int(),
+                                 deprecation_reason='Use allSpecimenConnection')
+    all_aliquot = graphene.List(AliquotModelType, specimen=graphene.Int(),
+                                deprecation_reason='Use allAliquotConnection')
+    # cursor paginated versions of the lists above (see lims/pagination.py)
+    users_connection = graphene.Field(
+        UserConnection, first=graphene.Int(), after=graphene.String())
+    all_shipments_connection = graphene.Field(
+        ShipmentConnection, first=graphene.Int(), after=graphene.String())
+    all_boxes_connection = graphene.Field(
+        BoxConnection, first=graphene.Int(), after=graphene.String())
+    all_patients_connection = graphene.Field(
+        PatientConnection, first=graphene.Int(), after=graphene.String())
+    all_specimen_connection = graphene.Field(
+        SpecimenConnection, first=graphene.Int(), after=graphene.String(),
+        patient=graphene.Int())
+    all_aliquot_connection = graphene.Field(
+        AliquotConnection, first=graphene.Int(), after=graphene.String(),
+        specimen=graphene.Int())
+    # multi criteria searches, paged like the connections above (lims/search.py)
+    search_specimens = graphene.Field(
+        SpecimenConnection, first=graphene.Int(), after=graphene.String(),
+        specimen_type=graphene.Int(), patient=graphene.Int(), visit=graphene.Int(),
+        collected_after=graphene.types.datetime.Date(),
+        collected_before=graphene.types.datetime.Date(),
+        storage=graphene.Int(), shipped=graphene.Boolean())
+    search_aliquots = graphene.Field(
+        AliquotConnection, first=graphene.Int(), after=graphene.String(),
+        aliquot_type=graphene.Int(), patient=graphene.Int(), specimen=graphene.Int(),
+        visit=graphene.Int(),
+        collected_after=graphene.types.datetime.Date(),
+        collected_before=graphene.types.datetime.Date(),
+        storage=graphene.Int(), shipped=graphene.Boolean())
     all_storage = graphene.List(StorageType)
     # returns data specifically geared towards UI construction
     storage_ui = graphene.List(StorageUI)
+    # storage object and everything it contains, top down
+    subtree = graphene.List(StorageType, id=graphene.Int(required=True))
+    # containers of a storage object, top level first (breadcrumbs)
+    ancestors = graphene.List(StorageType, id=graphene.Int(required=True))
     # type
     box_type = graphene.Field(BoxType, id=graphene.Int())
     patient = graphene.Field(PatientType,
@@ -526,6 +1147,25 @@ class Query(graphene.ObjectType):
                              pid=graphene.String(),
                              )
     box = graphene.Field(BoxModelType, id=graphene.Int())
+    # aliquots (with slot and box) and boxes of scanned barcodes
+    resolve_scans = graphene.Field(ScansType,
+                                   barcodes=graphene.List(graphene.String, required=True))
+    # aliquot counts and volumes from the inventory rollups (lims/inventory.py)
+    # grouped by any of the dimensions, storage includes contained storage
+    inventory = graphene.List(InventoryRowType,
+                              group_by=graphene.List(InventoryDimension),
+                              patient=graphene.Int(),
+                              specimen_type=graphene.Int(),
+                              aliquot_type=graphene.Int(),
+                              visit=graphene.Int(),
+                              storage=graphene.Int(),
+                              include_contained=graphene.Boolean())
+    # delta sync: changes after timestamp, or after the cursor of the
+    # previous call, limit rows of each list per call
+    changes_since = graphene.Field(ChangesType,
+                                   timestamp=graphene.DateTime(),
+                                   cursor=graphene.String(),
+                                   limit=graphene.Int())
 
     def resolve_me(self, info):
         user = info.context.user
@@ -544,14 +1184,29 @@ class Query(graphene.ObjectType):
         target_shipment = kwargs.get('shipment')
         shipment = ShipmentModel.objects.get(pk=target_shipment)
         boxes = BoxModel.objects.filter(manifest=shipment)
-        all_manifest = []
+        # every aliquot of the shipment in one joined query
+        slots = BoxSlotModel.objects.filter(box__manifest=shipment).select_related(
+            'content__specimen__patient',
+            'content__type',
+            'content__visit').order_by('row_position', 'column_position')
+
+        # hand the joined rows to the loaders used by AliquotModelType
+        loaders = get_loaders(info)
+        aliquot_by_box = defaultdict(list)
+        for slot in slots:
+            aliquot = slot.content
+            loaders.specimen.prime(aliquot.specimen_id, aliquot.specimen)
+            loaders.patient.prime(aliquot.specimen.patient_id, aliquot.specimen.patient)
+            loaders.aliquot_type.prime(aliquot.type_id, aliquot.type)
+            if aliquot.visit_id is not None:
+                loaders.visit.prime(aliquot.visit_id, aliquot.visit)
+            aliquot_by_box[slot.box_id].append(aliquot)
 
+        all_manifest = []
         for box in boxes:
-            slots = BoxSlotModel.objects.filter(box=box.id)
-            aliquot_list = []
-            for slot in slots:
-                aliquot_list.append(slot.content)
-            all_manifest.append(ManifestType(key=box.id, name=box.name, aliquot=aliquot_list))
+            all_manifest.append(ManifestType(key=box.id,
+                                             name=box.name,
+                                             aliquot=aliquot_by_box[box.id]))
         return all_manifest
 
     def resolve_storage_ui(self, info):
@@ -581,38 +1236,55 @@ class Query(graphene.ObjectType):
         """
         storage_return = []
 
-        all_storage_objects = StorageModel.objects.all()
+        # two queries for the whole tree, children and boxes grouped in memory
+        all_storage_objects = StorageModel.objects.all().order_by('path')
+        children = defaultdict(list)
+        for location in all_storage_objects:
+            children[location.container_id].append(location)
+        boxes = defaultdict(list)
+        for box in BoxModel.objects.filter(storage_location__isnull=False):
+            boxes[box.storage_location_id].append(box)
+
         for location in all_storage_objects:
-            content = StorageModel.objects.filter(container=location.id)
-            boxes_at_location = BoxModel.objects.filter(storage_location=location.id)
-            if location.container is None:
+            if location.container_id is None:
                 top_level = True
             else:
                 top_level = False
             append_storage = StorageUI(key=("panel-" + location.name),
                                        title=location.name,
-                                       content=content,
-                                       boxes=boxes_at_location,
+                                       content=children[location.id],
+                                       boxes=boxes[location.id],
                                        css_icon=location.css_icon,
                                        top_level=top_level)
             storage_return.append(append_storage)
 
+        return storage_return
 
+    def resolve_subtree(self, info, id):
+        path = StorageModel.objects.values_list('path', flat=True).get(id=id)
+        return StorageModel.objects.filter(
+            path__startswith=path).order_by('path')
 
-        return storage_return
+    def resolve_ancestors(self, info, id):
+        storage = StorageModel.objects.get(id=id)
+        return StorageModel.objects.filter(
+            id__in=storage.ancestor_ids()).order_by('path')
 
     def resolve_storage_json(self, info):
         return None
 
     def resolve_search_specimen(self, info, **kwargs):
-        """ for testing, to be deprecated for resolve_patient """
+        """ deprecated, the ranked pid search of searchPatients """
         patient = kwargs.get('patient')
 
         if patient is not None:
-            return PatientModel.objects.filter(pid__contains=patient)
+            return search_patients(patient)
 
         return None
 
+    def resolve_search_patients(self, info, pid, limit=None):
+        return search_patients(pid, limit)
+
     def resolve_users(self, info):
         return get_user_model().objects.all()
 
@@ -620,57 +1292,81 @@ class Query(graphene.ObjectType):
         return StorageModel.objects.all()
 
     def resolve_all_specimen_types(self, info, **kwargs):
-        return SpecimenType.objects.all()
+        return get_reference_data(SpecimenType)
 
     def resolve_all_visits(self, info):
-        return VisitModel.objects.all()
+        return get_reference_data(VisitModel)
 
     # will need to adjust model/object to make specimen type parent
     def resolve_all_aliquot_types(self, info, **kwargs):
-        return AliquotType.objects.all()
+        return get_reference_data(AliquotType)
+
+    def resolve_all_carriers(self, info):
+        return get_reference_data(CarrierModel)
+
+    def resolve_all_destinations(self, info):
+        return get_reference_data(DestinationModel)
 
     def resolve_all_boxes(self, info, **kwargs):
         return BoxModel.objects.all()
 
     def resolve_all_events(self, info, **kwargs):
-        return EventModel.objects.all()
+        return get_reference_data(EventModel)
 
     def resolve_box_type(self, info, **kwargs):
         id = kwargs.get('id')
         if id is not None:
-            box = BoxModel.objects.get(id=id)
-            return (box.box_type)
+            box_type_id = BoxModel.objects.values_list('box_type_id', flat=True).get(id=id)
+            box_types = {box_type.pk: box_type for box_type in get_reference_data(BoxTypeModel)}
+            return box_types.get(box_type_id)
 
     def resolve_all_schedules(self, info, **kwargs):
-        return ScheduleModel.objects.all()
+        return get_reference_data(ScheduleModel)
+
+    def resolve_draw_grid(self, info, **kwargs):
+        grid = DrawGridModel.objects.select_related(
+            'patient', 'event', 'specimen_type').order_by(
+            'patient__pid', 'event__order', 'specimen_type__type')
+        schedule = kwargs.get('schedule')
+        if schedule is not None:
+            grid = grid.filter(patient__draw_schedule=schedule)
+        patient = kwargs.get('patient')
+        if patient is not None:
+            grid = grid.filter(patient=patient)
+        missing = kwargs.get('missing')
+        if missing is True:
+            grid = grid.filter(expected=True, aliquots=0)
+        elif missing is False:
+            grid = grid.exclude(expected=True, aliquots=0)
+        return grid
+
+    def resolve_resolve_scans(self, info, barcodes):
+        return resolve_scans(barcodes)
+
+    def resolve_inventory(self, info, group_by=None, include_contained=True, **kwargs):
+        return inventory_totals(
+            group_by or [],
+            patient=kwargs.get('patient'),
+            specimen_type=kwargs.get('specimen_type'),
+            aliquot_type=kwargs.get('aliquot_type'),
+            visit=kwargs.get('visit'),
+            storage=kwargs.get('storage'),
+            include_contained=include_contained)
+
+    def resolve_changes_since(self, info, **kwargs):
+        return changes_since(
+            timestamp=kwargs.get('timestamp'),
+            cursor=kwargs.get('cursor'),
+            limit=kwargs.get('limit'))
 
     def resolve_all_slots(self, info, **kwargs):
-        box_json = {}
         id = kwargs.get('id')
-        box = BoxModel.objects.get(id=id)
-        # this can be editable in the future
-        content_entry = "{patient} {aliquot} {aliquot_id}"
-        box_json["name"] = box.name
-        box_json["description"] = box.description
-        # builds json object for ingestion by cell table in react
-        # row goes first as JS is stuck with a for loop starting with row
-        for slot in box.boxslotmodel_set.all():
-            column = {}
-            content = content_entry.format(
-                patient=slot.content.specimen.patient,
-                aliquot=slot.content,
-                aliquot_id=slot.content.pk)
-            column[slot.column_position] = content
-            if box_json.get(slot.row_position) is not None:
-                box_json[slot.row_position].update(column)
-            else:
-                box_json[slot.row_position] = column
-        return box_json
+        return get_box_grid(id, build_box_grid)
 
     def resolve_box(self, info, **kwargs):
         id = kwargs.get('id')
         if id is not None:
-            return BoxSlotModel.objects.all()
+            return BoxModel.objects.get(id=id)
 
     def resolve_all_patients(self, info, first=None, skip=None, **kwargs):
         patient_data = PatientModel.objects.all().order_by('-pk')
@@ -695,6 +1391,38 @@ class Query(graphene.ObjectType):
             return AliquotModel.objects.all().filter(specimen=specimen)
         return AliquotModel.objects.all()
 
+    def resolve_users_connection(self, info, first=None, after=None):
+        return paginate(UserConnection, get_user_model().objects.all(), first, after)
+
+    def resolve_all_shipments_connection(self, info, first=None, after=None):
+        return paginate(ShipmentConnection, ShipmentModel.objects.all(), first, after)
+
+    def resolve_all_boxes_connection(self, info, first=None, after=None):
+        return paginate(BoxConnection, BoxModel.objects.all(), first, after)
+
+    def resolve_all_patients_connection(self, info, first=None, after=None):
+        return paginate(PatientConnection, PatientModel.objects.all(), first, after)
+
+    def resolve_all_specimen_connection(self, info, first=None, after=None, **kwargs):
+        specimen = SpecimenModel.objects.all()
+        patient = kwargs.get('patient')
+        if patient is not None:
+            specimen = specimen.filter(patient=patient)
+        return paginate(SpecimenConnection, specimen, first, after)
+
+    def resolve_all_aliquot_connection(self, info, first=None, after=None, **kwargs):
+        aliquot = AliquotModel.objects.all()
+        specimen = kwargs.get('specimen')
+        if specimen is not None:
+            aliquot = aliquot.filter(specimen=specimen)
+        return paginate(AliquotConnection, aliquot, first, after)
+
+    def resolve_search_specimens(self, info, first=None, after=None, **kwargs):
+        return paginate(SpecimenConnection, search_specimens(**kwargs), first, after)
+
+    def resolve_search_aliquots(self, info, first=None, after=None, **kwargs):
+        return paginate(AliquotConnection, search_aliquots(**kwargs), first, after)
+
     def resolve_patient(self, info, **kwargs):
         id = kwargs.get('id')
         pid = kwargs.get('pid')
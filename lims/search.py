@@ -0,0 +1,181 @@
+import datetime
+from collections import Counter, namedtuple
+
+from django.contrib.postgres.search import TrigramSimilarity
+from django.db.models import Case, IntegerField, Q, Value, When
+from django.utils import timezone
+
+from lims.models.patient import PatientModel
+from lims.models.specimen import AliquotModel, SpecimenModel
+from lims.models.storage import BoxModel, BoxSlotModel, StorageModel
+
+"""
+    Index backed searches
+
+    PID search relies on the pg_trgm GIN indexes of migration 0002:
+    prefix matches (UPPER(pid) LIKE 'X%') use patient_pid_upper_trgm and
+    typo tolerant matches (pid % 'x', trigram similarity) use
+    patient_pid_trgm, so neither scans the patient table.
+
+    Barcode scans are looked up in the unique barcode indexes of aliquots
+    and boxes, a rack of tubes in one query.
+
+    Specimen and aliquot searches (searchSpecimens, searchAliquots) are
+    paged newest first by pk (lims/pagination.py). The (type, visit, id)
+    and (type, id) indexes of migration 0008 answer the type and visit
+    filters already in that order, collect date ranges use the collectdate
+    indexes and patient filters the patient and specimen foreign key
+    indexes (a patient has few specimens). A storage object is found by
+    the path index, its aliquots through the box and slot foreign keys.
+    Criteria about aliquots (visit, storage, shipped) select the specimens
+    having such an aliquot with an IN subquery, which the planner runs
+    as a join driven by the aliquots (a filter on an Exists annotation
+    is compared to true by Django 2.2 and checked row by row).
+"""
+
+SEARCH_LIMIT = 10
+MAX_SEARCH_LIMIT = 50
+# barcodes resolved at once, four 96 tube racks
+MAX_SCANS = 384
+
+Scan = namedtuple('Scan', 'barcode aliquot slot box')
+Scans = namedtuple('Scans', 'scans unknown duplicates')
+
+
+def search_patients(term, limit=None):
+    """
+        Patients whose pid starts with term, followed by those with a
+        similar pid, best match first
+        limit: kept between 1 and MAX_SEARCH_LIMIT, SEARCH_LIMIT when not given
+    """
+    term = (term or '').strip()
+    if not term:
+        return PatientModel.objects.none()
+    limit = SEARCH_LIMIT if limit is None else max(1, min(limit, MAX_SEARCH_LIMIT))
+
+    return PatientModel.objects.filter(
+        Q(pid__istartswith=term) | Q(pid__trigram_similar=term)
+    ).annotate(
+        prefix=Case(
+            When(pid__istartswith=term, then=Value(1)),
+            default=Value(0),
+            output_field=IntegerField()),
+        similarity=TrigramSimilarity('pid', term),
+    ).order_by('-prefix', '-similarity', 'pid')[:limit]
+
+
+def resolve_scans(barcodes):
+    """
+        Returns the Scans of barcodes read at the bench: a Scan per known
+        barcode in scan order, with the aliquot, its slot and box or the box,
+        the barcodes matching nothing (unknown) and those scanned more than
+        once (duplicates)
+    """
+    barcodes = [barcode.strip() for barcode in barcodes if barcode and barcode.strip()]
+    if len(barcodes) > MAX_SCANS:
+        raise Exception('At most {} barcodes can be resolved at once'.format(MAX_SCANS))
+    counts = Counter(barcodes)
+    barcodes = list(dict.fromkeys(barcodes))
+
+    aliquots = {
+        aliquot.barcode: aliquot
+        for aliquot in AliquotModel.objects.filter(
+            barcode__in=barcodes).select_related('boxslotmodel__box')
+    }
+    # box labels are only looked up when something else than tubes was scanned
+    remaining = [barcode for barcode in barcodes if barcode not in aliquots]
+    boxes = {}
+    if remaining:
+        boxes = {box.barcode: box for box in BoxModel.objects.filter(barcode__in=remaining)}
+
+    scans = []
+    unknown = []
+    for barcode in barcodes:
+        aliquot = aliquots.get(barcode)
+        if aliquot is not None:
+            try:
+                slot = aliquot.boxslotmodel
+            except BoxSlotModel.DoesNotExist:
+                slot = None
+            scans.append(Scan(barcode=barcode, aliquot=aliquot, slot=slot,
+                              box=slot.box if slot is not None else None))
+        elif barcode in boxes:
+            scans.append(Scan(barcode=barcode, aliquot=None, slot=None, box=boxes[barcode]))
+        else:
+            unknown.append(barcode)
+    duplicates = [barcode for barcode in barcodes if counts[barcode] > 1]
+    return Scans(scans=scans, unknown=unknown, duplicates=duplicates)
+
+
+def storage_path(storage):
+    path = StorageModel.objects.filter(pk=storage).values_list('path', flat=True).first()
+    if path is None:
+        raise Exception('Storage {} does not exist'.format(storage))
+    return path
+
+
+def aliquot_criteria(visit=None, storage=None, shipped=None):
+    """
+        Q of the aliquots having a visit, stored in a storage object (or
+        the objects it contains), in a shipped (True) or unshipped (False) box
+    """
+    criteria = Q()
+    if visit is not None:
+        criteria &= Q(visit=visit)
+    if storage is not None:
+        criteria &= Q(boxslotmodel__box__storage_location__path__startswith=storage_path(storage))
+    if shipped is not None:
+        criteria &= Q(boxslotmodel__box__manifest__isnull=not shipped)
+    return criteria
+
+
+def search_aliquots(aliquot_type=None, patient=None, specimen=None, visit=None,
+                    collected_after=None, collected_before=None, storage=None, shipped=None):
+    """
+        Aliquots matching every given criterion
+        collected_after, collected_before: dates, both included
+    """
+    aliquots = AliquotModel.objects.filter(aliquot_criteria(visit, storage, shipped))
+    if aliquot_type is not None:
+        aliquots = aliquots.filter(type=aliquot_type)
+    if patient is not None:
+        aliquots = aliquots.filter(specimen__patient=patient)
+    if specimen is not None:
+        aliquots = aliquots.filter(specimen=specimen)
+    # collectdate is a timestamp, compared with the bounds of the days
+    # rather than truncated so its index is used
+    if collected_after is not None:
+        aliquots = aliquots.filter(collectdate__gte=timezone.make_aware(
+            datetime.datetime.combine(collected_after, datetime.time.min)))
+    if collected_before is not None:
+        aliquots = aliquots.filter(collectdate__lt=timezone.make_aware(
+            datetime.datetime.combine(collected_before + datetime.timedelta(days=1),
+                                      datetime.time.min)))
+    return aliquots
+
+
+def search_specimens(specimen_type=None, patient=None, visit=None,
+                     collected_after=None, collected_before=None, storage=None, shipped=None):
+    """
+        Specimens matching every given criterion
+        visit, storage, shipped: the specimen has such an aliquot, or has
+        no aliquot in a shipped box for shipped False
+        collected_after, collected_before: dates, both included
+    """
+    specimens = SpecimenModel.objects.all()
+    if specimen_type is not None:
+        specimens = specimens.filter(type=specimen_type)
+    if patient is not None:
+        specimens = specimens.filter(patient=patient)
+    if collected_after is not None:
+        specimens = specimens.filter(collectdate__gte=collected_after)
+    if collected_before is not None:
+        specimens = specimens.filter(collectdate__lte=collected_before)
+
+    if visit is not None or storage is not None or shipped:
+        specimens = specimens.filter(pk__in=AliquotModel.objects.filter(
+            aliquot_criteria(visit, storage, shipped or None)).values('specimen'))
+    if shipped is False:
+        specimens = specimens.exclude(pk__in=AliquotModel.objects.filter(
+            aliquot_criteria(shipped=True)).values('specimen'))
+    return specimens
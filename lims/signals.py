@@ -0,0 +1,264 @@
+from django.contrib.auth import get_user_model
+from django.contrib.auth.signals import user_logged_out
+from django.core.signals import request_started
+from django.db.models import signals
+from django.dispatch import receiver
+
+from lims.auth import invalidate_user
+from lims.cache import invalidate_box_grids, invalidate_reference_data
+from lims.changes import TOMBSTONE_MODELS, record_deletion
+from lims.database import check_connections
+from lims.draw_grid import refresh_draw_grid_on_commit, schedules_naming
+from lims.inventory import refresh_inventory_on_commit
+from lims.live import storage_changed_on_commit
+from lims.models.inventory import InventoryModel
+from lims.models.patient import PatientModel, VisitModel
+from lims.models.schedule import EventModel, ScheduleModel
+from lims.models.shipping import CarrierModel, DestinationModel
+from lims.models.specimen import AliquotModel, AliquotType, SpecimenModel, SpecimenType
+from lims.models.storage import BoxModel, BoxSlotModel, BoxTypeModel, StorageModel
+
+"""
+    Signal handlers keeping cached and derived data in sync with the models
+    Connected when the app is ready (see LimsConfig.ready)
+"""
+
+
+# remember where a slot was so moving it refreshes both boxes
+# (and the inventory of the aliquot it held)
+@receiver(signals.pre_save, sender=BoxSlotModel)
+def remember_slot_box(sender, instance, raw=False, **kwargs):
+    instance._previous_box_id = None
+    instance._previous_content_id = None
+    if instance.pk is not None and not raw:
+        instance._previous_box_id, instance._previous_content_id = BoxSlotModel.objects.filter(
+            pk=instance.pk).values_list('box_id', 'content_id').first() or (None, None)
+
+
+@receiver(signals.post_save, sender=BoxSlotModel)
+@receiver(signals.post_delete, sender=BoxSlotModel)
+def slot_changed(sender, instance, **kwargs):
+    invalidate_box_grids(
+        [instance.box_id, getattr(instance, '_previous_box_id', None)])
+
+
+@receiver(signals.post_save, sender=BoxModel)
+@receiver(signals.post_delete, sender=BoxModel)
+def box_changed(sender, instance, **kwargs):
+    invalidate_box_grids([instance.pk])
+
+
+@receiver(signals.post_save, sender=AliquotModel)
+@receiver(signals.post_delete, sender=AliquotModel)
+def aliquot_changed(sender, instance, **kwargs):
+    invalidate_box_grids(BoxSlotModel.objects.filter(
+        content=instance.pk).values_list('box_id', flat=True))
+
+
+# slot labels are made of the pid and aliquot type (see build_box_grid):
+# a pid edit (editPid), an aliquot type rename or a specimen moved to
+# another patient changes the label of every slot holding their aliquots
+@receiver(signals.pre_save, sender=PatientModel)
+@receiver(signals.pre_save, sender=AliquotType)
+def remember_slot_label(sender, instance, raw=False, **kwargs):
+    instance._previous_label = None
+    if instance.pk is not None and not raw:
+        instance._previous_label = sender.objects.filter(pk=instance.pk).values_list(
+            'pid' if sender is PatientModel else 'type', flat=True).first()
+
+
+@receiver(signals.post_save, sender=PatientModel)
+@receiver(signals.post_save, sender=AliquotType)
+def slot_label_changed(sender, instance, created=False, **kwargs):
+    label = instance.pid if sender is PatientModel else instance.type
+    if created or getattr(instance, '_previous_label', None) == label:
+        return
+    content = 'content__specimen__patient' if sender is PatientModel else 'content__type'
+    invalidate_box_grids(BoxSlotModel.objects.filter(
+        **{content: instance.pk}).values_list('box_id', flat=True))
+
+
+# previous patient remembered by remember_specimen_patient below
+@receiver(signals.post_save, sender=SpecimenModel)
+def specimen_moved(sender, instance, created=False, **kwargs):
+    previous = getattr(instance, '_previous_patient_id', None)
+    if not created and previous is not None and previous != instance.patient_id:
+        invalidate_box_grids(BoxSlotModel.objects.filter(
+            content__specimen=instance.pk).values_list('box_id', flat=True))
+
+
+REFERENCE_MODELS = [
+    SpecimenType, AliquotType, EventModel, VisitModel, ScheduleModel,
+    BoxTypeModel, CarrierModel, DestinationModel,
+]
+
+
+def reference_data_changed(sender, **kwargs):
+    invalidate_reference_data(sender)
+
+
+for model in REFERENCE_MODELS:
+    signals.post_save.connect(reference_data_changed, sender=model)
+    signals.post_delete.connect(reference_data_changed, sender=model)
+
+
+# draw grid, see lims/draw_grid.py, and inventory, see lims/inventory.py
+
+@receiver(signals.pre_save, sender=AliquotModel)
+def remember_aliquot_patient(sender, instance, raw=False, **kwargs):
+    instance._previous_patient_id = None
+    if instance.pk is not None and not raw:
+        instance._previous_patient_id = AliquotModel.objects.filter(
+            pk=instance.pk).values_list('specimen__patient_id', flat=True).first()
+
+
+@receiver(signals.post_save, sender=AliquotModel)
+@receiver(signals.post_delete, sender=AliquotModel)
+def aliquot_drawn(sender, instance, **kwargs):
+    patient_ids = list(SpecimenModel.objects.filter(
+        pk=instance.specimen_id).values_list('patient_id', flat=True))
+    patient_ids.append(getattr(instance, '_previous_patient_id', None))
+    refresh_draw_grid_on_commit(patient_ids)
+    refresh_inventory_on_commit(patient_ids)
+
+
+@receiver(signals.pre_save, sender=SpecimenModel)
+def remember_specimen_patient(sender, instance, raw=False, **kwargs):
+    instance._previous_patient_id = None
+    if instance.pk is not None and not raw:
+        instance._previous_patient_id = SpecimenModel.objects.filter(
+            pk=instance.pk).values_list('patient_id', flat=True).first()
+
+
+@receiver(signals.post_save, sender=SpecimenModel)
+@receiver(signals.post_delete, sender=SpecimenModel)
+def specimen_drawn(sender, instance, **kwargs):
+    patient_ids = [instance.patient_id, getattr(instance, '_previous_patient_id', None)]
+    refresh_draw_grid_on_commit(patient_ids)
+    refresh_inventory_on_commit(patient_ids)
+
+
+@receiver(signals.post_save, sender=PatientModel)
+def patient_scheduled(sender, instance, **kwargs):
+    refresh_draw_grid_on_commit([instance.pk])
+
+
+@receiver(signals.post_save, sender=ScheduleModel)
+@receiver(signals.pre_delete, sender=ScheduleModel)
+def schedule_changed(sender, instance, **kwargs):
+    refresh_draw_grid_on_commit(PatientModel.objects.filter(
+        draw_schedule=instance.pk).values_list('pk', flat=True))
+
+
+# aliquots count towards the event named as their visit
+@receiver(signals.post_save, sender=VisitModel)
+@receiver(signals.pre_delete, sender=VisitModel)
+def visit_changed(sender, instance, **kwargs):
+    refresh_draw_grid_on_commit(AliquotModel.objects.filter(
+        visit=instance.pk).values_list('specimen__patient_id', flat=True))
+
+
+# schedules refer to events and specimen types by name, and aliquots to
+# events by visit label: a new name or a rename affects the patients on
+# the schedules naming the old or new name and, for an event, those with
+# aliquots of a visit labelled so (deletes are handled by the cascade)
+@receiver(signals.pre_save, sender=EventModel)
+@receiver(signals.pre_save, sender=SpecimenType)
+def remember_schedule_name(sender, instance, raw=False, **kwargs):
+    instance._previous_name = None
+    if instance.pk is not None and not raw:
+        instance._previous_name = sender.objects.filter(pk=instance.pk).values_list(
+            'event' if sender is EventModel else 'type', flat=True).first()
+
+
+@receiver(signals.post_save, sender=EventModel)
+@receiver(signals.post_save, sender=SpecimenType)
+def schedule_name_changed(sender, instance, **kwargs):
+    name = instance.event if sender is EventModel else instance.type
+    previous = getattr(instance, '_previous_name', None)
+    if previous == name:
+        return
+    names = {name, previous} - {None}
+    if sender is EventModel:
+        schedule_ids = schedules_naming(events=names)
+        refresh_draw_grid_on_commit(AliquotModel.objects.filter(
+            visit__label__in=names).values_list('specimen__patient_id', flat=True))
+    else:
+        schedule_ids = schedules_naming(specimen_types=names)
+    refresh_draw_grid_on_commit(PatientModel.objects.filter(
+        draw_schedule__in=schedule_ids).values_list('pk', flat=True))
+
+
+# inventory storage locations
+
+@receiver(signals.post_save, sender=BoxSlotModel)
+@receiver(signals.post_delete, sender=BoxSlotModel)
+def slot_filled(sender, instance, **kwargs):
+    refresh_inventory_on_commit(AliquotModel.objects.filter(
+        pk__in=[instance.content_id, getattr(instance, '_previous_content_id', None)],
+    ).values_list('specimen__patient_id', flat=True))
+
+
+@receiver(signals.post_save, sender=BoxModel)
+def box_located(sender, instance, created=False, **kwargs):
+    if not created:
+        refresh_inventory_on_commit(BoxSlotModel.objects.filter(
+            box=instance.pk).values_list('content__specimen__patient_id', flat=True))
+
+
+# the boxes of a deleted storage object move to its container
+# (see StorageModel), its rows are removed by the cascade
+@receiver(signals.pre_delete, sender=StorageModel)
+@receiver(signals.pre_delete, sender=VisitModel)
+def inventory_dimension_deleted(sender, instance, **kwargs):
+    field = 'storage' if sender is StorageModel else 'visit'
+    refresh_inventory_on_commit(InventoryModel.objects.filter(
+        **{field: instance.pk}).values_list('patient_id', flat=True))
+
+
+# live storage tree, see lims/live.py (box grids are sent by lims/cache.py)
+
+@receiver(signals.post_save, sender=StorageModel)
+def storage_changed(sender, instance, **kwargs):
+    storage_changed_on_commit(storage_ids=[instance.pk])
+
+
+@receiver(signals.post_delete, sender=StorageModel)
+def storage_deleted(sender, instance, **kwargs):
+    storage_changed_on_commit(deleted_storage=[(instance.pk, instance.container_id)])
+
+
+@receiver(signals.post_save, sender=BoxModel)
+@receiver(signals.post_delete, sender=BoxModel)
+def box_stored(sender, instance, **kwargs):
+    storage_changed_on_commit(box_ids=[instance.pk])
+
+
+# cached JWT users, see lims/auth.py
+
+@receiver(signals.post_save, sender=get_user_model())
+@receiver(signals.post_delete, sender=get_user_model())
+def user_changed(sender, instance, **kwargs):
+    invalidate_user(instance.get_username())
+
+
+@receiver(user_logged_out)
+def user_logged_out_handler(sender, request, user, **kwargs):
+    if user is not None:
+        invalidate_user(user.get_username())
+
+
+# tombstones for delta sync clients, see lims/changes.py
+def record_deletion_handler(sender, instance, **kwargs):
+    record_deletion(sender, instance.pk)
+
+
+for model in TOMBSTONE_MODELS:
+    signals.post_delete.connect(
+        record_deletion_handler, sender=model, dispatch_uid='tombstone-{}'.format(model.__name__))
+
+
+# replace persistent database connections the server dropped
+@receiver(request_started)
+def request_started_check_connections(sender, **kwargs):
+    check_connections()
@@ -0,0 +1,138 @@
+import csv
+import json
+from collections import namedtuple
+from urllib.request import urlopen
+
+from django.db import connection, transaction
+from django.utils import timezone
+
+from lims.draw_grid import refresh_draw_grid_on_commit
+from lims.models.patient import PatientModel, SourceModel
+
+"""
+    Patient sync engine
+
+    PIDs coming from an external source (REDCap etc) are reconciled against
+    existing patients in batches with a single INSERT ... ON CONFLICT upsert
+    per batch (postgres), which makes concurrent sync workers safe:
+
+    new pid: inserted as a synced patient of the source
+    existing unsynced (local) patient: marked synced to the source
+    existing synced patient: left unchanged
+
+    The upsert sends no post_save: the draw grid of every inserted or
+    synced patient is queued here, as patient_scheduled (lims/signals.py)
+    would.
+"""
+
+BATCH_SIZE = 1000
+
+SyncResult = namedtuple('SyncResult', 'inserted synced unchanged skipped')
+
+# xmax is 0 for a freshly inserted row and set for an updated one
+UPSERT_SQL = """
+    INSERT INTO {table} AS patient
+        (pid, source_id, draw_schedule_id, synced, sync_date, create_date, modify_date)
+    VALUES {values}
+    ON CONFLICT (pid) DO UPDATE
+        SET synced = TRUE,
+            sync_date = EXCLUDED.sync_date,
+            source_id = EXCLUDED.source_id,
+            modify_date = EXCLUDED.modify_date
+        WHERE patient.synced = FALSE
+    RETURNING patient.id, patient.pid, (patient.xmax = 0) AS inserted
+"""
+
+
+def upsert_patients(source_id, pids, draw_schedule_id=None):
+    """
+        Runs one upsert for a batch of unique pids
+        Returns (id, pid, inserted) for every inserted or newly synced patient
+    """
+    if not pids:
+        return []
+    now = timezone.now()
+    values = ', '.join(['(%s, %s, %s, TRUE, %s, %s, %s)'] * len(pids))
+    params = []
+    for pid in pids:
+        params.extend([pid, source_id, draw_schedule_id, now, now, now])
+
+    sql = UPSERT_SQL.format(
+        table=connection.ops.quote_name(PatientModel._meta.db_table),
+        values=values)
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+
+    refresh_draw_grid_on_commit(patient_id for patient_id, _, _ in rows)
+    return rows
+
+
+def sync_patients(source, pids, batch_size=BATCH_SIZE):
+    """
+        Reconciles pids from source (a SourceModel or its name) with patients
+        Blank, duplicate and over-long pids are skipped
+        Returns a SyncResult with the count of each outcome
+    """
+    if not isinstance(source, SourceModel):
+        source = SourceModel.objects.get(name=source)
+    if source.name == 'local':
+        raise ValueError('Patients can not be synced from the local source')
+
+    max_length = PatientModel._meta.get_field('pid').max_length
+    unique_pids = []
+    seen = set()
+    skipped = 0
+    for pid in pids:
+        pid = (pid or '').strip()
+        if not pid or len(pid) > max_length or pid in seen:
+            skipped += 1
+            continue
+        seen.add(pid)
+        unique_pids.append(pid)
+
+    inserted = synced = 0
+    for start in range(0, len(unique_pids), batch_size):
+        batch = unique_pids[start:start + batch_size]
+        with transaction.atomic():
+            rows = upsert_patients(source.id, batch)
+        batch_inserted = sum(1 for _, _, was_inserted in rows if was_inserted)
+        inserted += batch_inserted
+        synced += len(rows) - batch_inserted
+
+    unchanged = len(unique_pids) - inserted - synced
+    return SyncResult(inserted, synced, unchanged, skipped)
+
+
+def read_pid_file(path):
+    """
+        Reads pids from a local file
+        .json: a list of pids
+        .csv: the "pid" column, or the first column without a header
+        anything else: one pid per line
+    """
+    with open(path, newline='') as pid_file:
+        if path.endswith('.json'):
+            return [str(pid) for pid in json.load(pid_file)]
+        if path.endswith('.csv'):
+            rows = list(csv.reader(pid_file))
+            if rows and 'pid' in rows[0]:
+                column = rows[0].index('pid')
+                rows = rows[1:]
+            else:
+                column = 0
+            return [row[column] for row in rows if row]
+        return pid_file.read().splitlines()
+
+
+def fetch_pid_url(url, timeout=30):
+    """
+        Fetches pids from an http source returning a JSON list of pids or
+        one pid per line
+    """
+    with urlopen(url, timeout=timeout) as response:
+        body = response.read().decode('utf-8')
+    try:
+        return [str(pid) for pid in json.loads(body)]
+    except ValueError:
+        return body.splitlines()
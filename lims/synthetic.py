@@ -0,0 +1,185 @@
+import datetime
+from collections import namedtuple
+
+from django.db import transaction
+from django.utils import timezone
+
+from lims.draw_grid import BATCH_SIZE as DRAW_GRID_BATCH_SIZE, refresh_draw_grid
+from lims.inventory import refresh_inventory
+from lims.models.patient import PatientModel, SourceModel, VisitModel
+from lims.models.schedule import EventModel, ScheduleModel
+from lims.models.shipping import CarrierModel, DestinationModel, ShipmentModel
+from lims.models.specimen import AliquotModel, AliquotType, SpecimenModel, SpecimenType
+from lims.models.storage import BoxModel, BoxSlotModel, BoxTypeModel, StorageModel
+
+"""
+    Synthetic biorepository for load testing and benchmarks
+
+    Everything is inserted with bulk_create in one transaction, so even large
+    repositories take seconds. Rows bypass model save and signals: storage
+    paths are rebuilt and the draw grid and inventory of the new patients
+    refreshed once at the end. Reference data (types, events, visits, schedule, box type,
+    carrier, destination) is reused when it exists.
+
+    Generated pids are PREFIX + a sequence number, run again with another
+    prefix to grow an existing repository.
+"""
+
+BATCH_SIZE = 5000
+
+# specimen type -> aliquot types made from it
+SPECIMEN_TYPES = {
+    'Blood': [('Plasma', 'ml'), ('Serum', 'ml'), ('Buffy coat', 'ml')],
+    'Urine': [('Urine', 'ml')],
+}
+EVENTS = ['baseline', 'week 1', 'week 4', 'week 12']
+# storage objects contained in every storage object of the level above
+STORAGE_BRANCHING = 3
+
+SyntheticData = namedtuple(
+    'SyntheticData',
+    'patients specimens aliquots storage boxes slots shipments draw_grid')
+
+
+def cycle_item(items, index):
+    """ items[index] wrapping around, None for no items """
+    return items[index % len(items)] if items else None
+
+
+def reference_data():
+    """ returns (specimen types, aliquot types by specimen type, visits, schedule) """
+    specimen_types = []
+    aliquot_types = {}
+    for specimen_name, aliquots in SPECIMEN_TYPES.items():
+        specimen_type, _ = SpecimenType.objects.get_or_create(type=specimen_name)
+        specimen_types.append(specimen_type)
+        aliquot_types[specimen_type.pk] = [
+            AliquotType.objects.get_or_create(type=name, defaults={'units': units})[0]
+            for name, units in aliquots
+        ]
+
+    visits = []
+    for event in EVENTS:
+        if not EventModel.objects.filter(event=event).exists():
+            order = (EventModel.objects.order_by('-order').values_list(
+                'order', flat=True).first() or 0) + 1
+            EventModel.objects.create(event=event, order=order)
+        visits.append(VisitModel.objects.get_or_create(label=event)[0])
+
+    schedule, _ = ScheduleModel.objects.get_or_create(
+        name='Synthetic schedule',
+        defaults={'schedule': {event: list(SPECIMEN_TYPES) for event in EVENTS}})
+    return specimen_types, aliquot_types, visits, schedule
+
+
+def create_storage(depth):
+    """
+        Creates a tree of storage objects depth levels deep under one top object
+        Returns (every created object, the bottom level)
+    """
+    created = []
+    level = [None]
+    for depth_index in range(depth):
+        objects = []
+        for container in level:
+            for _ in range(1 if container is None else STORAGE_BRANCHING):
+                objects.append(StorageModel(
+                    name='L{}-{}'.format(depth_index + 1, len(objects) + 1),
+                    description='Synthetic storage level {}'.format(depth_index + 1),
+                    container=container))
+        level = StorageModel.objects.bulk_create(objects)
+        created.extend(level)
+    StorageModel.rebuild_paths()
+    return created, level
+
+
+@transaction.atomic
+def generate(patients=100, specimens=2, aliquots=3, storage_depth=3, boxes=10,
+             shipments=2, boxes_per_shipment=2, prefix='S', batch_size=BATCH_SIZE):
+    """
+        Creates patients with specimens per patient and aliquots per specimen,
+        a storage tree storage_depth levels deep with boxes spread over its
+        bottom level, filled with the aliquots in creation order, and
+        shipments of boxes_per_shipment boxes each
+        Returns a SyntheticData of the created ids
+    """
+    specimen_types, aliquot_types, visits, schedule = reference_data()
+    source = SourceModel.objects.get(name='local')
+    box_type, _ = BoxTypeModel.objects.get_or_create(
+        name='9x9', defaults={'description': '81 slot box', 'length': 9, 'height': 9})
+    carrier, _ = CarrierModel.objects.get_or_create(name='Synthetic carrier')
+    destination, _ = DestinationModel.objects.get_or_create(name='Synthetic lab')
+
+    now = timezone.now()
+    pid_width = PatientModel._meta.get_field('pid').max_length - len(prefix)
+    patient_objects = PatientModel.objects.bulk_create([
+        PatientModel(pid='{}{}'.format(prefix, str(index).zfill(pid_width)),
+                     source=source, draw_schedule=schedule)
+        for index in range(patients)
+    ], batch_size=batch_size)
+
+    specimen_objects = SpecimenModel.objects.bulk_create([
+        SpecimenModel(patient=patient,
+                      type=cycle_item(specimen_types, index),
+                      collectdate=now.date(),
+                      collecttime=now.time())
+        for patient in patient_objects
+        for index in range(specimens)
+    ], batch_size=batch_size)
+
+    aliquot_objects = AliquotModel.objects.bulk_create([
+        AliquotModel(specimen=specimen,
+                     type=cycle_item(aliquot_types[specimen.type_id], index),
+                     visit=cycle_item(visits, specimen_index),
+                     collectdate=now,
+                     collecttime=now.time(),
+                     volume=1.0,
+                     barcode='{}-{}-{}'.format(prefix, specimen.pk, index + 1))
+        for specimen_index, specimen in enumerate(specimen_objects)
+        for index in range(aliquots)
+    ], batch_size=batch_size)
+
+    storage_objects, bottom_level = create_storage(storage_depth)
+    shipment_objects = ShipmentModel.objects.bulk_create([
+        ShipmentModel(carrier=carrier,
+                      destination=destination,
+                      shipment_number='{}-{}'.format(prefix, index + 1),
+                      sent_date=now - datetime.timedelta(days=index))
+        for index in range(shipments)
+    ])
+    shipped = [shipment for shipment in shipment_objects for _ in range(boxes_per_shipment)]
+    box_objects = BoxModel.objects.bulk_create([
+        BoxModel(name='{}-box-{}'.format(prefix, index + 1),
+                 barcode='{}-box-{}'.format(prefix, index + 1),
+                 box_type=box_type,
+                 storage_location=cycle_item(bottom_level, index),
+                 manifest=shipped[index] if index < len(shipped) else None)
+        for index in range(boxes)
+    ])
+
+    positions = [
+        (box, row, column)
+        for box in box_objects
+        for row in range(1, box_type.height + 1)
+        for column in range(1, box_type.length + 1)
+    ]
+    slot_objects = BoxSlotModel.objects.bulk_create([
+        BoxSlotModel(box=box, row_position=row, column_position=column, content=aliquot)
+        for (box, row, column), aliquot in zip(positions, aliquot_objects)
+    ], batch_size=batch_size)
+
+    patient_ids = [patient.pk for patient in patient_objects]
+    draw_grid = 0
+    for start in range(0, len(patient_ids), DRAW_GRID_BATCH_SIZE):
+        draw_grid += refresh_draw_grid(patient_ids[start:start + DRAW_GRID_BATCH_SIZE])
+        refresh_inventory(patient_ids[start:start + DRAW_GRID_BATCH_SIZE])
+
+    return SyntheticData(
+        patients=patient_ids,
+        specimens=[specimen.pk for specimen in specimen_objects],
+        aliquots=[aliquot.pk for aliquot in aliquot_objects],
+        storage=[storage.pk for storage in storage_objects],
+        boxes=[box.pk for box in box_objects],
+        slots=[slot.pk for slot in slot_objects],
+        shipments=[shipment.pk for shipment in shipment_objects],
+        draw_grid=draw_grid)
@@ -0,0 +1,348 @@
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+
+from django.conf import settings
+from django.db import connections
+from graphql.language import ast
+
+"""
+    Per operation GraphQL telemetry
+
+    A sampled share of the requests (SAMPLE_RATE) is measured: total
+    latency, number and time of the SQL queries on every database
+    connection, and the time spent in each resolver (TelemetryMiddleware,
+    a graphene middleware). Requests that are not sampled only pay for one
+    random() call.
+
+    Measurements are added to the counters of the worker process. With
+    DIRECTORY set, every worker writes its counters to its own file there
+    (at most every FLUSH_INTERVAL seconds), and the /metrics view adds up
+    the files of all workers, so any worker can answer a scrape. Clear the
+    directory when the service is (re)started.
+
+    Settings live under GRAPHENE['TELEMETRY'], ex)
+    'TELEMETRY': {
+        'SAMPLE_RATE': 0.1,
+        'DIRECTORY': '/run/brims-metrics',
+    }
+"""
+
+DEFAULTS = {
+    # share of requests measured, 0 disables telemetry
+    'SAMPLE_RATE': 0.1,
+    # shared by the workers of a deployment, None keeps metrics per process
+    'DIRECTORY': None,
+    # seconds between writes of a worker's counters to DIRECTORY
+    'FLUSH_INTERVAL': 10,
+    # latency histogram buckets in seconds
+    'BUCKETS': [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10],
+    # operation names tracked, later names are counted as "other"
+    'MAX_OPERATIONS': 200,
+    # slowest resolver fields exported per operation
+    'FIELDS_PER_OPERATION': 10,
+    # required as "Authorization: Bearer <token>" by /metrics, which is
+    # only served without one when DEBUG is on
+    'METRICS_TOKEN': None,
+}
+
+
+def get_telemetry_settings():
+    return dict(DEFAULTS, **settings.GRAPHENE.get('TELEMETRY', {}))
+
+
+def operation_label(document_ast, operation_name=None):
+    """ returns (operation type, operation name) of the executed operation """
+    for definition in document_ast.definitions:
+        if not isinstance(definition, ast.OperationDefinition):
+            continue
+        name = definition.name.value if definition.name is not None else None
+        if operation_name is None or name == operation_name:
+            return definition.operation, name or 'anonymous'
+    return 'query', 'anonymous'
+
+
+def new_operation(buckets):
+    return {
+        'buckets': [0] * len(buckets),
+        'count': 0,
+        'seconds': 0.0,
+        'errors': 0,
+        'sql_queries': 0,
+        'sql_seconds': 0.0,
+        # field: [calls, seconds]
+        'fields': {},
+    }
+
+
+def merge_operation(total, operation):
+    total['buckets'] = [a + b for a, b in zip(total['buckets'], operation['buckets'])]
+    for key in ('count', 'seconds', 'errors', 'sql_queries', 'sql_seconds'):
+        total[key] += operation[key]
+    for field, (calls, seconds) in operation['fields'].items():
+        field_total = total['fields'].setdefault(field, [0, 0.0])
+        field_total[0] += calls
+        field_total[1] += seconds
+
+
+class Metrics(object):
+    """
+        Counters of one worker process
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.operations = {}
+        self.last_flush = time.monotonic()
+
+    def record(self, recording, telemetry_settings):
+        buckets = telemetry_settings['BUCKETS']
+        key = '{}:{}'.format(recording.operation_type, recording.operation_name)
+        with self.lock:
+            if key not in self.operations and (
+                    len(self.operations) >= telemetry_settings['MAX_OPERATIONS']):
+                key = '{}:other'.format(recording.operation_type)
+            operation = self.operations.get(key)
+            if operation is None:
+                operation = self.operations[key] = new_operation(buckets)
+            for index, bound in enumerate(buckets):
+                if recording.seconds <= bound:
+                    operation['buckets'][index] += 1
+            operation['count'] += 1
+            operation['seconds'] += recording.seconds
+            operation['errors'] += int(recording.failed)
+            operation['sql_queries'] += recording.sql_queries
+            operation['sql_seconds'] += recording.sql_seconds
+            for field, (calls, seconds) in recording.fields.items():
+                field_total = operation['fields'].setdefault(field, [0, 0.0])
+                field_total[0] += calls
+                field_total[1] += seconds
+
+        if telemetry_settings['DIRECTORY'] and (
+                time.monotonic() - self.last_flush >= telemetry_settings['FLUSH_INTERVAL']):
+            self.flush(telemetry_settings['DIRECTORY'])
+
+    def snapshot(self):
+        with self.lock:
+            return json.loads(json.dumps(self.operations))
+
+    def flush(self, directory):
+        """ atomically replaces the file of this worker in directory """
+        self.last_flush = time.monotonic()
+        os.makedirs(directory, exist_ok=True)
+        descriptor, temporary = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(descriptor, 'w') as worker_file:
+            json.dump(self.snapshot(), worker_file)
+        os.replace(temporary, os.path.join(directory, 'worker-{}.json'.format(os.getpid())))
+
+
+metrics = Metrics()
+
+
+class Recording(object):
+    """
+        Measurements of one sampled request
+    """
+
+    def __init__(self, operation_type, operation_name):
+        self.operation_type = operation_type
+        self.operation_name = operation_name
+        self.start = None
+        self.seconds = 0.0
+        self.failed = False
+        self.sql_queries = 0
+        self.sql_seconds = 0.0
+        self.fields = {}
+        # root fields of a request may run in parallel threads (lims/consumers.py)
+        self.lock = threading.Lock()
+
+    def sql_wrapper(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            seconds = time.perf_counter() - start
+            with self.lock:
+                self.sql_queries += 1
+                self.sql_seconds += seconds
+
+    def add_field(self, field, seconds):
+        with self.lock:
+            field_total = self.fields.get(field)
+            if field_total is None:
+                field_total = self.fields[field] = [0, 0.0]
+            field_total[0] += 1
+            field_total[1] += seconds
+
+
+def start_recording(context, document_ast, operation_name):
+    """
+        Returns a Recording when the request is sampled, None otherwise
+    """
+    if random.random() >= get_telemetry_settings()['SAMPLE_RATE']:
+        return None
+    recording = Recording(*operation_label(document_ast, operation_name))
+    recording.start = time.perf_counter()
+    if context is not None:
+        context._lims_telemetry = recording
+    return recording
+
+
+@contextmanager
+def recording_sql(recording):
+    """
+        Counts the SQL run by the current thread on every connection
+    """
+    with ExitStack() as stack:
+        if recording is not None:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(recording.sql_wrapper))
+        yield
+
+
+def finish_recording(recording, context, failed):
+    recording.seconds = time.perf_counter() - recording.start
+    recording.failed = failed
+    if context is not None:
+        context._lims_telemetry = None
+    metrics.record(recording, get_telemetry_settings())
+
+
+def measure(context, document_ast, operation_name, execute):
+    """
+        Runs execute(), measuring it when the request is sampled
+        Returns what execute returns
+    """
+    recording = start_recording(context, document_ast, operation_name)
+    if recording is None:
+        return execute()
+
+    result = None
+    try:
+        with recording_sql(recording):
+            result = execute()
+        return result
+    finally:
+        finish_recording(recording, context, result is None or bool(result.errors))
+
+
+class TelemetryMiddleware(object):
+    """
+        Graphene middleware timing the resolvers of sampled requests
+        Time of a resolver returning a promise (DataLoader) is the time
+        spent until the promise is returned
+    """
+
+    def resolve(self, next, root, info, **kwargs):
+        recording = getattr(info.context, '_lims_telemetry', None)
+        if recording is None:
+            return next(root, info, **kwargs)
+        start = time.perf_counter()
+        try:
+            return next(root, info, **kwargs)
+        finally:
+            recording.add_field(
+                '{}.{}'.format(info.parent_type.name, info.field_name),
+                time.perf_counter() - start)
+
+
+def collect():
+    """
+        Returns the counters of every worker added up by operation key
+    """
+    telemetry_settings = get_telemetry_settings()
+    directory = telemetry_settings['DIRECTORY']
+    if not directory:
+        return metrics.snapshot()
+
+    metrics.flush(directory)
+    totals = {}
+    for file_name in sorted(os.listdir(directory)):
+        if not file_name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(directory, file_name)) as worker_file:
+                operations = json.load(worker_file)
+        except (OSError, ValueError):
+            # removed or replaced while listing
+            continue
+        for key, operation in operations.items():
+            if key not in totals:
+                totals[key] = new_operation(telemetry_settings['BUCKETS'])
+            merge_operation(totals[key], operation)
+    return totals
+
+
+def escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render_prometheus(operations):
+    """
+        Renders counters in the Prometheus text exposition format
+    """
+    telemetry_settings = get_telemetry_settings()
+    lines = [
+        '# HELP lims_telemetry_sample_rate Share of GraphQL requests measured',
+        '# TYPE lims_telemetry_sample_rate gauge',
+        'lims_telemetry_sample_rate {}'.format(telemetry_settings['SAMPLE_RATE']),
+    ]
+
+    series = [
+        ('lims_graphql_operation_duration_seconds', 'histogram',
+         'Latency of sampled GraphQL operations'),
+        ('lims_graphql_operation_errors_total', 'counter',
+         'Sampled GraphQL operations returning errors'),
+        ('lims_graphql_operation_sql_queries_total', 'counter',
+         'SQL queries run by sampled GraphQL operations'),
+        ('lims_graphql_operation_sql_seconds_total', 'counter',
+         'Time spent in SQL by sampled GraphQL operations'),
+        ('lims_graphql_field_calls_total', 'counter',
+         'Resolver calls of the slowest fields of each operation'),
+        ('lims_graphql_field_seconds_total', 'counter',
+         'Resolver time of the slowest fields of each operation'),
+    ]
+    samples = {name: [] for name, _, _ in series}
+    for key in sorted(operations):
+        operation = operations[key]
+        operation_type, name = key.split(':', 1)
+        labels = 'type="{}",operation="{}"'.format(operation_type, escape_label(name))
+
+        histogram = samples['lims_graphql_operation_duration_seconds']
+        for bound, count in zip(telemetry_settings['BUCKETS'], operation['buckets']):
+            histogram.append('lims_graphql_operation_duration_seconds_bucket{{{},le="{}"}} {}'.format(
+                labels, bound, count))
+        histogram.append('lims_graphql_operation_duration_seconds_bucket{{{},le="+Inf"}} {}'.format(
+            labels, operation['count']))
+        histogram.append('lims_graphql_operation_duration_seconds_sum{{{}}} {}'.format(
+            labels, operation['seconds']))
+        histogram.append('lims_graphql_operation_duration_seconds_count{{{}}} {}'.format(
+            labels, operation['count']))
+
+        samples['lims_graphql_operation_errors_total'].append(
+            'lims_graphql_operation_errors_total{{{}}} {}'.format(labels, operation['errors']))
+        samples['lims_graphql_operation_sql_queries_total'].append(
+            'lims_graphql_operation_sql_queries_total{{{}}} {}'.format(
+                labels, operation['sql_queries']))
+        samples['lims_graphql_operation_sql_seconds_total'].append(
+            'lims_graphql_operation_sql_seconds_total{{{}}} {}'.format(
+                labels, operation['sql_seconds']))
+
+        slowest = sorted(
+            operation['fields'].items(), key=lambda item: item[1][1], reverse=True)
+        for field, (calls, seconds) in slowest[:telemetry_settings['FIELDS_PER_OPERATION']]:
+            field_labels = '{},field="{}"'.format(labels, escape_label(field))
+            samples['lims_graphql_field_calls_total'].append(
+                'lims_graphql_field_calls_total{{{}}} {}'.format(field_labels, calls))
+            samples['lims_graphql_field_seconds_total'].append(
+                'lims_graphql_field_seconds_total{{{}}} {}'.format(field_labels, seconds))
+
+    for name, metric_type, description in series:
+        lines.append('# HELP {} {}'.format(name, description))
+        lines.append('# TYPE {} {}'.format(name, metric_type))
+        lines.extend(samples[name])
+    return '\n'.join(lines) + '\n'
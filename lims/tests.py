@@ -1,3 +1,1821 @@
-from django.test import TestCase
+import datetime
+import glob
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+import types
+from importlib import import_module
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.testing import HttpCommunicator, WebsocketCommunicator
+from django.apps import apps
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.core.exceptions import PermissionDenied, ValidationError
+from django.core.management import CommandError, call_command
+from django.core.management.color import no_style
+from django.db import (
+    DatabaseError, IntegrityError, OperationalError, connection, connections, transaction)
+from django.db.models import Count, Sum
+from django.http import HttpResponse
+from django.test import Client, RequestFactory, SimpleTestCase, TestCase, TransactionTestCase
+from django.utils import timezone
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils.deprecation import MiddlewareMixin
+from graphql import parse
+from graphql.language.printer import print_ast
+from graphql_jwt.middleware import JSONWebTokenMiddleware as GrapheneJSONWebTokenMiddleware
+from graphql_jwt.shortcuts import get_token
+
+from brims.routing import application
+from lims.auth import JSONWebTokenErrorMiddleware, JSONWebTokenMiddleware
+from lims.backend import split_root_fields
+from lims.cache import box_grid_key, get_box_grid
+from lims.changes import SETTLE_SECONDS, changes_since
+from lims.consumers import GraphQLConsumer, shutdown_executor
+from lims.database import (
+    STICKY_COOKIE, ReplicaRouter, ReplicaStickinessMiddleware, check_connections,
+    route_operation)
+from lims.inventory import DIMENSIONS, inventory_totals
+from lims.exports import patient_batches, repository_export, repository_rows
+from lims.live import MAX_BOXES, grid_diff, publish_boxes
+from lims.models.patient import PatientModel, SourceModel, VisitModel
+from lims.models.schedule import EventModel, ScheduleModel
+from lims.models.shipping import ShipmentModel
+from lims.models.specimen import AliquotModel, AliquotType, SpecimenModel, SpecimenType
+from lims.models.storage import BoxModel, BoxSlotModel, BoxTypeModel, StorageModel
+from lims.persisted_queries import query_hash
+from lims.placement import ATTEMPTS, PlacementError, free_positions, place_aliquots
+from lims.query_cost import CostAnalysis
+from lims.refresh_queue import RefreshQueue
+from lims.schema import build_box_grid, bulk_create_patients, schema
+from lims.search import (
+    MAX_SEARCH_LIMIT, SEARCH_LIMIT, resolve_scans, search_aliquots, search_patients,
+    search_specimens)
+from lims.sync import SyncResult, sync_patients, upsert_patients
+from lims.synthetic import generate
+from lims.telemetry import DEFAULTS as TELEMETRY_DEFAULTS, start_recording
+
+
+def report_benchmark(text):
+    """ prints benchmark results when LIMS_BENCHMARK_REPORT is set """
+    if os.environ.get('LIMS_BENCHMARK_REPORT'):
+        print('\n' + text)
+
+
+class JWTAuthBenchmark(TestCase):
+    """
+        Per request cost of JWT authentication, graphql_jwt's graphene
+        middleware (before) against lims.auth (after)
+        Timings are printed with LIMS_BENCHMARK_REPORT set, the assertions
+        only cover database work
+    """
+    requests = 200
+    query = '{ me { username email isStaff } allEvents { event order } allVisits { label } }'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_user('bench', 'bench@example.com', 'pw')
+        for order in range(20):
+            EventModel.objects.create(event='event {}'.format(order), order=order)
+
+    def make_request(self):
+        request = RequestFactory().post(
+            '/graphql/', HTTP_AUTHORIZATION='JWT {}'.format(get_token(self.user)))
+        request.user = AnonymousUser()
+        return request
+
+    def run_before(self, request):
+        return schema.execute(
+            self.query, context_value=request,
+            middleware=[GrapheneJSONWebTokenMiddleware()])
+
+    def run_after(self, request):
+        def get_response(request):
+            return schema.execute(
+                self.query, context_value=request,
+                middleware=[JSONWebTokenErrorMiddleware()])
+        return JSONWebTokenMiddleware(get_response)(request)
+
+    def benchmark(self, execute):
+        requests = [self.make_request() for _ in range(self.requests)]
+        execute(self.make_request())  # warm up caches
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            for request in requests:
+                result = execute(request)
+            elapsed = time.perf_counter() - start
+        self.assertIsNone(result.errors)
+        self.assertEqual(result.data['me']['username'], 'bench')
+        return elapsed / self.requests, len(queries) / self.requests
+
+    def test_auth_overhead(self):
+        # without the cached user lookup of lims.auth
+        jwt_settings = dict(
+            settings.GRAPHQL_JWT,
+            JWT_GET_USER_BY_NATURAL_KEY_HANDLER='graphql_jwt.utils.get_user_by_natural_key')
+        with self.settings(GRAPHQL_JWT=jwt_settings):
+            before, before_queries = self.benchmark(self.run_before)
+        after, after_queries = self.benchmark(self.run_after)
+        report_benchmark('JWT auth per request: before {:.2f}ms {:.1f} queries, '
+                         'after {:.2f}ms {:.1f} queries'.format(
+                             before * 1000, before_queries, after * 1000, after_queries))
+        # the user lookup is served from the cache
+        self.assertEqual(after_queries, before_queries - 1)
+
+    def test_rejected_token(self):
+        request = RequestFactory().post('/graphql/', HTTP_AUTHORIZATION='JWT invalid')
+        request.user = AnonymousUser()
+        result = self.run_after(request)
+        self.assertIsNone(request.user.pk)
+        self.assertEqual(str(result.errors[0]), 'Error decoding signature')
+
+
+"""
+    Query benchmark suite
+
+    Every Query and Mutation field is run against synthetic repositories of
+    growing size (lims/synthetic.py). The test fails when an operation
+    returns no data, when its query count differs between sizes (N+1) or
+    exceeds its budget in lims/query_budgets.json. Budgets are the counts
+    measured when they were set: a change running more queries has to
+    update the file, so the increase shows up in review.
+    Set LIMS_BENCHMARK_REPORT to a file name to print latency and query
+    counts and write them to the file as json.
+
+    OPERATIONS maps a root field to a function returning (document,
+    variables) for the data of the current size. Mutations run in a
+    transaction that is rolled back, so every size sees the same data.
+"""
+
+BUDGETS_FILE = os.path.join(os.path.dirname(__file__), 'query_budgets.json')
+
+# cumulative: every size adds to the data of the previous one
+SIZES = [
+    ('small', dict(patients=10, specimens=2, aliquots=5, storage_depth=2,
+                   boxes=1, shipments=1, boxes_per_shipment=1)),
+    ('large', dict(patients=150, specimens=3, aliquots=5, storage_depth=3,
+                   boxes=8, shipments=3, boxes_per_shipment=2)),
+]
+REPEAT = 3
+# fields answering null without configuration (LOGOUT_REDIRECT_URL)
+UNSET_FIELDS = {'redirectUrl'}
+
+CONNECTION_SELECTION = '{ totalCount edges { cursor node { id } } pageInfo { hasNextPage endCursor } }'
+
+
+def local_source():
+    """ the 'local' source, pk 1 as in the source.json fixture """
+    source, created = SourceModel.objects.get_or_create(pk=1, defaults={'name': 'local'})
+    if created:
+        with connection.cursor() as cursor:
+            for sql in connection.ops.sequence_reset_sql(no_style(), [SourceModel]):
+                cursor.execute(sql)
+    return source
+
+
+def unplaced_aliquots(count):
+    return list(AliquotModel.objects.filter(
+        boxslotmodel__isnull=True).values_list('pk', flat=True)[:count])
+
+
+def empty_box():
+    return BoxModel.objects.create(name='bench', box_type=BoxTypeModel.objects.first()).pk
+
+
+def aliquot_arguments(data):
+    return {
+        'specimenid': data.specimens[-1],
+        'aliquottype': AliquotType.objects.first().pk,
+        'collectdate': '2020-01-01',
+        'collecttime': '10:00:00',
+        'volume': 1.0,
+    }
+
+
+OPERATIONS = {
+    # queries
+    'me': lambda data: ('{ me { username } }', None),
+    'users': lambda data: ('{ users { id username } }', None),
+    'redirectUrl': lambda data: ('{ redirectUrl }', None),
+    'searchSpecimen': lambda data: (
+        '{ searchSpecimen(patient: "1") { pid source } }', None),
+    'searchPatients': lambda data: (
+        '{ searchPatients(pid: "S00") { pid source } }', None),
+    'allShipments': lambda data: (
+        '{ allShipments { id shipmentNumber sentDate } }', None),
+    'shipmentManifest': lambda data: (
+        'query($id: Int) { shipmentManifest(shipment: $id) '
+        '{ key name aliquot { id type visit patient specimenid volume } } }',
+        {'id': data.shipments[0]}),
+    'allBoxes': lambda data: ('{ allBoxes { id name } }', None),
+    'allSpecimenTypes': lambda data: ('{ allSpecimenTypes { id type } }', None),
+    'allAliquotTypes': lambda data: ('{ allAliquotTypes { id type units } }', None),
+    'allCarriers': lambda data: ('{ allCarriers { id name } }', None),
+    'allDestinations': lambda data: ('{ allDestinations { id name } }', None),
+    'allSlots': lambda data: (
+        'query($id: Int) { allSlots(id: $id) }', {'id': data.boxes[0]}),
+    'allSchedules': lambda data: ('{ allSchedules { id name schedule } }', None),
+    'drawGrid': lambda data: (
+        'query($id: Int) { drawGrid(schedule: $id) '
+        '{ patient { pid } event { event order } specimenType { type } expected aliquots missing } }',
+        {'id': ScheduleModel.objects.first().pk}),
+    'allPatients': lambda data: (
+        '{ allPatients(first: 50) { id pid source } }', None),
+    'allEvents': lambda data: ('{ allEvents { id event order } }', None),
+    'allVisits': lambda data: ('{ allVisits { id label } }', None),
+    'allSpecimen': lambda data: (
+        'query($id: Int) { allSpecimen(patient: $id) { id type patient } }',
+        {'id': data.patients[0]}),
+    'allAliquot': lambda data: (
+        'query($id: Int) { allAliquot(specimen: $id) { id type visit patient volume } }',
+        {'id': data.specimens[0]}),
+    'usersConnection': lambda data: (
+        '{ usersConnection(first: 20) %s }' % CONNECTION_SELECTION, None),
+    'allShipmentsConnection': lambda data: (
+        '{ allShipmentsConnection(first: 20) %s }' % CONNECTION_SELECTION, None),
+    'allBoxesConnection': lambda data: (
+        '{ allBoxesConnection(first: 20) %s }' % CONNECTION_SELECTION, None),
+    'allPatientsConnection': lambda data: (
+        '{ allPatientsConnection(first: 50) { totalCount edges { node { pid source } } } }',
+        None),
+    'allSpecimenConnection': lambda data: (
+        '{ allSpecimenConnection(first: 50) { edges { node { id type patient } } } }',
+        None),
+    'allAliquotConnection': lambda data: (
+        '{ allAliquotConnection(first: 50) { edges { node { id type visit patient } } } }',
+        None),
+    'searchSpecimens': lambda data: (
+        'query($type: Int, $visit: Int, $storage: Int) { searchSpecimens(first: 50, '
+        'specimenType: $type, visit: $visit, storage: $storage, shipped: true, '
+        'collectedAfter: "2000-01-01") { edges { node { id type patient } } } }',
+        {'type': SpecimenType.objects.first().pk, 'visit': VisitModel.objects.first().pk,
+         'storage': data.storage[0]}),
+    'searchAliquots': lambda data: (
+        'query($type: Int, $visit: Int, $storage: Int) { searchAliquots(first: 50, '
+        'aliquotType: $type, visit: $visit, storage: $storage, shipped: true, '
+        'collectedAfter: "2000-01-01", collectedBefore: "2100-01-01") '
+        '{ edges { node { id type visit patient } } } }',
+        {'type': AliquotType.objects.first().pk, 'visit': VisitModel.objects.first().pk,
+         'storage': data.storage[0]}),
+    'allStorage': lambda data: ('{ allStorage { id name path } }', None),
+    'storageUi': lambda data: (
+        '{ storageUi { key title content { id name } boxes { id name } cssIcon topLevel } }',
+        None),
+    'subtree': lambda data: (
+        'query($id: Int!) { subtree(id: $id) { id name } }', {'id': data.storage[0]}),
+    'ancestors': lambda data: (
+        'query($id: Int!) { ancestors(id: $id) { id name } }', {'id': data.storage[-1]}),
+    'boxType': lambda data: (
+        'query($id: Int) { boxType(id: $id) { name length height } }',
+        {'id': data.boxes[0]}),
+    'patient': lambda data: (
+        'query($id: Int) { patient(id: $id) { pid source } }', {'id': data.patients[0]}),
+    'box': lambda data: (
+        'query($id: Int) { box(id: $id) { id name } }', {'id': data.boxes[0]}),
+    'changesSince': lambda data: (
+        '{ changesSince(timestamp: "2020-01-01T00:00:00+00:00", limit: 50) '
+        '{ patients { pid source } specimens { id type patientid } '
+        'aliquots { id type visit patient } deleted { model objectId } cursor hasMore } }',
+        None),
+    'resolveScans': lambda data: (
+        'query($barcodes: [String]!) { resolveScans(barcodes: $barcodes) '
+        '{ scans { barcode aliquot { id } slot { rowPosition columnPosition } box { id } } '
+        'unknown duplicates } }',
+        {'barcodes': list(AliquotModel.objects.order_by('pk').values_list(
+            'barcode', flat=True)[:95]) + ['unknown']}),
+    'inventory': lambda data: (
+        '{ inventory(groupBy: [PATIENT, ALIQUOT_TYPE, STORAGE]) '
+        '{ patient { pid } aliquotType { id } storage { id } aliquots volume } }',
+        None),
+
+    # mutations
+    'tokenAuth': lambda data: (
+        'mutation { tokenAuth(username: "bench", password: "pw") { token } }', None),
+    'verifyToken': lambda data: (
+        'mutation($token: String!) { verifyToken(token: $token) { payload } }',
+        {'token': get_token(get_user_model().objects.get(username='bench'))}),
+    'refreshToken': lambda data: (
+        'mutation($token: String!) { refreshToken(token: $token) { token } }',
+        {'token': get_token(get_user_model().objects.get(username='bench'))}),
+    'deleteTokenCookie': lambda data: ('mutation { deleteTokenCookie { deleted } }', None),
+    'deleteTokenRefresh': lambda data: (
+        'mutation { deleteTokenRefresh { deleted } }', None),
+    'createPatient': lambda data: (
+        'mutation { createPatient(pid: "BENCH1") { id pid } }', None),
+    'syncPatients': lambda data: (
+        'mutation($pids: [String]!) { syncPatients(source: "bench", pids: $pids) '
+        '{ inserted synced unchanged skipped } }',
+        {'pids': ['R{}'.format(index) for index in range(50)]}),
+    'createPatients': lambda data: (
+        'mutation($patients: [PatientInput]!) { createPatients(patients: $patients) '
+        '{ ok results { index id errors } } }',
+        {'patients': [{'pid': 'BP{}'.format(index), 'drawschedule': ScheduleModel.objects.first().pk}
+                      for index in range(20)]}),
+    'createSpecimen': lambda data: (
+        'mutation($patient: Int, $type: Int) { createSpecimen(patient: $patient, '
+        'specimentype: $type, collectdate: "2020-01-01", collecttime: "10:00:00") { id } }',
+        {'patient': data.patients[0], 'type': SpecimenType.objects.first().pk}),
+    'createSpecimens': lambda data: (
+        'mutation($specimens: [SpecimenInput]!) { createSpecimens(specimens: $specimens) '
+        '{ ok results { index id errors } } }',
+        {'specimens': [{'patient': patient, 'specimentype': SpecimenType.objects.first().pk,
+                        'collectdate': '2020-01-01', 'collecttime': '10:00:00'}
+                       for patient in data.patients[:10] for _ in range(2)]}),
+    'createAliquot': lambda data: (
+        'mutation($specimenid: Int, $aliquottype: Int, $collectdate: Date, '
+        '$collecttime: Time, $volume: Float) { createAliquot(specimenid: $specimenid, '
+        'aliquottype: $aliquottype, collectdate: $collectdate, collecttime: $collecttime, '
+        'volume: $volume, times: 10) { idList } }',
+        aliquot_arguments(data)),
+    'createAliquots': lambda data: (
+        'mutation($aliquots: [AliquotInput]!) { createAliquots(aliquots: $aliquots) { idList } }',
+        {'aliquots': [dict(aliquot_arguments(data), specimenid=specimen)
+                      for specimen in data.specimens[:20]]}),
+    'createUser': lambda data: (
+        'mutation { createUser(username: "bench2", password: "pw", '
+        'email: "bench2@example.com") { user { id } } }', None),
+    'createEvent': lambda data: (
+        'mutation { createEvent(event: "bench", order: 1000) { event order } }', None),
+    'createStorage': lambda data: (
+        'mutation($container: Int) { createStorage(name: "bench", description: "bench", '
+        'container: $container) { id } }', {'container': data.storage[-1]}),
+    'moveStorage': lambda data: (
+        'mutation($id: Int!, $container: Int) { moveStorage(id: $id, container: $container) '
+        '{ id container } }', {'id': data.storage[1], 'container': data.storage[2]}),
+    'placeAliquots': lambda data: (
+        'mutation($ids: [Int]!, $box: Int) { placeAliquots(aliquotIds: $ids, box: $box) '
+        '{ slots { id rowPosition columnPosition } } }',
+        {'ids': unplaced_aliquots(10), 'box': empty_box()}),
+    'deleteStorage': lambda data: (
+        'mutation($id: Int) { deleteStorage(id: $id) { id deleted } }',
+        {'id': data.storage[-1]}),
+    'editPid': lambda data: (
+        'mutation($id: Int) { editPid(id: $id, pid: "BENCH2") { id pid } }',
+        {'id': data.patients[0]}),
+}
+
+
+def load_budgets():
+    with open(BUDGETS_FILE) as budgets_file:
+        return json.load(budgets_file)
+
+
+class QueryBenchmark(TestCase):
+    """
+        Latency and query counts of every root field at every size in SIZES
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_user('bench', 'bench@example.com', 'pw')
+        local_source()
+        SourceModel.objects.get_or_create(name='bench')
+
+    def make_request(self):
+        request = RequestFactory().post('/graphql/')
+        request.user = self.user
+        return request
+
+    def measure(self, document, variables):
+        """ returns (query count with cold caches, best latency in ms) """
+        latencies = []
+        queries = None
+        for _ in range(REPEAT):
+            cache.clear()
+            with transaction.atomic():
+                with CaptureQueriesContext(connection) as captured:
+                    start = time.perf_counter()
+                    result = schema.execute(
+                        document, variables=variables, context_value=self.make_request())
+                    latencies.append((time.perf_counter() - start) * 1000)
+                transaction.set_rollback(True)
+            self.assertIsNone(result.errors, document)
+            # the budget counts the queries of actual work
+            self.assertTrue(all(value not in (None, [], {}) for name, value in result.data.items()
+                                if name not in UNSET_FIELDS), document)
+            if queries is None:
+                queries = len(captured)
+        return queries, min(latencies)
+
+    def test_operations_cover_schema(self):
+        fields = set(schema.get_query_type().fields)
+        fields |= set(schema.get_mutation_type().fields)
+        self.assertEqual(fields - set(OPERATIONS), set())
+        self.assertEqual(set(load_budgets()), set(OPERATIONS))
+
+    def test_query_budgets(self):
+        budgets = load_budgets()
+        results = {}
+        for index, (size, options) in enumerate(SIZES):
+            data = generate(prefix='S{}'.format(index), **options)
+            for name, operation in OPERATIONS.items():
+                with transaction.atomic():
+                    document, variables = operation(data)
+                    results.setdefault(name, {})[size] = self.measure(document, variables)
+                    transaction.set_rollback(True)
+
+        report_benchmark('\n'.join(['{:<24}'.format('operation') + ''.join(
+            '{:>20}'.format(size) for size, _ in SIZES) + '{:>8}'.format('budget')] + [
+            '{:<24}'.format(name) + ''.join(
+                '{:>8} q {:>7.1f}ms'.format(*by_size[size]) for size, _ in SIZES) +
+            '{:>8}'.format(budgets.get(name, '-'))
+            for name, by_size in results.items()]))
+
+        report = os.environ.get('LIMS_BENCHMARK_REPORT')
+        if report:
+            with open(report, 'w') as report_file:
+                json.dump({
+                    name: {size: {'queries': queries, 'ms': latency}
+                           for size, (queries, latency) in by_size.items()}
+                    for name, by_size in results.items()
+                }, report_file, indent=2)
+
+        growing = [
+            '{}: {}'.format(name, ', '.join(
+                '{} queries ({})'.format(by_size[size][0], size) for size, _ in SIZES))
+            for name, by_size in results.items()
+            if len({queries for queries, _ in by_size.values()}) > 1
+        ]
+        self.assertEqual(growing, [])
+        over_budget = [
+            '{} ({}): {} queries, budget {}'.format(name, size, queries, budgets.get(name))
+            for name, by_size in results.items()
+            for size, (queries, _) in by_size.items()
+            if queries > budgets.get(name, 0)
+        ]
+        self.assertEqual(over_budget, [])
+
+
+class SearchPlanTest(TestCase):
+    """
+        The common searchSpecimens/searchAliquots filters (lims/search.py)
+        are answered from an index: with sequential scans disabled, the
+        planner must not fall back to reading the whole table, either
+        sequentially or along the primary key filtering every row
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        local_source()
+        generate(patients=20, specimens=2, aliquots=3)
+        # plans depend on statistics, taken from the generated rows
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('ANALYZE')
+
+    def plan_nodes(self, queryset):
+        """ returns every node of the plan of a search page """
+        sql, params = queryset.order_by('-pk')[:51].query.sql_with_params()
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute('SET LOCAL enable_seqscan = off')
+            cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+            plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        nodes = [plan[0]['Plan']]
+        for node in nodes:
+            nodes.extend(node.get('Plans', []))
+        return nodes
+
+    def test_filters_use_indexes(self):
+        if connection.vendor != 'postgresql':
+            self.skipTest('plans are checked on postgres')
+        aliquot_type = AliquotType.objects.first().pk
+        specimen_type = SpecimenType.objects.first().pk
+        visit = VisitModel.objects.first().pk
+        patient = PatientModel.objects.first().pk
+        storage = StorageModel.objects.order_by('-pk').first().pk
+        past = datetime.date(2000, 1, 1)
+        searches = {
+            'aliquots by type and visit': search_aliquots(aliquot_type=aliquot_type, visit=visit),
+            'aliquots by type': search_aliquots(aliquot_type=aliquot_type),
+            'aliquots by collect date': search_aliquots(
+                collected_after=past, collected_before=past),
+            'specimens by type': search_specimens(specimen_type=specimen_type),
+            'specimens by collect date': search_specimens(
+                collected_after=past, collected_before=past),
+            'aliquots by patient': search_aliquots(patient=patient),
+            'specimens by patient': search_specimens(patient=patient),
+            'aliquots by storage': search_aliquots(storage=storage),
+            'specimens by storage': search_specimens(storage=storage),
+            'specimens by visit': search_specimens(visit=visit),
+            'aliquots by shipment': search_aliquots(shipped=True),
+            'specimens by shipment': search_specimens(shipped=True),
+        }
+        # criteria many rows share (a visit, being shipped) are read from
+        # the index of the table they drive, the searched table being
+        # walked newest first along its primary key
+        driving = {
+            'specimens by visit': 'lims_aliquotmodel',
+            'aliquots by shipment': 'lims_boxmodel',
+            'specimens by shipment': 'lims_boxmodel',
+        }
+        for name, queryset in searches.items():
+            for node in self.plan_nodes(queryset):
+                self.assertNotEqual(node['Node Type'], 'Seq Scan', name)
+                # a table is read through the index condition of a filter
+                relation = node.get('Relation Name')
+                if relation is not None and driving.get(name, relation) == relation:
+                    self.assertTrue('Index Cond' in node or 'Recheck Cond' in node, name)
+
+
+def execute(user, document, variables=None):
+    request = RequestFactory().post('/graphql/')
+    request.user = user
+    return schema.execute(document, variables=variables, context_value=request)
+
+
+class QueryCostTest(TestCase):
+    """
+        Over-deep or over-expensive queries are rejected before any resolver
+        runs, against the budget of the user named by the JWT
+    """
+    query = '{ allPatientsConnection(first: 50) { edges { node { pid } } } }'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_user('cost', 'cost@example.com', 'pw')
+        local_source()
+        PatientModel.objects.create(pid='P1')
+
+    def cost(self, document, variables=None):
+        return CostAnalysis(schema, parse(document), variables).analyze(
+            parse(document))[0]
+
+    def post(self, query, **query_cost):
+        graphene = dict(settings.GRAPHENE, QUERY_COST=dict(
+            settings.GRAPHENE['QUERY_COST'], **query_cost))
+        with override_settings(GRAPHENE=graphene), CaptureQueriesContext(connection) as queries:
+            response = Client().post(
+                '/graphql/', json.dumps({'query': self.query}), content_type='application/json',
+                HTTP_AUTHORIZATION='JWT {}'.format(get_token(self.user)))
+        resolved = any('lims_patientmodel' in query['sql'] for query in queries)
+        return response.json(), resolved
+
+    def test_first_capped(self):
+        document = ('query($first: Int) { allPatientsConnection(first: $first) '
+                    '{ edges { node { pid } } } }')
+        max_limit = settings.GRAPHENE['RELAY_CONNECTION_MAX_LIMIT']
+        self.assertEqual(self.cost(document, {'first': 10 ** 6}),
+                         self.cost(document, {'first': max_limit}))
+        self.assertEqual(self.cost(document), self.cost(document, {'first': max_limit}))
+        self.assertLess(self.cost(document, {'first': 10}),
+                        self.cost(document, {'first': max_limit}))
+
+    def test_over_cost(self):
+        cost = self.cost(self.query)
+        result, resolved = self.post(self.query, MAX_COST=cost - 1)
+        self.assertEqual(result['errors'][0]['message'],
+                         'Query cost {} exceeds the maximum allowed cost of {}'.format(
+                             cost, cost - 1))
+        self.assertNotIn('data', result)
+        self.assertFalse(resolved)
+        # the budget of the user of the token
+        result, resolved = self.post(self.query, MAX_COST=cost - 1,
+                                     USER_MAX_COST={'cost': cost})
+        self.assertNotIn('errors', result)
+        self.assertEqual(result['data']['allPatientsConnection']['edges'][0]['node']['pid'], 'P1')
+        self.assertTrue(resolved)
+
+    def test_over_deep(self):
+        result, resolved = self.post(self.query, MAX_DEPTH=3)
+        self.assertEqual(result['errors'][0]['message'],
+                         'Query is nested 4 levels deep, the maximum allowed depth is 3')
+        self.assertFalse(resolved)
+
+
+class CreateAliquotTimesTest(TestCase):
+    """
+        times of createAliquot and createAliquots entries
+    """
+    create_aliquot = (
+        'mutation($specimenid: Int, $aliquottype: Int, $collectdate: Date, '
+        '$collecttime: Time, $volume: Float, $times: Int) { createAliquot('
+        'specimenid: $specimenid, aliquottype: $aliquottype, collectdate: $collectdate, '
+        'collecttime: $collecttime, volume: $volume, times: $times) { idList } }')
+    create_aliquots = (
+        'mutation($aliquots: [AliquotInput]!) { createAliquots(aliquots: $aliquots) '
+        '{ idList } }')
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_user('times', 'times@example.com', 'pw')
+        local_source()
+        cls.data = generate(patients=1, specimens=1, aliquots=0, boxes=0)
+
+    def arguments(self, times):
+        return dict(aliquot_arguments(self.data), times=times)
+
+    def test_create_aliquot(self):
+        for times, created in ((None, 1), (1, 1), (5, 5)):
+            result = execute(self.user, self.create_aliquot, self.arguments(times))
+            self.assertIsNone(result.errors)
+            self.assertEqual(len(result.data['createAliquot']['idList']), created)
+        for times in (0, -3):
+            before = AliquotModel.objects.count()
+            result = execute(self.user, self.create_aliquot, self.arguments(times))
+            self.assertIn('times must be at least 1', str(result.errors))
+            self.assertEqual(AliquotModel.objects.count(), before)
+
+    def test_create_aliquots(self):
+        result = execute(self.user, self.create_aliquots, {
+            'aliquots': [self.arguments(1), self.arguments(4), self.arguments(None)]})
+        self.assertIsNone(result.errors)
+        self.assertEqual(len(result.data['createAliquots']['idList']), 6)
+        for times in (0, -1):
+            before = AliquotModel.objects.count()
+            result = execute(self.user, self.create_aliquots, {
+                'aliquots': [self.arguments(2), self.arguments(times)]})
+            self.assertIn('times must be at least 1', str(result.errors))
+            self.assertEqual(AliquotModel.objects.count(), before)
+
+
+class CreatePatientsTest(TestCase):
+    """
+        pids already taken, before the batch or while it is inserted
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        local_source()
+        PatientModel.objects.create(pid='P1')
+
+    def test_padded_pid_exists(self):
+        created, errors = bulk_create_patients([{'pid': ' P1 '}, {'pid': 'P2'}])
+        self.assertEqual(created, [None, None])
+        self.assertEqual(errors, [['Patient P1 already exists'], []])
+        self.assertFalse(PatientModel.objects.filter(pid='P2').exists())
+
+    def test_pid_inserted_concurrently(self):
+        # the pre-check misses P1, as when another request inserts it meanwhile
+        filter_patients = PatientModel.objects.filter
+        with mock.patch.object(PatientModel.objects, 'filter', side_effect=[
+                PatientModel.objects.none(), filter_patients(pid__in=['P1', 'P3'])]):
+            created, errors = bulk_create_patients([{'pid': 'P3'}, {'pid': 'P1'}])
+        self.assertEqual(created, [None, None])
+        self.assertEqual(errors, [[], ['Patient P1 already exists']])
+        self.assertFalse(PatientModel.objects.filter(pid='P3').exists())
+
+
+class BarcodeTest(TestCase):
+    """
+        aliquot barcodes: stripped, unique among aliquots and boxes
+    """
+    create_aliquots = (
+        'mutation($aliquots: [AliquotInput]!) { createAliquots(aliquots: $aliquots) '
+        '{ idList } }')
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_user('barcode', 'barcode@example.com', 'pw')
+        local_source()
+        cls.data = generate(patients=1, specimens=1, aliquots=1, boxes=1)
+        AliquotModel.objects.update(barcode='T1')
+        BoxModel.objects.update(barcode='B1')
+
+    def create(self, barcode):
+        return execute(self.user, self.create_aliquots, {
+            'aliquots': [dict(aliquot_arguments(self.data), barcode=barcode)]})
+
+    def test_padded_barcode(self):
+        result = self.create(' T2 ')
+        self.assertIsNone(result.errors)
+        aliquot = AliquotModel.objects.get(pk=result.data['createAliquots']['idList'][0])
+        self.assertEqual(aliquot.barcode, 'T2')
+        self.assertEqual([scan.aliquot for scan in resolve_scans(['T2']).scans], [aliquot])
+        self.assertIn('Barcodes already used: T1', str(self.create('T1 ').errors))
+
+    def test_barcode_inserted_concurrently(self):
+        # the pre-check misses T1, as when another request inserts it meanwhile
+        before = AliquotModel.objects.count()
+        with mock.patch('lims.schema.check_barcodes'):
+            result = self.create('T1')
+        self.assertIn('Barcodes already used: T1', str(result.errors))
+        self.assertEqual(AliquotModel.objects.count(), before)
+
+    def test_box_barcode(self):
+        self.assertIn('Barcodes already used: B1', str(self.create('B1').errors))
+        aliquot = AliquotModel.objects.get(barcode='T1')
+        aliquot.barcode = 'B1'
+        with self.assertRaisesMessage(ValidationError, 'Barcode B1 is used by a box'):
+            aliquot.save()
+        box = BoxModel.objects.get(barcode='B1')
+        box.barcode = ' T1'
+        with self.assertRaisesMessage(ValidationError, 'Barcode T1 is used by an aliquot'):
+            box.save()
+        scans = resolve_scans(['B1', 'T1']).scans
+        self.assertEqual([scan.aliquot for scan in scans], [None, AliquotModel.objects.get(
+            barcode='T1')])
+        self.assertEqual(scans[0].box, BoxModel.objects.get(barcode='B1'))
+
+
+class PlacementTest(TransactionTestCase):
+    """
+        Slot allocation while other transactions hold boxes or take positions
+    """
+
+    def setUp(self):
+        local_source()
+        generate(patients=1, specimens=1, aliquots=4, boxes=0)
+        box_type = BoxTypeModel.objects.create(name='2x2', description='', length=2, height=2)
+        self.box_type = box_type.pk
+        self.box, self.next_box = [
+            BoxModel.objects.create(name=name, box_type=box_type).pk for name in ('A', 'B')]
+        self.aliquots = unplaced_aliquots(4)
+
+    def test_skip_locked(self):
+        locked, release = threading.Event(), threading.Event()
+
+        def hold_box():
+            try:
+                with transaction.atomic():
+                    BoxModel.objects.select_for_update().get(pk=self.box)
+                    locked.set()
+                    release.wait(10)
+            finally:
+                connection.close()
+
+        holder = threading.Thread(target=hold_box)
+        holder.start()
+        try:
+            self.assertTrue(locked.wait(10))
+            slots = place_aliquots(self.aliquots[:2], box_type=self.box_type)
+        finally:
+            release.set()
+            holder.join()
+        self.assertEqual({slot.box_id for slot in slots}, {self.next_box})
+        # the first box is filled again once released
+        slots = place_aliquots(self.aliquots[2:], box_type=self.box_type)
+        self.assertEqual({slot.box_id for slot in slots}, {self.box})
+
+    def test_aliquot_placed_concurrently(self):
+        placing, placed = threading.Event(), threading.Event()
+
+        def place_first():
+            try:
+                with transaction.atomic():
+                    AliquotModel.objects.select_for_update().get(pk=self.aliquots[0])
+                    BoxSlotModel.objects.create(box_id=self.next_box, row_position=1,
+                                                column_position=1, content_id=self.aliquots[0])
+                    placing.set()
+                    placed.wait(0.2)
+            finally:
+                connection.close()
+
+        other = threading.Thread(target=place_first)
+        other.start()
+        try:
+            self.assertTrue(placing.wait(10))
+            # waits for the other placement to commit, then sees its slot
+            with self.assertRaisesMessage(PlacementError, 'already in a box'):
+                place_aliquots(self.aliquots[:2], box=self.box)
+        finally:
+            placed.set()
+            other.join()
+        self.assertFalse(BoxSlotModel.objects.filter(box=self.box).exists())
+
+    def taken_positions(self, stale_calls):
+        """ free_positions answering with a taken position stale_calls times """
+        calls = []
+
+        def positions(count, **kwargs):
+            calls.append(kwargs)
+            if len(calls) <= stale_calls:
+                return [(self.box, 1, 1)][:count]
+            return free_positions(count, **kwargs)
+        return calls, positions
+
+    def test_taken_position_retried(self):
+        place_aliquots(self.aliquots[:1], box=self.box)
+        calls, positions = self.taken_positions(1)
+        with mock.patch('lims.placement.free_positions', positions):
+            slots = place_aliquots(self.aliquots[1:2], box=self.box)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual([(slot.row_position, slot.column_position) for slot in slots], [(1, 2)])
+
+    def test_taken_position_attempts(self):
+        place_aliquots(self.aliquots[:1], box=self.box)
+        calls, positions = self.taken_positions(ATTEMPTS)
+        with mock.patch('lims.placement.free_positions', positions):
+            with self.assertRaisesMessage(PlacementError, 'Positions were taken'):
+                place_aliquots(self.aliquots[1:2], box=self.box)
+        self.assertEqual(len(calls), ATTEMPTS)
+        self.assertEqual(BoxSlotModel.objects.count(), 1)
+
+    def test_positions_outside(self):
+        slot = BoxSlotModel(box_id=self.box, row_position=0, column_position=1,
+                            content_id=self.aliquots[0])
+        with self.assertRaisesMessage(ValidationError, 'Row 0 is outside the box (1-2)'):
+            slot.save()
+        # as stored before positions were checked
+        BoxSlotModel.objects.bulk_create([slot])
+        check_slot_positions = import_module(
+            'lims.migrations.0009_check_slot_positions').check_slot_positions
+        with self.assertRaisesMessage(RuntimeError, '1 box slots are outside their box'):
+            check_slot_positions(apps, None)
+
+
+class SlotLabelTest(TransactionTestCase):
+    """
+        Cached box grids follow the pid, aliquot type and patient of the
+        aliquots in their slots
+    """
+
+    def setUp(self):
+        cache.clear()
+        local_source()
+        self.data = generate(patients=2, specimens=1, aliquots=1, boxes=1)
+        self.slot = BoxSlotModel.objects.select_related(
+            'content__specimen__patient', 'content__type').first()
+        self.assertEqual(self.label(), '{} {} {}'.format(
+            self.slot.content.specimen.patient.pid, self.slot.content.type.type,
+            self.slot.content_id))
+
+    def label(self):
+        grid = get_box_grid(self.slot.box_id, build_box_grid)
+        return grid[self.slot.row_position][self.slot.column_position]
+
+    def test_pid_edited(self):
+        patient = self.slot.content.specimen.patient
+        result = execute(get_user_model().objects.create_user('label', 'l@example.com', 'pw'),
+                         'mutation($id: Int, $pid: String) { editPid(id: $id, pid: $pid) '
+                         '{ pid } }', {'id': patient.pk, 'pid': 'EDITED'})
+        self.assertIsNone(result.errors)
+        self.assertTrue(self.label().startswith('EDITED '))
+
+    def test_aliquot_type_renamed(self):
+        aliquot_type = self.slot.content.type
+        aliquot_type.type = 'Renamed'
+        aliquot_type.save()
+        self.assertIn(' Renamed ', self.label())
+
+    def test_specimen_moved(self):
+        specimen = self.slot.content.specimen
+        other = PatientModel.objects.exclude(pk=specimen.patient_id).first()
+        specimen.patient = other
+        specimen.save()
+        self.assertTrue(self.label().startswith('{} '.format(other.pid)))
+
+
+class SearchPatientsTest(TestCase):
+    """
+        limits of searchPatients and the deprecated searchSpecimen
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_user('search', 'search@example.com', 'pw')
+        local_source()
+        PatientModel.objects.bulk_create(
+            PatientModel(pid='P{:03d}'.format(index), source_id=1) for index in range(60))
+
+    def test_limit(self):
+        for limit, found in ((None, SEARCH_LIMIT), (-5, 1), (0, 1), (3, 3),
+                             (100, MAX_SEARCH_LIMIT)):
+            self.assertEqual(len(search_patients('P0', limit)), found, limit)
+
+    def test_search_specimen(self):
+        result = execute(self.user, '{ searchSpecimen(patient: "P01") { pid } }')
+        self.assertIsNone(result.errors)
+        self.assertEqual(result.data['searchSpecimen'][0]['pid'], 'P010')
+
+
+class Interrupted(Exception):
+    pass
+
+
+class ExportRepositoryTest(TestCase):
+    """
+        Batches of the repository export and resuming the export_repository
+        command after it was interrupted in the middle of a batch
+    """
+    command = 'lims.management.commands.export_repository.'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_user('export', 'export@example.com', 'pw')
+        local_source()
+        generate(patients=5, specimens=2, aliquots=2, boxes=1, shipments=0)
+        PatientModel.objects.create(pid='EMPTY')
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def test_patient_batches(self):
+        patients = list(PatientModel.objects.order_by('pk').values_list('pk', flat=True))
+        self.assertEqual(list(patient_batches(None, 2)), [
+            (None, patients[1]), (patients[1], patients[3]), (patients[3], patients[5])])
+        self.assertEqual(list(patient_batches(patients[3], 5)), [(patients[3], patients[5])])
+        self.assertEqual(list(patient_batches(patients[5], 2)), [])
+
+    def test_repository_rows(self):
+        patients = list(PatientModel.objects.order_by('pk').values_list('pk', flat=True))
+        rows = list(repository_rows(patients[0], patients[2]))
+        # two patients of two specimens of two aliquots
+        self.assertEqual(len(rows), 8)
+        self.assertEqual({row[0] for row in rows}, set(patients[1:3]))
+        self.assertEqual(rows, sorted(rows, key=lambda row: (row[0], row[3], row[6])))
+        # the patient without specimens has a row of its own
+        self.assertEqual(list(repository_rows(patients[4]))[-1][:4],
+                         (patients[5], 'EMPTY', 'local', None))
+        self.assertEqual(len(list(repository_export(None, 2))), 21)
+
+    def interrupted_rows(self, after, until, chunk_size):
+        """ the rows of the second batch, failing after its first row """
+        rows = repository_rows(after, until, chunk_size)
+        self.batches += 1
+        if self.batches == 2:
+            yield next(rows)
+            raise Interrupted()
+        yield from rows
+
+    def export(self, output, export_format, interrupt=False, resume=False):
+        self.batches = 0
+        rows = self.interrupted_rows if interrupt else repository_rows
+        with mock.patch(self.command + 'repository_rows', side_effect=rows):
+            call_command('export_repository', output, format=export_format,
+                         batch_size=2, resume=resume, stdout=io.StringIO())
+
+    def resume(self, output, export_format):
+        """ exports interrupted in the second batch then resumed """
+        checkpoint = output.rstrip('/') + '.checkpoint'
+        with self.assertRaises(Interrupted):
+            self.export(output, export_format, interrupt=True)
+        with open(checkpoint) as checkpoint_file:
+            offset = json.load(checkpoint_file)['offset']
+        if export_format != 'parquet':
+            # part of the interrupted batch was written after the checkpoint
+            self.assertGreater(os.path.getsize(output), offset)
+        self.export(output, export_format, resume=True)
+        self.assertFalse(os.path.exists(checkpoint))
+
+    def test_resume_file(self):
+        for export_format in ('csv', 'ndjson'):
+            complete = os.path.join(self.directory, 'complete.' + export_format)
+            call_command('export_repository', complete, format=export_format,
+                         stdout=io.StringIO())
+            resumed = os.path.join(self.directory, 'resumed.' + export_format)
+            self.resume(resumed, export_format)
+            with open(complete) as complete_file, open(resumed) as resumed_file:
+                self.assertEqual(resumed_file.read(), complete_file.read(), export_format)
+
+    def test_resume_parts(self):
+        def write_parquet(output, columns, types, rows, chunk_size):
+            with open(output, 'w') as part:
+                for row in rows:
+                    part.write(json.dumps(row, default=str) + '\n')
+                    yield 1
+
+        output = os.path.join(self.directory, 'parts')
+        with mock.patch(self.command + 'parquet_available', return_value=True), \
+                mock.patch(self.command + 'write_parquet', side_effect=write_parquet):
+            self.resume(output, 'parquet')
+        patients = list(PatientModel.objects.order_by('pk').values_list('pk', flat=True))
+        parts = sorted(glob.glob(os.path.join(output, '*')))
+        self.assertEqual([os.path.basename(part) for part in parts], [
+            'patients-{:010d}.parquet'.format(pk) for pk in patients[1::2]])
+        exported = []
+        for part in parts:
+            with open(part) as part_file:
+                exported.extend(json.loads(line) for line in part_file)
+        self.assertEqual(exported, json.loads(json.dumps(
+            list(repository_export(None, 2)), default=str)))
+
+    def test_resume_other_format(self):
+        output = os.path.join(self.directory, 'export.csv')
+        with self.assertRaises(Interrupted):
+            self.export(output, 'csv', interrupt=True)
+        with self.assertRaisesMessage(CommandError, 'is a csv export, not ndjson'):
+            call_command('export_repository', output, format='ndjson', resume=True)
+
+    def test_view_staff_only(self):
+        client = Client()
+        client.force_login(self.user)
+        self.assertEqual(client.get('/export/').status_code, 403)
+        self.user.is_staff = True
+        self.user.save()
+        response = client.get('/export/?format=ndjson')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(b''.join(response.streaming_content).splitlines()), 21)
+
+    def test_manifest_view(self):
+        client = Client()
+        client.force_login(self.user)
+        shipment = ShipmentModel.objects.create()
+        response = client.get('/manifest/{}/'.format(shipment.pk))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content).count(b'\n'), 1)
+        response = client.get('/manifest/{}/'.format(shipment.pk + 1))
+        self.assertEqual(response.status_code, 404)
+
+
+class GridDiffTest(SimpleTestCase):
+    """
+        Updates sent to the live subscribers of a box
+    """
+    grid = {'name': 'box', 'description': None, 1: {1: 'P1 PLASMA 1', 2: 'P1 PLASMA 2'}}
+
+    def test_first_grid(self):
+        self.assertEqual(grid_diff(None, self.grid), {
+            'name': 'box', 'description': None, 'slots': [
+                {'row': 1, 'column': 1, 'content': 'P1 PLASMA 1'},
+                {'row': 1, 'column': 2, 'content': 'P1 PLASMA 2'}]})
+
+    def test_unchanged(self):
+        self.assertEqual(grid_diff(self.grid, dict(self.grid)), {'slots': []})
+
+    def test_changed_slots(self):
+        grid = {'name': 'renamed', 'description': None,
+                1: {2: 'P2 SERUM 3'}, 2: {1: 'P1 PLASMA 1'}}
+        self.assertEqual(grid_diff(self.grid, grid), {'name': 'renamed', 'slots': [
+            {'row': 1, 'column': 1, 'content': None},
+            {'row': 1, 'column': 2, 'content': 'P2 SERUM 3'},
+            {'row': 2, 'column': 1, 'content': 'P1 PLASMA 1'}]})
+
+
+class SplitRootFieldsTest(SimpleTestCase):
+    """
+        Queries cut into one document per root field by split_root_fields
+    """
+
+    def split(self, query, operation_name=None):
+        parts = split_root_fields(parse(query), operation_name)
+        return None if parts is None else [print_ast(part) for part in parts]
+
+    def test_split(self):
+        parts = self.split('query($first: Int) { events: allEvents { ...Event } '
+                           'allPatients(first: $first) { pid } } '
+                           'fragment Event on EventType { event }')
+        self.assertEqual(len(parts), 2)
+        self.assertIn('events: allEvents', parts[0])
+        self.assertNotIn('allPatients', parts[0])
+        self.assertIn('allPatients(first: $first)', parts[1])
+        for part in parts:
+            self.assertIn('query ($first: Int)', part)
+            self.assertIn('fragment Event on EventType', part)
+        self.assertEqual(len(self.split('query A { me { id } } '
+                                        'query B { allEvents { id } allVisits { id } }', 'B')), 2)
+
+    def test_not_split(self):
+        for query, operation_name in (
+                ('{ allEvents { id } }', None),
+                ('mutation { logout { id } refreshToken { token } }', None),
+                ('{ allEvents { id } allEvents { event } }', None),
+                ('{ ...Root allVisits { id } } fragment Root on Query { me { id } }', None),
+                ('query A { me { id } } query B { allEvents { id } allVisits { id } }', 'A'),
+                ('query A { me { id } } query B { allEvents { id } allVisits { id } }', None)):
+            self.assertIsNone(self.split(query, operation_name), query)
+
+
+class RefusingMiddleware(MiddlewareMixin):
+    """
+        answers the requests sent with X-Refuse from its view hook, and
+        raises PermissionDenied for those sent with X-Deny
+    """
+
+    def process_view(self, request, callback, callback_args, callback_kwargs):
+        if 'HTTP_X_REFUSE' in request.META:
+            return HttpResponse(str(getattr(callback, 'csrf_exempt', False)), status=403)
+        if 'HTTP_X_DENY' in request.META:
+            raise PermissionDenied
+        return None
+
+
+class GraphQLConsumerTest(TransactionTestCase):
+    """
+        Root fields of a query executed concurrently by the ASGI /graphql/
+    """
+    # queries read from the replica outside a transaction (lims/database.py)
+    databases = {'default', 'replica'}
+    query = ('query($first: Int) { me { username } allEvents { event } '
+             'allPatientsConnection(first: $first) { edges { node { pid } } } '
+             'searchAliquots(storage: -1) { edges { node { id } } } }')
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('async', 'async@example.com', 'pw')
+        local_source()
+        generate(patients=3, specimens=0, aliquots=0, boxes=0)
+        # built again with the middleware of the test
+        GraphQLConsumer.handler = None
+        self.addCleanup(setattr, GraphQLConsumer, 'handler', None)
+
+    @classmethod
+    def tearDownClass(cls):
+        # worker threads keep their connections to the test database
+        shutdown_executor()
+        super().tearDownClass()
+
+    def body(self):
+        return json.dumps({'query': self.query, 'variables': {'first': 2}})
+
+    def post(self, headers=(), host=b'testserver'):
+        communicator = HttpCommunicator(
+            application, 'POST', '/graphql/', body=self.body().encode(), headers=[
+                (b'host', host),
+                (b'content-type', b'application/json'),
+                (b'authorization', 'JWT {}'.format(get_token(self.user)).encode()),
+            ] + list(headers))
+        return async_to_sync(communicator.get_response)(timeout=10)
+
+    def counting_parts(self, delay=0):
+        """ patches execute_part, returns [calls, most parts running at once] """
+        counts = [0, 0]
+        running = []
+        lock = threading.Lock()
+        execute_part = GraphQLConsumer.execute_part
+
+        def counting(consumer, *args):
+            with lock:
+                counts[0] += 1
+                running.append(None)
+                counts[1] = max(counts[1], len(running))
+            try:
+                time.sleep(delay)
+                return execute_part(consumer, *args)
+            finally:
+                with lock:
+                    running.pop()
+
+        patcher = mock.patch.object(GraphQLConsumer, 'execute_part', counting)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return counts
+
+    def test_merged_like_serial(self):
+        counts = self.counting_parts()
+        response = self.post()
+        self.assertEqual(response['status'], 200)
+        self.assertEqual(counts[0], 4)
+        parallel = json.loads(response['body'])
+        serial = Client().post(
+            '/graphql/', self.body(), content_type='application/json',
+            HTTP_AUTHORIZATION='JWT {}'.format(get_token(self.user))).json()
+        self.assertEqual(parallel, serial)
+        self.assertEqual(list(parallel['data']), [
+            'me', 'allEvents', 'allPatientsConnection', 'searchAliquots'])
+        self.assertEqual(parallel['data']['me'], {'username': 'async'})
+        self.assertEqual([error['path'] for error in parallel['errors']], [['searchAliquots']])
+
+    def test_concurrent_fields(self):
+        for limit in (1, 2):
+            with override_settings(GRAPHENE=dict(settings.GRAPHENE, ASYNC=dict(
+                    settings.GRAPHENE['ASYNC'], MAX_CONCURRENT_FIELDS=limit))):
+                counts = self.counting_parts(delay=0.05)
+                self.assertEqual(self.post()['status'], 200)
+            self.assertEqual(counts, [4, limit])
+
+    def test_view_middleware(self):
+        with override_settings(MIDDLEWARE=settings.MIDDLEWARE + ['lims.tests.RefusingMiddleware']):
+            counts = self.counting_parts()
+            response = self.post([(b'x-refuse', b'1')])
+            # called with the csrf exempt /graphql/ view
+            self.assertEqual((response['status'], response['body']), (403, b'True'))
+            self.assertEqual(counts[0], 0)
+            self.assertEqual(self.post()['status'], 200)
+            self.assertEqual(counts[0], 4)
+
+    def test_middleware_exceptions(self):
+        counts = self.counting_parts()
+        with override_settings(ALLOWED_HOSTS=['testserver']):
+            # DisallowedHost raised by CommonMiddleware
+            self.assertEqual(self.post(host=b'elsewhere.example')['status'], 400)
+        GraphQLConsumer.handler = None
+        with override_settings(MIDDLEWARE=settings.MIDDLEWARE + ['lims.tests.RefusingMiddleware']):
+            self.assertEqual(self.post([(b'x-deny', b'1')])['status'], 403)
+        self.assertEqual(counts[0], 0)
+
+
+class LiveConsumerTest(TransactionTestCase):
+    """
+        /live/ box subscriptions, through the ASGI application
+    """
+
+    @classmethod
+    def tearDownClass(cls):
+        shutdown_executor()
+        super().tearDownClass()
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('live', 'live@example.com', 'pw')
+        local_source()
+        self.data = generate(patients=1, specimens=1, aliquots=2, boxes=0)
+        box_type = BoxTypeModel.objects.create(name='live', description='', length=9, height=9)
+        self.box = BoxModel.objects.create(name='live', box_type=box_type).pk
+        cache.clear()
+
+    async def connect(self):
+        communicator = WebsocketCommunicator(application, '/live/')
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def subscribe(self, communicator, boxes):
+        await communicator.send_json_to({
+            'token': get_token(self.user), 'subscribe': {'boxes': boxes}})
+
+    def test_box_updates(self):
+        async def run():
+            communicator = await self.connect()
+            await self.subscribe(communicator, [self.box])
+            self.assertEqual(await communicator.receive_json_from(),
+                             {'box': self.box, 'name': 'live', 'description': None, 'slots': []})
+
+            slot = await sync_to_async(BoxSlotModel.objects.create)(
+                box_id=self.box, content_id=self.data.aliquots[0],
+                row_position=1, column_position=2)
+            update = await communicator.receive_json_from()
+            self.assertEqual(update['box'], self.box)
+            self.assertEqual([(change['row'], change['column']) for change in update['slots']],
+                             [(1, 2)])
+            self.assertIsNotNone(update['slots'][0]['content'])
+
+            # a grid left in the cache of this process by a change made in
+            # another one: the update is read from the database
+            cache.set(box_grid_key(self.box), {'name': 'stale', 'description': None})
+            await sync_to_async(BoxSlotModel.objects.filter(pk=slot.pk).update)(row_position=3)
+            await sync_to_async(publish_boxes)([self.box])
+            update = await communicator.receive_json_from()
+            self.assertEqual([(change['row'], change['column'], change['content'] is None)
+                              for change in update['slots']], [(1, 2, True), (3, 2, False)])
+            self.assertNotIn('name', update)
+
+            await sync_to_async(BoxModel.objects.filter(pk=self.box).delete)()
+            self.assertEqual(await communicator.receive_json_from(),
+                             {'box': self.box, 'deleted': True})
+            await communicator.disconnect()
+        async_to_sync(run)()
+
+    def test_subscription_limit(self):
+        async def run():
+            communicator = await self.connect()
+            await self.subscribe(communicator, list(range(1, MAX_BOXES + 2)))
+            self.assertEqual(await communicator.receive_json_from(), {
+                'error': 'At most {} boxes can be subscribed'.format(MAX_BOXES)})
+            self.assertTrue(await communicator.receive_nothing())
+            await communicator.disconnect()
+        async_to_sync(run)()
+
+
+class PersistedQueryTest(TestCase):
+    """
+        Queries sent as the hash of a registered document
+    """
+    query = '{ allEvents { event } }'
+
+    def setUp(self):
+        cache.clear()
+        EventModel.objects.create(event='persisted', order=1)
+        patcher = mock.patch('lims.views.get_persisted_query', side_effect={
+            query_hash(self.query): self.query}.get)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get(self, extensions):
+        return Client().get('/graphql/', {'extensions': extensions},
+                            HTTP_ACCEPT='application/json')
+
+    def test_registered_hash(self):
+        response = self.get(json.dumps(
+            {'persistedQuery': {'version': 1, 'sha256Hash': query_hash(self.query)}}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'data': {'allEvents': [{'event': 'persisted'}]}})
+
+    def test_unknown_hash(self):
+        response = self.get(json.dumps(
+            {'persistedQuery': {'version': 1, 'sha256Hash': query_hash('{ me { id } }')}}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'errors': [{
+            'message': 'PersistedQueryNotFound',
+            'extensions': {'code': 'PERSISTED_QUERY_NOT_FOUND'}}]})
+
+    def test_invalid_extensions(self):
+        for extensions in ('{', '[1]', '"hash"', '{"persistedQuery": 1}'):
+            self.assertEqual(self.get(extensions).status_code, 400, extensions)
+
+
+def telemetry_settings(**telemetry):
+    return override_settings(GRAPHENE=dict(settings.GRAPHENE, TELEMETRY=telemetry))
+
+
+class TelemetryTest(SimpleTestCase):
+    """
+        Sampling and access to /metrics
+    """
+    document = parse('{ me { id } }')
+
+    def test_sampled_by_default(self):
+        self.assertLess(TELEMETRY_DEFAULTS['SAMPLE_RATE'], 1)
+        with telemetry_settings(), mock.patch('lims.telemetry.random.random', return_value=0.5):
+            self.assertIsNone(start_recording(None, self.document, None))
+        with telemetry_settings(), mock.patch('lims.telemetry.random.random', return_value=0.05):
+            self.assertEqual(start_recording(None, self.document, None).operation_type, 'query')
+        with telemetry_settings(SAMPLE_RATE=0), \
+                mock.patch('lims.telemetry.random.random', return_value=0):
+            self.assertIsNone(start_recording(None, self.document, None))
+
+    def test_metrics_without_token(self):
+        with telemetry_settings():
+            self.assertEqual(Client().get('/metrics').status_code, 403)
+            with override_settings(DEBUG=True):
+                self.assertEqual(Client().get('/metrics').status_code, 200)
+
+    def test_metrics_token(self):
+        with telemetry_settings(METRICS_TOKEN='secret'):
+            self.assertEqual(Client().get('/metrics').status_code, 401)
+            self.assertEqual(Client().get(
+                '/metrics', HTTP_AUTHORIZATION='Bearer wrong').status_code, 401)
+            response = Client().get('/metrics', HTTP_AUTHORIZATION='Bearer secret')
+            self.assertEqual(response.status_code, 200)
+            self.assertIn(b'lims_telemetry_sample_rate 0.1', response.content)
+
+
+class RefreshQueueTest(TransactionTestCase):
+    """
+        Ids queued by a transaction are refreshed once, when it commits
+    """
+
+    def setUp(self):
+        self.refreshed = []
+        self.queue = RefreshQueue(self.refreshed.append, 2)
+
+    def test_one_refresh_per_transaction(self):
+        with transaction.atomic():
+            self.queue.add([3, 1])
+            self.queue.add([2, None, 1])
+            self.assertEqual(self.refreshed, [])
+        self.assertEqual(self.refreshed, [[1, 2], [3]])
+
+    def test_outside_transaction(self):
+        self.queue.add([1])
+        self.queue.add([2])
+        self.assertEqual(self.refreshed, [[1], [2]])
+
+    def test_rolled_back_transaction(self):
+        with self.assertRaises(Interrupted), transaction.atomic():
+            self.queue.add([1])
+            raise Interrupted()
+        with transaction.atomic():
+            self.queue.add([2])
+        self.assertEqual(self.refreshed, [[2]])
+
+    def test_rolled_back_savepoint(self):
+        with transaction.atomic():
+            with self.assertRaises(Interrupted), transaction.atomic():
+                self.queue.add([1])
+                raise Interrupted()
+            self.queue.add([2])
+        self.assertEqual(self.refreshed, [[2]])
+
+
+class ScheduleNameTest(TestCase):
+    """
+        Renaming an event or specimen type refreshes the draw grid of the
+        patients it can affect, not of every patient
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        local_source()
+        blood = SpecimenType.objects.create(type='Blood')
+        SpecimenType.objects.create(type='Urine')
+        EventModel.objects.create(event='baseline', order=1)
+        EventModel.objects.create(event='week 1', order=2)
+        baseline = ScheduleModel.objects.create(name='baseline', schedule={'baseline': ['Blood']})
+        weekly = ScheduleModel.objects.create(name='weekly', schedule={'week 1': ['Urine']})
+        cls.on_baseline = PatientModel.objects.create(pid='BASE', draw_schedule=baseline)
+        cls.on_weekly = PatientModel.objects.create(pid='WEEK', draw_schedule=weekly)
+        cls.collected = PatientModel.objects.create(pid='COLL')
+        PatientModel.objects.create(pid='NONE')
+        specimen = SpecimenModel.objects.create(
+            patient=cls.collected, type=blood, collectdate='2020-01-01', collecttime='10:00')
+        AliquotModel.objects.create(
+            specimen=specimen, type=AliquotType.objects.create(type='Plasma', units='ml'),
+            visit=VisitModel.objects.create(label='week 1'), collectdate='2020-01-01T10:00Z',
+            collecttime='10:00', volume=1)
+
+    def queued(self, change):
+        patient_ids = set()
+        with mock.patch('lims.signals.refresh_draw_grid_on_commit',
+                        side_effect=patient_ids.update):
+            change()
+        return patient_ids
+
+    def test_event_renamed(self):
+        week = EventModel.objects.get(event='week 1')
+        week.event = 'week one'
+        self.assertEqual(self.queued(week.save), {self.on_weekly.pk, self.collected.pk})
+
+    def test_event_reordered(self):
+        week = EventModel.objects.get(event='week 1')
+        week.order = 5
+        self.assertEqual(self.queued(week.save), set())
+
+    def test_specimen_type_renamed(self):
+        blood = SpecimenType.objects.get(type='Blood')
+        blood.type = 'Whole blood'
+        self.assertEqual(self.queued(blood.save), {self.on_baseline.pk})
+
+    def test_invalid_schedules(self):
+        check_schedules = import_module(
+            'lims.migrations.0012_check_schedules').check_schedules
+        check_schedules(apps, None)
+        # as stored before schedules were validated
+        ScheduleModel.objects.bulk_create([
+            ScheduleModel(name='listed', schedule=['Blood']),
+            ScheduleModel(name='renamed', schedule={'baseline': ['Serum']}),
+        ])
+        with self.assertRaisesMessage(RuntimeError, '2 schedules do not map known events '
+                                                    'to known specimen type names (listed, renamed)'):
+            check_schedules(apps, None)
+
+
+class InventoryTest(TransactionTestCase):
+    """
+        The inventory rollup matches the aliquots after changes made
+        through each signal path, once their transaction commits
+    """
+
+    def setUp(self):
+        local_source()
+        self.data = generate(patients=3, specimens=2, aliquots=2, storage_depth=2, boxes=2,
+                             shipments=0)
+        self.box, self.empty_box = BoxModel.objects.filter(pk__in=self.data.boxes).order_by('pk')
+        self.visit = VisitModel.objects.first()
+        self.assert_inventory()
+
+    def assert_inventory(self):
+        fields = ['specimen__patient', 'specimen__type', 'type', 'visit',
+                  'boxslotmodel__box__storage_location']
+        expected = AliquotModel.objects.values(*fields).annotate(
+            aliquot_total=Count('id'), volume_total=Sum('volume')).order_by(*fields)
+        self.assertEqual(
+            [tuple(row[dimension] for dimension in DIMENSIONS) + (row['aliquots'], row['volume'])
+             for row in inventory_totals(DIMENSIONS)],
+            [tuple(row[field] for field in fields) + (row['aliquot_total'], row['volume_total'])
+             for row in expected])
+
+    def create_aliquot(self, specimen):
+        return AliquotModel.objects.create(
+            specimen_id=specimen, type=AliquotType.objects.first(), visit=self.visit,
+            collectdate=timezone.now(), collecttime='10:00', volume=2.5)
+
+    def test_aliquot_changes(self):
+        aliquot = self.create_aliquot(self.data.specimens[0])
+        self.assert_inventory()
+        aliquot.volume = 4
+        aliquot.visit = VisitModel.objects.last()
+        aliquot.save()
+        self.assert_inventory()
+        # to a specimen of another patient
+        aliquot.specimen_id = self.data.specimens[-1]
+        aliquot.save()
+        self.assert_inventory()
+        aliquot.delete()
+        self.assert_inventory()
+
+    def test_slot_changes(self):
+        aliquot = self.create_aliquot(self.data.specimens[0])
+        slot = BoxSlotModel.objects.create(
+            box=self.empty_box, content=aliquot, row_position=1, column_position=1)
+        self.assert_inventory()
+        # a filled slot moved to the box of another storage object
+        slot = BoxSlotModel.objects.filter(box=self.box).first()
+        slot.box = self.empty_box
+        slot.row_position = 2
+        slot.save()
+        self.assert_inventory()
+        slot.delete()
+        self.assert_inventory()
+
+    def test_box_relocated(self):
+        self.box.storage_location = StorageModel.objects.filter(
+            container__isnull=True).first()
+        self.box.save()
+        self.assert_inventory()
+
+    def test_storage_deleted(self):
+        self.box.storage_location.delete()
+        self.assert_inventory()
+
+    def test_visit_deleted(self):
+        self.visit.delete()
+        self.assert_inventory()
+
+    def test_unknown_storage(self):
+        with self.assertRaisesMessage(Exception, 'Storage 0 does not exist'):
+            inventory_totals([], storage=0)
+
+
+class ChangesSinceTest(TestCase):
+    """
+        Keyset pages of changesSince across rows sharing a modify_date,
+        deletions and the settle delay
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        local_source()
+        cls.changed = timezone.now() - datetime.timedelta(minutes=5)
+        PatientModel.objects.bulk_create(
+            PatientModel(pid='C{}'.format(index), source_id=1) for index in range(5))
+        # the same modify_date for every patient, pages are told apart by id
+        PatientModel.objects.update(modify_date=cls.changed)
+        cls.patients = list(PatientModel.objects.order_by('pk').values_list('pk', flat=True))
+
+    def sync(self, cursor=None, now=None):
+        """ returns (pages of patient ids, deleted ids, last cursor) until has_more is false """
+        pages, deleted = [], []
+        while True:
+            changes = changes_since(cursor=cursor, limit=2, now=now)
+            pages.append([patient.pk for patient in changes.patients])
+            deleted.extend(tombstone.object_id for tombstone in changes.deleted)
+            cursor = changes.cursor
+            if not changes.has_more:
+                return pages, deleted, cursor
+
+    def test_equal_modify_dates(self):
+        pages, deleted, cursor = self.sync()
+        self.assertEqual(pages, [self.patients[:2], self.patients[2:4], self.patients[4:]])
+        self.assertEqual(deleted, [])
+        self.assertEqual(self.sync(cursor), ([[]], [], cursor))
+
+    def test_deletions(self):
+        _, _, cursor = self.sync()
+        PatientModel.objects.filter(pk__in=self.patients[1:4]).delete()
+        # tombstones settle like changed rows
+        self.assertEqual(self.sync(cursor)[:2], ([[]], []))
+        later = timezone.now() + datetime.timedelta(seconds=SETTLE_SECONDS)
+        pages, deleted, _ = self.sync(cursor, now=later)
+        self.assertEqual(pages, [[], []])
+        self.assertEqual(sorted(deleted), self.patients[1:4])
+
+    def test_settle_delay(self):
+        settle = datetime.timedelta(seconds=SETTLE_SECONDS)
+        self.assertEqual(self.sync(now=self.changed + settle)[0], [[]])
+        self.assertEqual(
+            sum(self.sync(now=self.changed + settle + datetime.timedelta(seconds=1))[0], []),
+            self.patients)
+
+    def test_bulk_create_sets_modify_date(self):
+        _, _, cursor = self.sync()
+        created = PatientModel.objects.bulk_create([PatientModel(pid='NEW', source_id=1)])
+        later = timezone.now() + datetime.timedelta(seconds=SETTLE_SECONDS)
+        self.assertEqual(self.sync(cursor, now=later)[0], [[created[0].pk]])
+
+
+class PatientSyncTest(TestCase):
+    """
+        Patients of an external source, reconciled by pid with the upsert
+        of lims/sync.py
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.local = local_source()
+        cls.external = SourceModel.objects.create(name='external')
+        cls.unsynced = PatientModel.objects.create(pid='LOCAL', source=cls.local)
+        cls.synced = PatientModel.objects.create(pid='SYNCED', source=cls.external)
+
+    def test_upsert_tells_inserts_from_updates(self):
+        rows = upsert_patients(self.external.pk, ['NEW', 'LOCAL', 'SYNCED'])
+        inserted = {pid: was_inserted for _, pid, was_inserted in rows}
+        # xmax = 0 for the inserted row only, the synced patient is not returned
+        self.assertEqual(inserted, {'NEW': True, 'LOCAL': False})
+        patient = PatientModel.objects.get(pk=self.unsynced.pk)
+        self.assertEqual((patient.synced, patient.source_id), (True, self.external.pk))
+
+    def test_sync_patients(self):
+        queued = set()
+        with mock.patch('lims.sync.refresh_draw_grid_on_commit', side_effect=queued.update):
+            result = sync_patients(self.external, ['NEW', ' LOCAL ', 'SYNCED', '', 'NEW'])
+        self.assertEqual(result, SyncResult(inserted=1, synced=1, unchanged=1, skipped=2))
+        # the upsert sends no post_save, the draw grid is queued by the sync
+        self.assertEqual(queued, {PatientModel.objects.get(pid='NEW').pk, self.unsynced.pk})
+
+    def test_save_external(self):
+        patient = PatientModel(pid='NEW', source=self.external)
+        patient.save()
+        self.assertTrue(PatientModel.objects.filter(pk=patient.pk, synced=True).exists())
+        patient = PatientModel(pid='LOCAL', source=self.external)
+        patient.save()
+        self.assertEqual(patient.pk, self.unsynced.pk)
+        with self.assertRaisesMessage(IntegrityError, 'SYNCED already exists and is synced'):
+            PatientModel(pid='SYNCED', source=self.external).save()
+
+    def test_create_synced_patient(self):
+        user = get_user_model().objects.create_user('sync', 'sync@example.com', 'pw')
+        create_patient = (
+            'mutation($pid: String, $source: Int) { createPatient(pid: $pid, source: $source) '
+            '{ pid synced } }')
+        result = execute(user, create_patient, {'pid': 'LOCAL', 'source': self.external.pk})
+        self.assertIsNone(result.errors)
+        self.assertEqual(result.data['createPatient'], {'pid': 'LOCAL', 'synced': True})
+        result = execute(user, create_patient, {'pid': 'SYNCED', 'source': self.external.pk})
+        self.assertEqual([str(error) for error in result.errors],
+                         ['Patient SYNCED already exists'])
+        self.assertEqual(PatientModel.objects.filter(pid='SYNCED').count(), 1)
+
+    def test_update_reads_no_source(self):
+        patient = PatientModel.objects.get(pk=self.unsynced.pk)
+        patient.pid = 'RENAMED'
+        with CaptureQueriesContext(connection) as captured:
+            patient.save()
+        self.assertFalse([query for query in captured if 'lims_sourcemodel' in query['sql']])
+
+
+@override_settings(DATABASE_HEALTH_CHECK_INTERVAL=30)
+class ReplicaRouterTest(SimpleTestCase):
+    """
+        Reads of GraphQL queries go to the replica, unless the client wrote
+        recently or the replica is down; connections are health checked
+    """
+
+    def setUp(self):
+        patcher = mock.patch('lims.database._replica_down_until', 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.router = ReplicaRouter()
+
+    def read_alias(self, request, operation_type='query'):
+        with route_operation(request, operation_type):
+            return self.router.db_for_read(PatientModel)
+
+    def test_routes(self):
+        request = RequestFactory().post('/graphql/')
+        with mock.patch('lims.database.replica_available', return_value=True):
+            self.assertEqual(self.read_alias(request), 'replica')
+            with mock.patch.object(connections['default'], 'in_atomic_block', True):
+                self.assertIsNone(self.read_alias(request))
+            self.assertIsNone(self.read_alias(request, 'mutation'))
+            self.assertTrue(request.lims_wrote)
+            # the client wrote a moment ago
+            request = RequestFactory().post('/graphql/')
+            request.COOKIES[STICKY_COOKIE] = '1'
+            self.assertIsNone(self.read_alias(request))
+        self.assertEqual(self.router.db_for_write(PatientModel), 'default')
+        self.assertFalse(self.router.allow_migrate('replica', 'lims'))
+
+    def test_sticky_cookie(self):
+        middleware = ReplicaStickinessMiddleware()
+        request = RequestFactory().post('/graphql/')
+        self.assertNotIn(STICKY_COOKIE, middleware.process_response(
+            request, HttpResponse()).cookies)
+        request.lims_wrote = True
+        with override_settings(DATABASE_STICKY_SECONDS=5):
+            cookie = middleware.process_response(request, HttpResponse()).cookies[STICKY_COOKIE]
+        self.assertEqual(cookie['max-age'], 5)
+
+    def test_replica_down(self):
+        replica = connections['replica']
+        request = RequestFactory().post('/graphql/')
+        with mock.patch.object(replica, 'connection', None), mock.patch.object(
+                replica, 'ensure_connection', side_effect=OperationalError) as connect, \
+                mock.patch('time.monotonic', return_value=1000):
+            self.assertIsNone(self.read_alias(request))
+            # not tried again before the next health check
+            self.assertIsNone(self.read_alias(request))
+            self.assertEqual(connect.call_count, 1)
+        with mock.patch.object(replica, 'connection', None), mock.patch.object(
+                replica, 'ensure_connection') as connect, \
+                mock.patch('time.monotonic', return_value=1000 + 31):
+            self.assertEqual(self.read_alias(request), 'replica')
+            self.assertEqual(connect.call_count, 1)
+
+    def test_check_connections(self):
+        dead = types.SimpleNamespace(
+            connection=object(), in_atomic_block=False, is_usable=mock.Mock(return_value=False),
+            close=mock.Mock())
+        busy = types.SimpleNamespace(
+            connection=object(), in_atomic_block=True, is_usable=mock.Mock(), close=mock.Mock())
+        with mock.patch('lims.database.connections') as all_connections, \
+                mock.patch('time.monotonic', side_effect=[100, 110, 131]):
+            all_connections.all.return_value = [dead, busy]
+            for _ in range(3):
+                check_connections()
+        # checked at 100 and 131, not at 110 (DATABASE_HEALTH_CHECK_INTERVAL)
+        self.assertEqual(dead.is_usable.call_count, 2)
+        self.assertEqual(dead.close.call_count, 2)
+        self.assertEqual(dead.lims_checked_at, 131)
+        busy.is_usable.assert_not_called()
+
+
+class ReadYourWritesTest(TransactionTestCase):
+    """
+        After a mutation, the queries of the client read from the primary
+    """
+    databases = {'default', 'replica'}
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('sticky', 'sticky@example.com', 'pw')
+        local_source()
+
+    def post(self, client, query):
+        with CaptureQueriesContext(connections['replica']) as replica_queries:
+            response = client.post(
+                '/graphql/', json.dumps({'query': query}), content_type='application/json',
+                HTTP_AUTHORIZATION='JWT {}'.format(get_token(self.user)))
+        self.assertNotIn('errors', response.json())
+        return response, len(replica_queries)
+
+    def test_read_after_write(self):
+        query = '{ allPatientsConnection { edges { node { pid } } } }'
+        client = Client()
+        _, replica_queries = self.post(client, query)
+        self.assertGreater(replica_queries, 0)
+        response, replica_queries = self.post(
+            client, 'mutation { createPatient(pid: "STICKY") { pid } }')
+        self.assertEqual(replica_queries, 0)
+        self.assertIn(STICKY_COOKIE, response.cookies)
+        # the cookie is sent back by the client
+        response, replica_queries = self.post(client, query)
+        self.assertEqual(replica_queries, 0)
+        self.assertEqual(response.json()['data']['allPatientsConnection']['edges'],
+                         [{'node': {'pid': 'STICKY'}}])
+        # another client reads from the replica
+        _, replica_queries = self.post(Client(), query)
+        self.assertGreater(replica_queries, 0)
+
+
+class StoragePathTest(TestCase):
+    """
+        Materialized storage paths: any depth, only recomputed on a move
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.building = StorageModel.objects.create(name='building', description='')
+        cls.room = StorageModel.objects.create(
+            name='room', description='', container=cls.building)
+        cls.freezer = StorageModel.objects.create(
+            name='freezer', description='', container=cls.room)
+
+    def test_deep_path(self):
+        container = self.freezer
+        for depth in range(100):
+            container = StorageModel.objects.create(
+                name='rack {}'.format(depth), description='', container=container)
+        path = StorageModel.objects.get(pk=container.pk).path
+        self.assertGreater(len(path), 255)
+        self.assertEqual(path, container.path)
+        self.assertEqual(StorageModel.objects.get(pk=container.pk).ancestor_ids()[:3],
+                         [self.building.pk, self.room.pk, self.freezer.pk])
+
+    def test_save_not_moved(self):
+        freezer = StorageModel.objects.get(pk=self.freezer.pk)
+        # its room moves meanwhile
+        other = StorageModel.objects.create(name='other', description='')
+        room = StorageModel.objects.get(pk=self.room.pk)
+        room.container = other
+        room.save()
+
+        freezer.name = 'renamed'
+        with CaptureQueriesContext(connection) as captured:
+            freezer.save()
+        self.assertEqual(len(captured), 1)
+        self.assertNotIn('"path"', captured[0]['sql'])
+        freezer = StorageModel.objects.get(pk=self.freezer.pk)
+        self.assertEqual((freezer.name, freezer.path), (
+            'renamed', '/{}/{}/{}/'.format(other.pk, self.room.pk, self.freezer.pk)))
+
+        # moved back to the top
+        freezer.container = None
+        freezer.save()
+        self.assertEqual(StorageModel.objects.get(pk=self.freezer.pk).path,
+                         '/{}/'.format(self.freezer.pk))
+
+    def test_move_all_or_nothing(self):
+        room = StorageModel.objects.get(pk=self.room.pk)
+        room.container = StorageModel.objects.get(pk=self.freezer.pk)
+        with self.assertRaisesMessage(ValidationError, 'cannot be placed inside itself'):
+            room.save()
+        other = StorageModel.objects.create(name='other', description='')
+        room = StorageModel.objects.get(pk=self.room.pk)
+        room.container = other
+        # the subtree update fails after the row was saved
+        with mock.patch('lims.models.storage.Replace', side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                room.save()
+        self.assertEqual(
+            list(StorageModel.objects.filter(pk__in=[self.room.pk, self.freezer.pk]).order_by(
+                'pk').values_list('container', 'path')),
+            [(self.building.pk, '/{}/{}/'.format(self.building.pk, self.room.pk)),
+             (self.room.pk, '/{}/{}/{}/'.format(self.building.pk, self.room.pk, self.freezer.pk))])
+
+    def test_rebuild_migration(self):
+        StorageModel.objects.update(path='')
+        rebuild_storage_paths = import_module(
+            'lims.migrations.0011_rebuild_storage_paths').rebuild_storage_paths
+        rebuild_storage_paths(apps, None)
+        self.assertEqual(StorageModel.objects.get(pk=self.freezer.pk).path,
+                         '/{}/{}/{}/'.format(self.building.pk, self.room.pk, self.freezer.pk))
+        self.assertEqual(StorageModel.objects.get(pk=self.building.pk).path,
+                         '/{}/'.format(self.building.pk))
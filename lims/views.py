@@ -0,0 +1,178 @@
+import json
+
+from django.conf import settings
+from django.http import (
+    HttpResponse, HttpResponseBadRequest, HttpResponseNotFound, StreamingHttpResponse)
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.views.decorators.http import require_GET
+from graphene_django.views import GraphQLView, HttpError
+
+from lims.exports import (
+    MANIFEST_COLUMNS, REPOSITORY_COLUMNS, STREAM_FORMATS, manifest_rows, parquet_available,
+    repository_export, stream_parquet)
+from lims.models.shipping import ShipmentModel
+from lims.persisted_queries import get_persisted_query, is_registered, persisted_only
+from lims.telemetry import collect, get_telemetry_settings, render_prometheus
+
+
+def patch_revalidation(request, response):
+    """ GET query results may be stored by the browser, revalidated on every use """
+    if request.method == 'GET':
+        patch_cache_control(response, private=True, no_cache=True)
+        patch_vary_headers(response, ['Authorization', 'Cookie'])
+    return response
+
+
+class PersistedQueryNotFound(HttpError):
+    """
+        Unknown persisted query hash, answered as the GraphQL error on which
+        Apollo's persisted query link sends the query text again
+    """
+
+    def __init__(self):
+        super().__init__(HttpResponse(), 'PersistedQueryNotFound')
+
+
+class LimsGraphQLView(GraphQLView):
+    """
+        GraphQLView accepting persisted queries (see lims/persisted_queries.py)
+
+        Query results fetched with GET may be kept by the browser but have to
+        be revalidated: ConditionalGetMiddleware tags them with an ETag and
+        answers a matching If-None-Match with an empty 304, so unchanged
+        reference data (types, events, visits ...) is not sent again.
+    """
+
+    def dispatch(self, request, *args, **kwargs):
+        return patch_revalidation(request, super().dispatch(request, *args, **kwargs))
+
+    @staticmethod
+    def get_persisted_hash(request, data):
+        extensions = request.GET.get('extensions') or data.get('extensions')
+        if not extensions:
+            return None
+        if isinstance(extensions, str):
+            try:
+                extensions = json.loads(extensions)
+            except ValueError:
+                raise HttpError(HttpResponseBadRequest('Extensions are invalid JSON.'))
+        if not isinstance(extensions, dict):
+            raise HttpError(HttpResponseBadRequest('Extensions must be a JSON object.'))
+        persisted_query = extensions.get('persistedQuery') or {}
+        if not isinstance(persisted_query, dict):
+            raise HttpError(HttpResponseBadRequest('persistedQuery must be a JSON object.'))
+        return persisted_query.get('sha256Hash')
+
+    @staticmethod
+    def format_error(error):
+        formatted = GraphQLView.format_error(error)
+        if isinstance(error, PersistedQueryNotFound):
+            formatted['extensions'] = {'code': 'PERSISTED_QUERY_NOT_FOUND'}
+        return formatted
+
+    def get_graphql_params(self, request, data):
+        query, variables, operation_name, id = super().get_graphql_params(request, data)
+
+        sha256_hash = self.get_persisted_hash(request, data)
+        if sha256_hash is not None:
+            query = get_persisted_query(sha256_hash)
+            if query is None:
+                raise PersistedQueryNotFound()
+        elif query and persisted_only() and not is_registered(query):
+            raise HttpError(HttpResponseBadRequest('Only persisted queries are allowed.'))
+
+        return query, variables, operation_name, id
+
+
+def request_user(request):
+    """
+        Returns the session or JWT (header/cookie) user of a plain django
+        view, or None when the request is not authenticated
+        The token is checked by lims.auth.JSONWebTokenMiddleware
+    """
+    if request.user.is_authenticated:
+        return request.user
+    return None
+
+
+@require_GET
+def shipment_manifest(request, shipment):
+    """
+        Streams the manifest of a shipment as csv (default) or ndjson
+        ex) /manifest/12/?format=ndjson
+    """
+    if request_user(request) is None:
+        return HttpResponse('Not logged in', status=401)
+
+    export_format = request.GET.get('format', 'csv')
+    if export_format not in STREAM_FORMATS:
+        return HttpResponseBadRequest('Unknown format')
+    stream, content_type, extension = STREAM_FORMATS[export_format]
+    if not ShipmentModel.objects.filter(pk=shipment).exists():
+        return HttpResponseNotFound('Unknown shipment')
+
+    columns = [column for column, _ in MANIFEST_COLUMNS]
+    response = StreamingHttpResponse(
+        stream(columns, manifest_rows(shipment)),
+        content_type=content_type)
+    response['Content-Disposition'] = 'attachment; filename="shipment-{}.{}"'.format(
+        shipment, extension)
+    return response
+
+
+@require_GET
+def export_repository(request):
+    """
+        Streams the whole repository (see lims/exports.py) as csv (default),
+        ndjson or parquet
+        after: patient id to resume after, ex) /export/?format=ndjson&after=1200
+        to resume an interrupted download, drop the rows of the last patient
+        received and ask again after the patient before it
+        Staff only
+    """
+    user = request_user(request)
+    if user is None:
+        return HttpResponse('Not logged in', status=401)
+    if not user.is_staff:
+        return HttpResponse('Staff only', status=403)
+
+    try:
+        after = int(request.GET['after']) if request.GET.get('after') else None
+    except ValueError:
+        return HttpResponseBadRequest('Invalid after')
+    export_format = request.GET.get('format', 'csv')
+    columns = [column for column, _, _ in REPOSITORY_COLUMNS]
+    rows = repository_export(after)
+    if export_format == 'parquet':
+        if not parquet_available():
+            return HttpResponseBadRequest('The parquet format requires pyarrow')
+        types = [column_type for _, _, column_type in REPOSITORY_COLUMNS]
+        content = stream_parquet(columns, types, rows)
+        content_type, extension = 'application/vnd.apache.parquet', 'parquet'
+    elif export_format in STREAM_FORMATS:
+        stream, content_type, extension = STREAM_FORMATS[export_format]
+        content = stream(columns, rows)
+    else:
+        return HttpResponseBadRequest('Unknown format')
+
+    response = StreamingHttpResponse(content, content_type=content_type)
+    response['Content-Disposition'] = 'attachment; filename="repository.{}"'.format(extension)
+    return response
+
+
+@require_GET
+def metrics(request):
+    """
+        GraphQL telemetry of every worker in the Prometheus text format
+        Requires the METRICS_TOKEN bearer token, and is not served without
+        one unless DEBUG is on
+    """
+    token = get_telemetry_settings()['METRICS_TOKEN']
+    if not token:
+        if not settings.DEBUG:
+            return HttpResponse('METRICS_TOKEN is not set', status=403)
+    elif request.META.get('HTTP_AUTHORIZATION') != 'Bearer {}'.format(token):
+        return HttpResponse('Not authorized', status=401)
+    return HttpResponse(
+        render_prometheus(collect()),
+        content_type='text/plain; version=0.0.4; charset=utf-8')